@@ -1,23 +1,47 @@
-from flask import Flask, request, Response, jsonify
-import json
 import os
-import requests
+import sys
+import time
 
-# API Configuration - Load from environment variables
+# Make the shared proxy package importable when Vercel loads this file directly
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from proxy import routing, upstream
+
+# API Configuration - Load from environment variables, once per instance
 API_CONFIG = {
     "api_key": os.getenv("CLAUDE_API_KEY", ""),
     "base_url": os.getenv("CLAUDE_BASE_URL", "https://www.dmxapi.cn/v1"),
     "model": os.getenv("CLAUDE_MODEL", "claude-sonnet-4-20250514")
 }
 
+# Open the upstream connection first, so its TLS handshake overlaps the
+# rest of the cold start (Flask alone takes over 100 ms to import)
+if API_CONFIG["api_key"]:
+    for target in routing.get_router(API_CONFIG).upstreams:
+        upstream.warm(target.base_url)
+
+from flask import Flask, request, Response, jsonify  # noqa: E402
+
+from proxy import admission, metrics, requestlog, resume, wire  # noqa: E402
+from proxy.blobs import BlobsMissing, check_references  # noqa: E402
+from proxy.chat import stream_chat  # noqa: E402
+from proxy.coalesce import stream_coalesced  # noqa: E402
+from proxy.context import fit_context  # noqa: E402
+from proxy.conversations import ConversationNotFound, record_reply, resolve_messages  # noqa: E402
+from proxy.response_cache import stream_with_cache  # noqa: E402
+from proxy.routes import admission_rejected, api, blobs_missing, conversation_not_found, start_batch  # noqa: E402
+from proxy.segmenter import segment_stream  # noqa: E402
+
 app = Flask(__name__)
+app.register_blueprint(api)
 
 # CORS headers for all responses
 @app.after_request
 def after_request(response):
     response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
-    response.headers.add('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Last-Event-ID')
+    response.headers.add('Access-Control-Allow-Methods', 'GET, POST, DELETE, OPTIONS')
+    response.headers.add('Access-Control-Expose-Headers', 'X-Conversation-Id, X-Request-Id, X-Stream-Id, X-Job-Id, Retry-After')
     return response
 
 @app.route('/api/test', methods=['GET'])
@@ -32,87 +56,92 @@ def handle_chat():
     if request.method == 'OPTIONS':
         return '', 200
     
+    started = time.perf_counter()
+    trace = requestlog.start(requestlog.request_id(request.headers.get('X-Request-Id')))
+    ticket = None
     try:
         data = request.get_json()
-        messages = data.get('messages', [])
         
         # Check if API key is configured
         if not API_CONFIG["api_key"]:
+            trace.finish(500, 'server_error', error='API key not configured')
             return jsonify({'error': 'API key not configured'}), 500
         
-        # Prepare the request to Claude API
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {API_CONFIG["api_key"]}'
-        }
+        client = admission.client_key(request.remote_addr, request.headers.get('X-Forwarded-For'))
+        # Admitted before the history, blobs and context budget are looked at,
+        # so a rejected request costs nothing and a retry starts clean
+        try:
+            ticket = admission.get_controller().admit(client)
+        except admission.Rejected as e:
+            trace.finish(e.status, 'rejected', reason=e.reason)
+            return admission_rejected(e)
+        
+        try:
+            conversation_id, messages, turn = resolve_messages(data, validate=check_references)
+        except ConversationNotFound:
+            ticket.release()
+            trace.finish(404, 'conversation_not_found')
+            return conversation_not_found()
+        except BlobsMissing as e:
+            ticket.release()
+            trace.finish(409, 'blob_not_found')
+            return blobs_missing(e)
+        
+        messages, max_tokens = fit_context(messages)
         
         payload = {
             'model': API_CONFIG['model'],
             'messages': messages,
             'stream': True,
-            'max_tokens': 10000
+            'max_tokens': max_tokens
         }
+        metrics.record_request(started, request.content_length or 0)
+        trace.event('chat_start', model=payload['model'], bytes_in=request.content_length or 0,
+                    messages=len(messages), max_tokens=max_tokens, conversation_id=conversation_id,
+                    client=client, stream_format=data.get('stream_format'))
         
-        def generate():
-            try:
-                # Make streaming request to Claude API
-                response = requests.post(
-                    f'{API_CONFIG["base_url"]}/chat/completions',
-                    headers=headers,
-                    json=payload,
-                    stream=True,
-                    timeout=30
-                )
-                
-                if response.status_code != 200:
-                    error_data = json.dumps({'error': f'API request failed with status {response.status_code}'})
-                    yield f"data: {error_data}\n\n"
-                    return
-                
-                # Stream the response
-                for line in response.iter_lines():
-                    if line:
-                        line = line.decode('utf-8')
-                        if line.startswith('data: '):
-                            data_content = line[6:]  # Remove 'data: ' prefix
-                            if data_content.strip() == '[DONE]':
-                                done_data = json.dumps({'done': True})
-                                yield f"data: {done_data}\n\n"
-                                break
-                            try:
-                                chunk_data = json.loads(data_content)
-                                output = json.dumps(chunk_data)
-                                yield f"data: {output}\n\n"
-                            except json.JSONDecodeError:
-                                continue
-                
-                # Ensure connection is properly closed
-                response.close()
-                
-            except requests.exceptions.Timeout:
-                error_data = json.dumps({'error': 'Request timed out'})
-                yield f"data: {error_data}\n\n"
-            except requests.exceptions.RequestException as e:
-                error_data = json.dumps({'error': f'Request failed: {str(e)}'})
-                yield f"data: {error_data}\n\n"
-            except Exception as e:
-                error_data = json.dumps({'error': f'Server error: {str(e)}'})
-                yield f"data: {error_data}\n\n"
-        
-        return Response(generate(), content_type='text/plain', headers={
+        headers = {
             'Cache-Control': 'no-cache',
-            'Connection': 'close'
-        })
+            'Connection': 'close',
+            'X-Request-Id': trace.request_id
+        }
+        frames = stream_with_cache(
+            payload, lambda: stream_coalesced(payload, lambda: stream_chat(API_CONFIG, payload, trace=trace)))
+        if conversation_id:
+            frames = record_reply(frames, turn)
+            headers['X-Conversation-Id'] = conversation_id
+        if data.get('stream_format') == 'segments':
+            frames = segment_stream(frames)
+        elif data.get('stream_format') == 'compact':
+            frames = wire.compact_stream(frames)
+        stream_id, frames = resume.resumable(frames, ticket)
+        if stream_id:
+            headers['X-Stream-Id'] = stream_id
+        encoding = wire.negotiate(request.headers.get('Accept-Encoding'))
+        if encoding:
+            frames = wire.compress_stream(frames, encoding)
+            headers.update(wire.compression_headers(encoding))
+        
+        frames = requestlog.TracedStream(metrics.instrument_stream(frames, started), trace)
+        frames = admission.AdmittedStream(frames, ticket)
+        return Response(frames, content_type='text/plain', headers=headers)
                 
     except Exception as e:
+        if ticket is not None:
+            ticket.release()
+        trace.finish(500, 'server_error', error=str(e))
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
+@app.route('/api/batch', methods=['POST'])
+def handle_batch():
+    return start_batch(API_CONFIG)
+
 @app.route('/api', methods=['GET'])
 @app.route('/api/', methods=['GET'])
 def handle_api_info():
     return jsonify({
         'message': 'FakeClippy API is running', 
-        'endpoints': ['/api/chat', '/api/test'],
+        'endpoints': ['/api/chat', '/api/batch', '/api/test', '/api/upstream/stats', '/api/conversations', '/api/blobs', '/api/attachments', '/api/preview', '/api/templates', '/api/cache', '/api/logs', '/api/context', '/api/metrics', '/api/profile'],
         'api_key_configured': bool(API_CONFIG["api_key"])
     })
 
@@ -0,0 +1,606 @@
+"""
+Async (ASGI) entry point for the chat proxy.
+
+Serves the same routes as server.py and api/index.py (/api/chat, /api/test,
+/api, static files from public/) but relays chat streams as coroutines, so
+one worker process can hold thousands of concurrent SSE streams instead of
+one OS thread per stream. The Flask apps remain the Vercel target.
+
+Run with:
+    uvicorn asgi:app --host localhost --port 5000
+"""
+import asyncio
+import json
+import mimetypes
+import os
+import time
+from urllib.parse import parse_qs, unquote
+
+from proxy import (admission, async_chat, attachments, batch, blobs, coalesce, context, metrics, preview,
+                   requestlog, resume, routing, static_assets, templates, wire)
+from proxy.config import load_api_config
+from proxy.conversations import (ConversationNotFound, arecord_reply, get_store,
+                                 resolve_messages, valid_conversation_id)
+from proxy.response_cache import astream_with_cache, cache as response_cache
+from proxy.segmenter import asegment_stream
+
+PUBLIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'public')
+
+# API Configuration - Load from environment variables or .env file
+API_CONFIG = load_api_config()
+
+CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers', b'Content-Type, Last-Event-ID'),
+    (b'access-control-allow-methods', b'GET, POST, DELETE, OPTIONS'),
+    (b'access-control-expose-headers', b'X-Conversation-Id, X-Request-Id, X-Stream-Id, X-Job-Id, Retry-After'),
+]
+
+
+async def send_body(send, status, body, content_type, extra_headers=()):
+    headers = [
+        (b'content-type', content_type.encode('latin-1')),
+        (b'content-length', str(len(body)).encode('latin-1')),
+    ]
+    headers.extend(CORS_HEADERS)
+    headers.extend(extra_headers)
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_json(send, status, obj):
+    await send_body(send, status, json.dumps(obj).encode('utf-8'), 'application/json')
+
+
+def request_headers(scope):
+    return {name.decode('latin-1'): value.decode('latin-1') for name, value in scope['headers']}
+
+
+def client_key(scope):
+    client = scope.get('client')
+    return admission.client_key(client[0] if client else None, request_headers(scope).get('x-forwarded-for'))
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+async def serve_precompressed(send, method, filename, headers):
+    entry = static_assets.get_assets(PUBLIC_DIR).get(filename)
+    if entry is None:
+        await send_body(send, 404, b'Not Found', 'text/plain')
+        return
+    status, body, response_headers = static_assets.select(
+        entry, headers.get('accept-encoding'), headers.get('if-none-match'))
+    response_headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in response_headers]
+    if status == 200:
+        response_headers.append((b'content-length', str(len(body)).encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': response_headers + CORS_HEADERS})
+    await send({'type': 'http.response.body', 'body': b'' if method == 'HEAD' else body})
+
+
+async def serve_static(send, filename):
+    path = os.path.normpath(os.path.join(PUBLIC_DIR, filename))
+    if not path.startswith(PUBLIC_DIR + os.sep) or not os.path.isfile(path):
+        await send_body(send, 404, b'Not Found', 'text/plain')
+        return
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    if content_type.startswith('text/') or content_type == 'application/javascript':
+        content_type += '; charset=utf-8'
+    body = await asyncio.to_thread(_read_file, path)
+    await send_body(send, 200, body, content_type)
+
+
+async def conversation_not_found(send):
+    await send_json(send, 404, {'error': 'Conversation not found', 'code': 'conversation_not_found'})
+
+
+async def relay_stream(receive, send, payload, turn=None, started=None, stream_format=None, trace=None,
+                       accept_encoding=None, ticket=None):
+    trace = trace or requestlog.start(requestlog.request_id())
+    headers = [
+        (b'content-type', b'text/plain; charset=utf-8'),
+        (b'cache-control', b'no-cache'),
+        (b'x-request-id', trace.request_id.encode('ascii')),
+    ] + CORS_HEADERS
+    frames = astream_with_cache(payload, lambda: coalesce.astream_coalesced(
+        payload, lambda: async_chat.astream_chat(API_CONFIG, payload, trace=trace)))
+    if turn:
+        frames = arecord_reply(frames, turn)
+        headers.append((b'x-conversation-id', turn.conversation_id.encode('ascii')))
+    if stream_format == 'segments':
+        frames = asegment_stream(frames)
+    elif stream_format == 'compact':
+        frames = wire.acompact_stream(frames)
+    stream_id, frames = resume.aresumable(frames, ticket)
+    if stream_id:
+        headers.append((b'x-stream-id', stream_id.encode('ascii')))
+    frames = compress_stream(frames, accept_encoding, headers)
+    await send_stream(receive, send, requestlog.atraced(metrics.ainstrument_stream(frames, started), trace), headers)
+
+
+def compress_stream(frames, accept_encoding, headers):
+    encoding = wire.negotiate(accept_encoding)
+    if not encoding:
+        return frames
+    headers.extend((name.lower().encode('latin-1'), value.encode('latin-1'))
+                   for name, value in wire.compression_headers(encoding).items())
+    return wire.acompress_stream(frames, encoding)
+
+
+async def send_stream(receive, send, frames, headers):
+    await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+
+    async def pump():
+        try:
+            async for frame in frames:
+                await send({'type': 'http.response.body', 'body': frame, 'more_body': True})
+        finally:
+            await frames.aclose()
+
+    async def watch_disconnect():
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+
+    # Stop reading from upstream as soon as the browser goes away
+    pump_task = asyncio.ensure_future(pump())
+    watch_task = asyncio.ensure_future(watch_disconnect())
+    await asyncio.wait([pump_task, watch_task], return_when=asyncio.FIRST_COMPLETED)
+    watch_task.cancel()
+    if not pump_task.done():
+        pump_task.cancel()
+        await asyncio.gather(pump_task, return_exceptions=True)
+        return
+    pump_task.result()
+    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+async def handle_chat(scope, receive, send):
+    started = time.perf_counter()
+    trace = requestlog.start(requestlog.request_id(request_headers(scope).get('x-request-id')))
+    ticket = None
+    try:
+        body = await read_body(receive)
+        if body is None:
+            trace.finish(499, 'client_closed')
+            return
+        data = json.loads(body or b'{}')
+
+        # Check if API key is configured
+        if not API_CONFIG["api_key"]:
+            trace.finish(500, 'server_error', error='API key not configured')
+            await send_json(send, 500, {'error': 'API key not configured'})
+            return
+
+        client = client_key(scope)
+        # Admitted before the history, blobs and context budget are looked at,
+        # so a rejected request costs nothing and a retry starts clean
+        try:
+            ticket = await admission.get_async_controller().admit(client)
+        except admission.Rejected as e:
+            trace.finish(e.status, 'rejected', reason=e.reason)
+            await send_body(send, e.status, json.dumps(e.body()).encode('utf-8'), 'application/json',
+                            [(b'retry-after', str(e.retry_after).encode('latin-1'))])
+            return
+
+        try:
+            # Off the event loop: CONVERSATION_STORE=sqlite reads the history from disk
+            conversation_id, messages, turn = await asyncio.to_thread(
+                resolve_messages, data, validate=blobs.check_references)
+        except ConversationNotFound:
+            ticket.release()
+            trace.finish(404, 'conversation_not_found')
+            await conversation_not_found(send)
+            return
+        except blobs.BlobsMissing as e:
+            ticket.release()
+            trace.finish(409, 'blob_not_found')
+            await send_json(send, 409, {'error': 'Attachment not found', 'code': 'blob_not_found', 'handles': e.handles})
+            return
+
+        messages, max_tokens = context.fit_context(messages)
+
+        payload = {
+            'model': API_CONFIG['model'],
+            'messages': messages,
+            'stream': True,
+            'max_tokens': max_tokens
+        }
+        metrics.record_request(started, len(body))
+        trace.event('chat_start', model=payload['model'], bytes_in=len(body), messages=len(messages),
+                    max_tokens=max_tokens, conversation_id=conversation_id, client=client,
+                    stream_format=data.get('stream_format'))
+    except Exception as e:
+        if ticket is not None:
+            ticket.release()
+        trace.finish(500, 'server_error', error=str(e))
+        await send_json(send, 500, {'error': f'Server error: {str(e)}'})
+        return
+
+    try:
+        await relay_stream(receive, send, payload, turn, started, data.get('stream_format'), trace,
+                           request_headers(scope).get('accept-encoding'), ticket)
+    finally:
+        ticket.release()
+        # Still open only if the stream was cancelled before its first frame
+        trace.finish(200, 'client_closed')
+
+
+async def handle_resume(scope, receive, send, stream_id):
+    started = time.perf_counter()
+    headers = request_headers(scope)
+    trace = requestlog.start(requestlog.request_id(headers.get('x-request-id')))
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    try:
+        position = resume.parse_event_id(headers.get('last-event-id', query.get('last_event_id', [None])[0]))
+    except ValueError as e:
+        trace.fail(str(e))
+        trace.finish(400, 'bad_request')
+        await send_json(send, 400, {'error': str(e)})
+        return
+    try:
+        frames, held = resume.aresume(stream_id, position)
+    except resume.StreamNotFound:
+        trace.finish(404, 'stream_not_found')
+        await send_json(send, 404, {'error': 'Stream not found', 'code': 'stream_not_found'})
+        return
+    except resume.ReplayUnavailable as e:
+        trace.finish(410, 'replay_unavailable')
+        await send_json(send, 410, {'error': str(e), 'code': 'replay_unavailable'})
+        return
+
+    client = client_key(scope)
+    trace.event('chat_resume', stream_id=stream_id, last_event_id=position, client=client)
+    ticket = None
+    if not held:
+        # A stream still reading upstream keeps its own slot, so only a
+        # replay of a finished one is admitted
+        try:
+            ticket = await admission.get_async_controller().admit(client)
+        except admission.Rejected as e:
+            trace.finish(e.status, 'rejected', reason=e.reason)
+            await send_body(send, e.status, json.dumps(e.body()).encode('utf-8'), 'application/json',
+                            [(b'retry-after', str(e.retry_after).encode('latin-1'))])
+            return
+    response_headers = [
+        (b'content-type', b'text/plain; charset=utf-8'),
+        (b'cache-control', b'no-cache'),
+        (b'x-request-id', trace.request_id.encode('ascii')),
+        (b'x-stream-id', stream_id.encode('ascii')),
+    ] + CORS_HEADERS
+    frames = compress_stream(frames, headers.get('accept-encoding'), response_headers)
+    try:
+        await send_stream(receive, send, requestlog.atraced(metrics.ainstrument_stream(frames, started), trace),
+                          response_headers)
+    finally:
+        if ticket is not None:
+            ticket.release()
+        trace.finish(200, 'client_closed')
+
+
+async def handle_batch(scope, receive, send):
+    trace = requestlog.start(requestlog.request_id(request_headers(scope).get('x-request-id')))
+    body = await read_body(receive)
+    if body is None:
+        trace.finish(499, 'client_closed')
+        return
+    try:
+        data = json.loads(body or b'{}')
+    except ValueError:
+        data = None
+    client = client_key(scope)
+    controller = admission.get_async_controller()
+    try:
+        ticket = await controller.admit(client)
+    except admission.Rejected as e:
+        trace.finish(e.status, 'rejected', reason=e.reason)
+        await send_body(send, e.status, json.dumps(e.body()).encode('utf-8'), 'application/json',
+                        [(b'retry-after', str(e.retry_after).encode('latin-1'))])
+        return
+    try:
+        # Each slide request takes its own ticket; the job's was charged to the client already
+        loop = asyncio.get_running_loop()
+        job = await asyncio.to_thread(
+            batch.start_job, API_CONFIG, data, trace,
+            admit=lambda: controller.admit_threadsafe(client, loop, charge=False))
+    except ValueError as e:
+        trace.fail(str(e))
+        trace.finish(400, 'bad_request')
+        await send_json(send, 400, {'error': str(e)})
+        return
+    except blobs.BlobsMissing as e:
+        trace.finish(409, 'blob_not_found')
+        await send_json(send, 409, {'error': 'Attachment not found', 'code': 'blob_not_found',
+                                    'handles': e.handles})
+        return
+    finally:
+        # The progress stream holds no upstream connection; holding a slot
+        # for it could leave the job's own slides waiting behind it
+        ticket.release()
+    headers = [
+        (b'content-type', b'text/plain; charset=utf-8'),
+        (b'cache-control', b'no-cache'),
+        (b'x-job-id', job.id.encode('ascii')),
+        (b'x-request-id', trace.request_id.encode('ascii')),
+    ] + CORS_HEADERS
+    # The job keeps running if the client goes away
+    await send_stream(receive, send, job.aframes(), headers)
+
+
+async def handle_batch_get(send, job_id):
+    try:
+        snapshot = await asyncio.to_thread(batch.get_store().get, job_id)
+    except batch.JobNotFound:
+        await send_json(send, 404, {'error': 'Job not found', 'code': 'job_not_found'})
+        return
+    await send_json(send, 200, snapshot)
+
+
+async def handle_blob_upload(receive, send, headers):
+    body = await read_body(receive)
+    if body is None:
+        return
+    try:
+        meta, deduplicated = await asyncio.to_thread(
+            blobs.get_store().put, body, headers.get('content-type'), headers.get('x-blob-name'))
+    except blobs.BlobTooLarge as e:
+        await send_json(send, 413, {'error': str(e)})
+        return
+    await send_json(send, 200, {
+        'handle': meta['handle'],
+        'marker': blobs.marker(meta['handle']),
+        'size': meta['size'],
+        'content_type': meta['content_type'],
+        'deduplicated': deduplicated,
+    })
+
+
+async def handle_attachment_upload(receive, send, headers):
+    body = await read_body(receive)
+    if body is None:
+        return
+    name = unquote(headers.get('x-blob-name', '')) or None
+    try:
+        result = await asyncio.to_thread(attachments.get_processor().process, body, headers.get('content-type'), name)
+    except blobs.BlobTooLarge as e:
+        await send_json(send, 413, {'error': str(e)})
+        return
+    except attachments.AttachmentsBusy as e:
+        await send_body(send, 503, json.dumps({'error': str(e)}).encode('utf-8'), 'application/json',
+                        [(b'retry-after', b'2')])
+        return
+    await send_json(send, 200, result)
+
+
+async def handle_blob_get(send, method, handle, headers):
+    store = blobs.get_store()
+    meta = store.get_meta(handle) if blobs.valid_handle(handle) else None
+    if meta is None:
+        await send_json(send, 404, {'error': 'Attachment not found', 'code': 'blob_not_found', 'handles': [handle]})
+        return
+    # Content-addressed, so a handle's bytes never change
+    cache_headers = [
+        (b'etag', f'"{handle}"'.encode('ascii')),
+        (b'cache-control', b'public, max-age=31536000, immutable'),
+    ]
+    if handle in headers.get('if-none-match', ''):
+        await send({'type': 'http.response.start', 'status': 304, 'headers': cache_headers + CORS_HEADERS})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+    if method == 'HEAD':
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', meta['content_type'].encode('latin-1')),
+            (b'content-length', str(meta['size']).encode('latin-1')),
+        ] + cache_headers + CORS_HEADERS})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+    body = await asyncio.to_thread(store.read, handle)
+    await send_body(send, 200, body, meta['content_type'], cache_headers)
+
+
+async def handle_conversation(send, method, conversation_id):
+    store = get_store()
+    if not valid_conversation_id(conversation_id):
+        await conversation_not_found(send)
+    elif method == 'GET':
+        messages = store.get(conversation_id)
+        if messages is None:
+            await conversation_not_found(send)
+        else:
+            await send_json(send, 200, {'conversation_id': conversation_id, 'messages': messages})
+    elif method == 'DELETE':
+        if store.delete(conversation_id):
+            preview.get_store().discard(conversation_id)
+            await send_json(send, 200, {'deleted': conversation_id})
+        else:
+            await conversation_not_found(send)
+    else:
+        await send_body(send, 405, b'Method Not Allowed', 'text/plain')
+
+
+async def handle_preview_update(receive, send):
+    body = await read_body(receive)
+    if body is None:
+        return
+    try:
+        data = json.loads(body or b'{}')
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+    conversation_id = data.get('conversation_id')
+    messages = None
+    if valid_conversation_id(conversation_id):
+        messages = await asyncio.to_thread(get_store().get, conversation_id)
+    if messages is None:
+        await conversation_not_found(send)
+        return
+    # Parsing and diffing a large document is CPU-bound
+    status, result = await asyncio.to_thread(preview.preview_reply, conversation_id, messages, data)
+    await send_json(send, status, result)
+
+
+async def handle_preview_get(send, conversation_id):
+    document = preview.get_store().document(conversation_id) if valid_conversation_id(conversation_id) else None
+    if document is None:
+        await send_json(send, 404, {'error': 'Preview not found', 'code': 'preview_not_found'})
+    else:
+        await send_json(send, 200, document)
+
+
+async def handle_template_get(send, name, headers):
+    try:
+        digest = await asyncio.to_thread(templates.get_digests().get, name)
+    except templates.TemplateNotFound:
+        await send_json(send, 404, {'error': 'Template not found', 'code': 'template_not_found'})
+        return
+    cache_headers = [(b'etag', f'"{digest.etag}"'.encode('ascii')), (b'cache-control', b'no-cache')]
+    if digest.etag in headers.get('if-none-match', ''):
+        await send({'type': 'http.response.start', 'status': 304, 'headers': cache_headers + CORS_HEADERS})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+    await send_body(send, 200, digest.html.encode('utf-8'), 'text/html; charset=utf-8', cache_headers)
+
+
+async def handle_profile(scope, receive, send):
+    # Imported on first use, so the profiler costs nothing until it is asked for
+    from proxy import profiler
+
+    try:
+        profiler.authorize(request_headers(scope).get('authorization'))
+    except profiler.ProfilerDisabled:
+        await send_json(send, 404, {'error': 'Not found'})
+        return
+    except profiler.NotAuthorized:
+        await send_json(send, 403, {'error': 'Forbidden', 'code': 'forbidden'})
+        return
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    try:
+        seconds, interval, output = profiler.parse_options({name: values[0] for name, values in query.items()})
+        # Sampled from a worker thread so the event loop keeps serving (and is profiled) meanwhile
+        result = await asyncio.to_thread(profiler.profile, seconds, interval)
+    except ValueError as e:
+        await send_json(send, 400, {'error': str(e)})
+        return
+    except profiler.ProfileRunning:
+        await send_json(send, 409, {'error': 'A profile is already running', 'code': 'profile_running'})
+        return
+    if output == 'collapsed':
+        await send_body(send, 200, result.collapsed().encode('utf-8'), 'text/plain; charset=utf-8')
+        return
+    await send_json(send, 200, result.report())
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            if API_CONFIG["api_key"]:
+                for target in routing.get_router(API_CONFIG).upstreams:
+                    asyncio.ensure_future(async_chat.warm(target.base_url))
+            asyncio.ensure_future(asyncio.to_thread(templates.get_digests().warm))
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await async_chat.close_all()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    method = scope['method']
+    path = scope['path']
+
+    if method == 'OPTIONS':
+        await send_body(send, 200, b'', 'text/plain')
+    elif path == '/api/chat' and method == 'POST':
+        await handle_chat(scope, receive, send)
+    elif path == '/api/batch' and method == 'POST':
+        await handle_batch(scope, receive, send)
+    elif path == '/api/batch' and method == 'GET':
+        await send_json(send, 200, batch.stats())
+    elif path.startswith('/api/batch/') and method == 'GET':
+        await handle_batch_get(send, path[len('/api/batch/'):])
+    elif path.startswith('/api/chat/') and method == 'GET':
+        await handle_resume(scope, receive, send, path[len('/api/chat/'):])
+    elif path == '/api/test' and method == 'GET':
+        await send_json(send, 200, {
+            "status": "Async proxy is working!",
+            "api_key_configured": bool(API_CONFIG["api_key"])
+        })
+    elif path in ('/api', '/api/') and method == 'GET':
+        await send_json(send, 200, {
+            'message': 'FakeClippy API is running',
+            'endpoints': ['/api/chat', '/api/batch', '/api/test', '/api/upstream/stats', '/api/conversations', '/api/blobs', '/api/attachments', '/api/preview', '/api/templates', '/api/cache', '/api/logs', '/api/context', '/api/metrics', '/api/profile'],
+            'api_key_configured': bool(API_CONFIG["api_key"])
+        })
+    elif path == '/api/metrics' and method == 'GET':
+        await send_body(send, 200, metrics.render().encode('utf-8'), metrics.CONTENT_TYPE)
+    elif path == '/api/upstream/stats' and method == 'GET':
+        await send_json(send, 200, {
+            'pools': async_chat.pool_stats(),
+            'coalescing': coalesce.stats(),
+            'routing': routing.stats(),
+            'admission': admission.get_async_controller().stats(),
+            'resume': resume.stats(),
+        })
+    elif path == '/api/logs' and method == 'GET':
+        await send_json(send, 200, requestlog.stats())
+    elif path == '/api/cache' and method == 'GET':
+        await send_json(send, 200, response_cache.stats())
+    elif path == '/api/context' and method == 'GET':
+        await send_json(send, 200, context.stats())
+    elif path == '/api/conversations' and method == 'GET':
+        await send_json(send, 200, get_store().stats())
+    elif path.startswith('/api/conversations/'):
+        await handle_conversation(send, method, path[len('/api/conversations/'):])
+    elif path == '/api/preview' and method == 'POST':
+        await handle_preview_update(receive, send)
+    elif path == '/api/preview' and method == 'GET':
+        await send_json(send, 200, preview.get_store().stats())
+    elif path.startswith('/api/preview/') and method == 'GET':
+        await handle_preview_get(send, path[len('/api/preview/'):])
+    elif path == '/api/templates' and method == 'GET':
+        await send_json(send, 200, await asyncio.to_thread(templates.get_digests().stats))
+    elif path.startswith('/api/templates/') and method == 'GET':
+        await handle_template_get(send, path[len('/api/templates/'):], request_headers(scope))
+    elif path == '/api/blobs' and method == 'POST':
+        await handle_blob_upload(receive, send, request_headers(scope))
+    elif path == '/api/attachments' and method == 'POST':
+        await handle_attachment_upload(receive, send, request_headers(scope))
+    elif path == '/api/attachments' and method == 'GET':
+        await send_json(send, 200, attachments.get_processor().stats())
+    elif path == '/api/blobs' and method == 'GET':
+        await send_json(send, 200, blobs.get_store().stats())
+    elif path.startswith('/api/blobs/') and method in ('GET', 'HEAD'):
+        await handle_blob_get(send, method, path[len('/api/blobs/'):], request_headers(scope))
+    elif path == '/api/profile' and method == 'POST':
+        await handle_profile(scope, receive, send)
+    elif path.startswith('/api/'):
+        await send_json(send, 404, {'error': 'Not found'})
+    elif method in ('GET', 'HEAD') and static_assets.STATIC_CONFIG["mode"] == 'precompressed':
+        await serve_precompressed(send, method, 'index.html' if path == '/' else path.lstrip('/'), request_headers(scope))
+    elif method in ('GET', 'HEAD'):
+        await serve_static(send, 'index.html' if path == '/' else path.lstrip('/'))
+    else:
+        await send_body(send, 405, b'Method Not Allowed', 'text/plain')
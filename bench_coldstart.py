@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Cold-start benchmark for the Vercel function in api/index.py.
+
+Each run starts a fresh interpreter that loads the entry module the way
+the Vercel runtime does (import by path, then call the WSGI app), sends
+one /api/chat request against a local fake_upstream.py and reads the
+reply. Reported per entry:
+
+- startup: interpreter start until the driver runs,
+- import: importing the entry module, i.e. building the app,
+- first byte: from calling the app until the first reply chunk,
+- cold ttfb: from spawning the process until the first reply chunk,
+- warm ttfb: first byte of a second request in the same process,
+- modules: entries in sys.modules once the reply is done.
+
+The baseline is api/index.py (and the proxy package) as of a git
+revision, extracted to a temporary directory with `git archive`, and runs
+of both trees are interleaved. With --fail-over, the exit status is 1
+when the working tree's median cold ttfb is more than that many percent
+above the baseline's.
+
+Usage:
+    python bench_coldstart.py [--runs 15] [--baseline HEAD~1] [--fail-over 10] [--output coldstart.json]
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from loadtest_streams import ROOT, percentile
+
+# Runs in the fresh interpreter; argv: entry path
+DRIVER = r'''
+import time
+spawned = time.time()
+import importlib, io, json, os, sys
+
+entry = sys.argv[1]
+sys.path.insert(0, os.path.dirname(entry))
+started = time.perf_counter()
+module = importlib.import_module(os.path.splitext(os.path.basename(entry))[0])
+imported = time.perf_counter()
+
+
+def chat(text):
+    body = json.dumps({'message': {'role': 'user', 'content': text}}).encode('utf-8')
+    environ = {
+        'REQUEST_METHOD': 'POST', 'PATH_INFO': '/api/chat', 'QUERY_STRING': '', 'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '443', 'SERVER_PROTOCOL': 'HTTP/1.1', 'REMOTE_ADDR': '127.0.0.1',
+        'CONTENT_TYPE': 'application/json', 'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0), 'wsgi.url_scheme': 'https', 'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr, 'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+    }
+    status = []
+    begin = time.perf_counter()
+    result = module.app(environ, lambda s, headers, exc_info=None: status.append(s))
+    first = None
+    size = 0
+    try:
+        for chunk in result:
+            if chunk and first is None:
+                first = time.perf_counter()
+                first_wall = time.time()
+            size += len(chunk)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    if first is None:
+        first, first_wall = time.perf_counter(), time.time()
+    return status[0], size, first - begin, first_wall
+
+
+status, size, first_byte, first_wall = chat('Hello')
+_, _, warm_first_byte, _ = chat('Hello again')
+print(json.dumps({
+    'spawned': spawned, 'import': imported - started, 'first_byte': first_byte, 'first_wall': first_wall,
+    'warm_first_byte': warm_first_byte, 'status': status, 'bytes': size, 'modules': len(sys.modules),
+}))
+'''
+
+
+def extract_baseline(ref, directory):
+    """Write api/ and proxy/ as of ref into directory and return its entry path."""
+    archive = subprocess.run(['git', 'archive', ref, 'api', 'proxy'], cwd=ROOT, check=True,
+                             capture_output=True).stdout
+    subprocess.run(['tar', '-x', '-C', directory], input=archive, check=True)
+    return os.path.join(directory, 'api', 'index.py')
+
+
+def start_upstream(args):
+    cmd = [sys.executable, 'fake_upstream.py', '--port', str(args.upstream_port),
+           '--tokens', str(args.tokens), '--interval', str(args.interval)]
+    proc = subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.DEVNULL)
+    time.sleep(0.5)
+    return proc
+
+
+def run_once(entry, env):
+    spawned = time.time()
+    out = subprocess.run([sys.executable, '-c', DRIVER, entry], cwd=tempfile.gettempdir(),
+                         env=env, capture_output=True, text=True, timeout=60)
+    if out.returncode != 0:
+        raise RuntimeError(f'{entry} failed:\n{out.stderr}')
+    r = json.loads(out.stdout.strip().splitlines()[-1])
+    if not r['status'].startswith('200'):
+        raise RuntimeError(f'{entry} answered {r["status"]}:\n{out.stderr}')
+    return {
+        'startup_ms': (r['spawned'] - spawned) * 1000,
+        'import_ms': r['import'] * 1000,
+        'first_byte_ms': r['first_byte'] * 1000,
+        'cold_ttfb_ms': (r['first_wall'] - spawned) * 1000,
+        'warm_ttfb_ms': r['warm_first_byte'] * 1000,
+        'modules': r['modules'],
+    }
+
+
+COLUMNS = ('startup_ms', 'import_ms', 'first_byte_ms', 'cold_ttfb_ms', 'warm_ttfb_ms', 'modules')
+
+
+def summarize(runs):
+    return {
+        column: {
+            'p50': round(statistics.median(r[column] for r in runs), 1),
+            'p90': round(percentile([r[column] for r in runs], 90), 1),
+        }
+        for column in COLUMNS
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=15)
+    parser.add_argument('--baseline', default='HEAD', metavar='REF',
+                        help="git revision to compare against, or '' to measure the working tree only")
+    parser.add_argument('--fail-over', type=float, default=None, metavar='PCT',
+                        help='exit 1 if the median cold ttfb regressed by more than PCT percent')
+    parser.add_argument('--upstream-port', type=int, default=8957)
+    parser.add_argument('--tokens', type=int, default=20)
+    parser.add_argument('--interval', type=float, default=0.001)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.update({
+        'VERCEL': '1',
+        'CLAUDE_API_KEY': 'benchmark',
+        'CLAUDE_BASE_URL': f'http://127.0.0.1:{args.upstream_port}/v1',
+        'BLOB_DIR': tempfile.mkdtemp(prefix='coldstart-blobs-'),
+    })
+    workdir = tempfile.mkdtemp(prefix='coldstart-')
+    entries = {'working tree': os.path.join(ROOT, 'api', 'index.py')}
+    if args.baseline:
+        entries[args.baseline] = extract_baseline(args.baseline, workdir)
+
+    upstream = start_upstream(args)
+    results = {name: [] for name in entries}
+    try:
+        # One untimed run each so both trees start with compiled bytecode
+        for entry in entries.values():
+            run_once(entry, env)
+        for _ in range(args.runs):
+            for name, entry in entries.items():
+                results[name].append(run_once(entry, env))
+    finally:
+        upstream.terminate()
+        upstream.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+        shutil.rmtree(env['BLOB_DIR'], ignore_errors=True)
+
+    report = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': vars(args),
+        'results': {name: summarize(runs) for name, runs in results.items()},
+    }
+    print(f"{'entry':<14} {'startup':>8} {'import':>8} {'1st byte':>9} {'cold ttfb':>10} {'p90':>7} "
+          f"{'warm ttfb':>10} {'modules':>8}   (ms, medians of {args.runs} runs)")
+    for name, s in report['results'].items():
+        print(f"{name:<14} {s['startup_ms']['p50']:>8} {s['import_ms']['p50']:>8} {s['first_byte_ms']['p50']:>9} "
+              f"{s['cold_ttfb_ms']['p50']:>10} {s['cold_ttfb_ms']['p90']:>7} {s['warm_ttfb_ms']['p50']:>10} "
+              f"{int(s['modules']['p50']):>8}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.baseline and args.fail_over is not None:
+        current = report['results']['working tree']['cold_ttfb_ms']['p50']
+        baseline = report['results'][args.baseline]['cold_ttfb_ms']['p50']
+        change = (current - baseline) / baseline * 100
+        print(f"\ncold ttfb {change:+.1f}% against {args.baseline}")
+        if change > args.fail_over:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
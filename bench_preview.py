@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Benchmark and correctness check for the live preview patches (proxy/preview.py).
+
+Generates slide decks of increasing size from the public/Template*.html
+slides (one <head> with the templates' styles and scripts, N slides in
+<body>, a few images referenced as IMAGE_PLACEHOLDER_n), then feeds the
+preview store a sequence of replies, each a typical edit of the previous
+deck: retitle or restyle a slide, insert, delete or move one, edit a
+tenth of the slides, change a CSS rule, add a script.
+
+For every step it reports the time to extract, parse and diff the reply,
+the number of ops, and the bytes the browser receives: the patch, next to
+the whole document plus the base64 images that the old preview path
+re-inlined on every update. Each patch is applied to the previous tree in
+Python with the same semantics as the browser code, and the result must
+equal the new document. No network or API key is needed.
+
+Usage:
+    python bench_preview.py [--slides 20 100 400] [--image-kb 250] [--seed 1]
+"""
+import argparse
+import copy
+import glob
+import json
+import os
+import random
+import sys
+import time
+
+from proxy import preview
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+HANDLES = ['%032x' % (i + 1) for i in range(3)]
+ASSET_BASE = 'https://example.test/api/blobs/'
+
+
+def load_slides():
+    """Head children and top-level slide elements of every template."""
+    heads, slides = [], []
+    for path in sorted(glob.glob(os.path.join(ROOT, 'public', 'Template*.html'))):
+        with open(path, encoding='utf-8') as f:
+            document = preview.parse(f.read())
+        heads.extend(node for node in document.head.children if node.tag != '#text')
+        slides.extend(node for node in document.body.children if node.tag not in ('#text', '#comment', 'script'))
+    return heads, slides
+
+
+def build_deck(heads, slides, count):
+    deck = preview.Document()
+    deck.doctype = 'DOCTYPE html'
+    deck.html.attrs = [('lang', 'en')]
+    seen = set()
+    for node in heads:
+        markup = preview.serialize(node)
+        if markup not in seen:
+            seen.add(markup)
+            deck.head.children += [preview.Text('\n'), copy.deepcopy(node)]
+    for i in range(count):
+        slide = copy.deepcopy(slides[i % len(slides)])
+        slide.attrs = [(k, v) for k, v in slide.attrs if k != 'id'] + [('id', f'slide-{i}')]
+        if i % 7 == 0:
+            image = preview.Element('img', [('src', f'IMAGE_PLACEHOLDER_{i // 7 % 3 + 1}'), ('alt', '')])
+            slide.children.append(image)
+        deck.body.children += [preview.Text('\n'), slide]
+    deck.body.children.append(preview.Text('\n'))
+    return deck
+
+
+def elements(node, tag=None):
+    for child in getattr(node, 'children', ()):
+        if child.tag == '#text' or child.tag == '#comment':
+            continue
+        if tag is None or child.tag == tag:
+            yield child
+        yield from elements(child, tag)
+
+
+def slide_nodes(deck):
+    return [node for node in deck.body.children if node.tag != '#text']
+
+
+def has_canvas(node):
+    return any(True for _ in elements(node, 'canvas')) or node.tag == 'canvas'
+
+
+def retitle(deck, rng, count=1):
+    candidates = [s for s in slide_nodes(deck) if not has_canvas(s)]
+    for slide in rng.sample(candidates, min(count, len(candidates))):
+        texts = [t for e in [slide, *elements(slide)] for t in e.children if t.tag == '#text' and t.text.strip()]
+        if texts:
+            rng.choice(texts).text = f'Edited {rng.randrange(10 ** 6)}'
+
+
+def restyle(deck, rng):
+    slide = rng.choice(slide_nodes(deck))
+    slide.attrs = [(k, v) for k, v in slide.attrs if k != 'style'] + [('style', 'outline: 2px solid #f60;')]
+
+
+def insert_slide(deck, rng):
+    children = deck.body.children
+    new = copy.deepcopy(rng.choice([s for s in slide_nodes(deck) if not has_canvas(s)]))
+    new.attrs = [(k, v) for k, v in new.attrs if k != 'id'] + [('id', f'slide-new-{rng.randrange(10 ** 6)}')]
+    at = 2 * rng.randrange(len(children) // 2) + 1
+    children[at:at] = [new, preview.Text('\n')]
+
+
+def delete_slide(deck, rng):
+    children = deck.body.children
+    at = children.index(rng.choice([s for s in slide_nodes(deck) if not has_canvas(s)]))
+    del children[at:at + 2]
+
+
+def move_slide(deck, rng):
+    children = deck.body.children
+    at = children.index(rng.choice([s for s in slide_nodes(deck) if not has_canvas(s)]))
+    moved = children[at:at + 2]
+    del children[at:at + 2]
+    to = 2 * rng.randrange(len(children) // 2) + 1
+    children[to:to] = moved
+
+
+def change_css(deck, rng):
+    style = next(elements(deck.head, 'style'))
+    style.children = [preview.Text(style.children[0].text + '\n.slide h1 { letter-spacing: 0.02em; }\n')]
+
+
+def add_script(deck, rng):
+    script = preview.Element('script')
+    script.children.append(preview.Text('console.log("slide deck ready");'))
+    deck.body.children += [script, preview.Text('\n')]
+
+
+EDITS = [
+    ('retitle one slide', retitle),
+    ('restyle one slide', restyle),
+    ('insert a slide', insert_slide),
+    ('delete a slide', delete_slide),
+    ('move a slide', move_slide),
+    ('edit 10% of slides', lambda deck, rng: retitle(deck, rng, max(1, len(slide_nodes(deck)) // 10))),
+    ('change a CSS rule', change_css),
+    ('add a script', add_script),
+]
+
+
+# Python version of applyPreviewPatch() in public/script.js
+
+def resolve(document, path):
+    node = document.head if path[0] == 0 else document.body
+    for index in path[1:]:
+        node = node.children[index]
+    return node, None
+
+
+def apply_ops(document, ops):
+    for op in ops:
+        if op['op'] in ('remove', 'replace', 'text', 'attrs'):
+            parent = document.head if op['path'][0] == 0 else document.body
+            for index in op['path'][1:-1]:
+                parent = parent.children[index]
+            if len(op['path']) == 1:
+                node, parent, index = parent, None, None
+            else:
+                index = op['path'][-1]
+                node = parent.children[index]
+        else:
+            node, _ = resolve(document, op['path'])
+        if node.tag != op['node']:
+            raise AssertionError(f'{op["op"]} expected <{op["node"]}>, found <{node.tag}>')
+        if op['op'] == 'text':
+            node.text = op['text']
+        elif op['op'] == 'attrs':
+            attrs = dict(node.attrs)
+            attrs.update(op['set'])
+            node.attrs = [(k, v) for k, v in attrs.items() if k not in op['remove']]
+        elif op['op'] == 'remove':
+            del parent.children[index]
+        elif op['op'] == 'replace':
+            parent.children[index:index + 1] = preview.parse_fragment(op['html'], parent.tag)
+        elif op['op'] == 'insert':
+            node.children[op['index']:op['index']] = preview.parse_fragment(op['html'], node.tag)
+
+
+def canonical(node):
+    if node.tag in ('#text', '#comment'):
+        return (node.tag, node.text)
+    return (node.tag, sorted(node.attrs, key=lambda a: a[0]), [canonical(c) for c in node.children])
+
+
+def reply_for(deck):
+    return 'Here is the updated deck:\n\n```html\n' + preview.serialize_document(deck) + '\n```\n'
+
+
+def run(deck, rng, image_bytes):
+    store = preview.PreviewStore(max_documents=10, patch_ratio=preview.PREVIEW_CONFIG["patch_ratio"])
+    images = {f'IMAGE_PLACEHOLDER_{i + 1}': handle for i, handle in enumerate(HANDLES)}
+    first = store.update('bench', reply_for(deck), None, images, ASSET_BASE)
+    version = first['version']
+    shown = preview.parse(first['html'])
+    failures = 0
+    for name, edit in EDITS:
+        deck = copy.deepcopy(deck)
+        edit(deck, rng)
+        reply = reply_for(deck)
+        started = time.perf_counter()
+        result = store.update('bench', reply, version, images, ASSET_BASE)
+        elapsed = time.perf_counter() - started
+        expected = preview.parse(preview.extract_html(reply))
+        preview.link_images(expected, images, ASSET_BASE)
+        document_bytes = len(preview.serialize_document(expected).encode('utf-8'))
+        if result['mode'] == 'patch':
+            sent = len(json.dumps(result['ops'], ensure_ascii=False).encode('utf-8'))
+            apply_ops(shown, result['ops'])
+            detail = f"{len(result['ops'])} ops"
+        else:
+            sent = len(result['html'].encode('utf-8'))
+            shown = preview.parse(result['html'])
+            detail = result['reason']
+        ok = canonical(shown.html) == canonical(expected.html)
+        failures += not ok
+        legacy = document_bytes + image_bytes
+        print(f"  {name:<20} {elapsed * 1000:>8.1f} {result['mode']:>9} {sent / 1024:>10.1f} "
+              f"{legacy / 1024:>10.1f} {sent / legacy * 100:>6.2f}%  {detail}{'' if ok else '  MISMATCH'}")
+        version = result['version']
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--slides', type=int, nargs='+', default=[20, 100, 400])
+    parser.add_argument('--image-kb', type=int, default=250, help='size of each of the 3 images before base64')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    heads, slides = load_slides()
+    image_bytes = 3 * (args.image_kb * 1024 * 4 // 3)
+    failures = 0
+    for count in args.slides:
+        deck = build_deck(heads, slides, count)
+        size = len(preview.serialize_document(deck).encode('utf-8'))
+        print(f"\n{count} slides, {size / 1024:.0f} KB document")
+        print(f"  {'edit':<20} {'diff ms':>8} {'mode':>9} {'sent KB':>10} {'legacy KB':>10} {'ratio':>7}")
+        failures += run(deck, random.Random(args.seed), image_bytes)
+    if failures:
+        print(f'\n{failures} patch(es) did not reproduce the new document')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
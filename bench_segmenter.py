@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for proxy/segmenter.py.
+
+Replays the largest reply of the test_segmenter.py corpus (every
+public/Template*.html slide several times, multi-hundred KB) as
+token-sized deltas and reports segmenter throughput, with and without
+the SSE re-framing done by the proxy, next to a Python port of the
+per-delta work the browser does on the plain stream (detectHTML,
+getCleanMessageForHTML and formatMessage over the whole accumulated
+reply). The port is only run up to --baseline-max-kb because its cost
+grows with the square of the reply length. That the segment events are
+correct is checked by test_segmenter.py. No network or API key is needed.
+
+Usage:
+    python bench_segmenter.py [--repeat 5] [--baseline-max-kb 64] [--seed 1]
+"""
+import argparse
+import json
+import random
+import re
+import time
+
+from proxy.segmenter import segment_stream
+from test_segmenter import build_corpus, load_templates, segment, split_deltas
+
+
+# Python port of the browser's per-delta work on the plain stream (public/script.js)
+
+_DETECT = [re.compile(p, re.I) for p in (
+    r'<html', r'<!DOCTYPE', r'<div', r'<body', r'<head', r'<p\s', r'<span', r'<section', r'<article', r'<nav',
+    r'<header', r'<footer', r'<form', r'<table', r'<button', r'<input', r'```html', r'<style', r'<script',
+    r'<link', r'<meta', r'<title', r'<h[1-6]', r'<ul', r'<ol', r'<li', r'<img', r'<a\s')]
+_CLEAN = [re.compile(p, re.I) for tag in ('html', '!DOCTYPE', 'div', 'section', 'article', 'form', 'table', 'style',
+                                          'script', 'body', 'head', 'nav', 'header', 'footer')
+          for p in (r'<%s[\s\S]*?</%s>' % (tag, 'html' if tag == '!DOCTYPE' else tag), r'<%s[\s\S]*$' % tag)]
+PLACEHOLDER = '[HTML_PREVIEW_PLACEHOLDER]'
+
+
+def detect_html(content):
+    return any(p.search(content) for p in _DETECT)
+
+
+def clean_message(content):
+    content = re.sub(r'```html[\s\S]*?```', PLACEHOLDER, content, flags=re.I)
+    content = re.sub(r'```html[\s\S]*$', PLACEHOLDER, content, flags=re.I)
+    content = re.sub(r'^\s*[\'"`]?html[\'"`]?\s*', '', content, flags=re.I)
+    content = re.sub(r'\n\s*[\'"`]?html[\'"`]?\s*', '\n', content, flags=re.I)
+    for pattern in _CLEAN:
+        content = pattern.sub(PLACEHOLDER, content)
+    content = re.sub(r'<[^>]*>', '', content)
+    content = re.sub(r'<[^>]*$', '', content)
+    content = re.sub(r'\n\s*\n', '\n', content).strip()
+    return content
+
+
+def format_message(content):
+    content = re.sub(r'\*\*(.*?)\*\*', r'<strong>\1</strong>', content)
+    content = re.sub(r'\*(.*?)\*', r'<em>\1</em>', content)
+    content = re.sub(r'`(.*?)`', r'<code>\1</code>', content)
+    return content.replace('\n', '<br>')
+
+
+def browser_baseline(deltas):
+    message = ''
+    html_detected = False
+    for delta in deltas:
+        message += delta
+        if not html_detected and detect_html(message):
+            html_detected = True
+        format_message(clean_message(message) if html_detected else message)
+
+
+def sse_frames(deltas):
+    for delta in deltas:
+        chunk = {'choices': [{'index': 0, 'delta': {'content': delta}, 'finish_reason': None}]}
+        yield f'data: {json.dumps(chunk)}\n\n'.encode('utf-8')
+    yield b'data: {"done": true}\n\n'
+
+
+def timed(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench(corpus, repeat, baseline_max_kb, seed):
+    rng = random.Random(seed)
+    sizes = [16, 32, 64, 128, 300]
+    _, big, _ = corpus[-1]
+    print(f"{'reply KB':>8} {'deltas':>8} {'segmenter ms':>13} {'MB/s':>7} {'+ SSE ms':>9} {'browser-style ms':>17}")
+    for kb in sizes:
+        reply = big[:kb * 1024]
+        deltas = split_deltas(reply, rng)
+        frames = list(sse_frames(deltas))
+        seg = timed(lambda: segment(deltas), repeat)
+        sse = timed(lambda: sum(1 for _ in segment_stream(iter(frames))), repeat)
+        baseline = '-'
+        if kb <= baseline_max_kb:
+            baseline = f'{timed(lambda: browser_baseline(deltas), 1) * 1000:.0f}'
+        print(f'{kb:>8} {len(deltas):>8} {seg * 1000:>13.1f} {len(reply) / seg / 1e6:>7.1f} '
+              f'{sse * 1000:>9.1f} {baseline:>17}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--baseline-max-kb', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    bench(build_corpus(load_templates()), args.repeat, args.baseline_max_kb, args.seed)
+
+
+if __name__ == '__main__':
+    main()
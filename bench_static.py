@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Before/after benchmark for static asset serving.
+
+Loads the page the way a browser would (index.html, then the stylesheet,
+script and favicon it references) against server.py in both STATIC_MODE
+settings, using the Flask test client so no port is needed:
+
+- cold: first visit, nothing cached;
+- warm: revisit with the validators from the cold visit. Immutable
+  fingerprinted assets are served from the browser cache without a request.
+
+Reports bytes on the wire and server CPU time per page load.
+
+Usage:
+    python bench_static.py [--loads 200]
+"""
+import argparse
+import gzip
+import re
+import time
+
+import server
+from proxy import static_assets
+
+ACCEPT_ENCODING = 'gzip, deflate, br' if static_assets.brotli else 'gzip, deflate'
+
+
+def page_assets(html):
+    return [m for m in re.findall(r'(?:href|src)="([^"]+)"', html) if not m.startswith(('http:', 'https:', '//'))]
+
+
+def load_page(client, cache):
+    """One page load; returns bytes received and the number of requests."""
+    received = 0
+    requests_made = 0
+
+    def fetch(path):
+        nonlocal received, requests_made
+        cached = cache.get(path)
+        if cached is not None and 'immutable' in cached['cache_control']:
+            return cached['text']
+        headers = {'Accept-Encoding': ACCEPT_ENCODING}
+        if cached is not None:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        response = client.get(path, headers=headers)
+        requests_made += 1
+        received += len(response.data) + sum(len(k) + len(v) + 4 for k, v in response.headers.items())
+        if response.status_code == 304:
+            return cached['text']
+        text = response.get_data(as_text=False)
+        if response.headers.get('Content-Encoding') == 'gzip':
+            text = gzip.decompress(text)
+        elif response.headers.get('Content-Encoding') == 'br':
+            text = static_assets.brotli.decompress(text)
+        cache[path] = {
+            'text': text.decode('utf-8', errors='replace'),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'cache_control': response.headers.get('Cache-Control', ''),
+        }
+        response.close()
+        return cache[path]['text']
+
+    html = fetch('/')
+    for asset in page_assets(html) + ['favicon.ico']:
+        fetch('/' + asset.lstrip('/'))
+    return received, requests_made
+
+
+def run(mode, loads):
+    static_assets.STATIC_CONFIG["mode"] = mode
+    if mode == 'precompressed':
+        static_assets.get_assets('public')
+    client = server.app.test_client()
+
+    results = {}
+    for phase in ('cold', 'warm'):
+        total_bytes = 0
+        total_requests = 0
+        cpu = 0.0
+        for _ in range(loads):
+            cache = {}
+            if phase == 'warm':
+                load_page(client, cache)
+            start = time.process_time()
+            received, requests_made = load_page(client, cache)
+            cpu += time.process_time() - start
+            total_bytes += received
+            total_requests += requests_made
+        results[phase] = (total_bytes / loads, total_requests / loads, cpu / loads * 1000)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--loads', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'mode':<14} {'phase':<6} {'KB/load':>10} {'requests':>9} {'cpu ms/load':>12}")
+    for mode in ('directory', 'precompressed'):
+        for phase, (size, count, cpu_ms) in run(mode, args.loads).items():
+            print(f"{mode:<14} {phase:<6} {size / 1024:>10.1f} {count:>9.1f} {cpu_ms:>12.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Reproducible streaming benchmark for the chat proxy.
+
+Starts fake_upstream.py and each proxy entry point (server.py, the Vercel
+app in api/index.py, asgi.py) in subprocesses, then runs a fixed number of
+/api/chat streams per concurrency level and reports:
+
+- time to first byte and inter-chunk latency percentiles,
+- throughput (streams/s and proxied KB/s),
+- proxy CPU time per stream and peak RSS (read from /proc, so Linux only),
+- errors seen by the client, including injected upstream failures.
+
+Every run is written to a JSON file together with its settings, so results
+from different commits or machines can be compared side by side.
+
+Usage:
+    python bench_streams.py --target server vercel --concurrency 1 10 50 --output bench.json
+    python bench_streams.py --latency 0.5 --error-rate 0.05 --disconnect-rate 0.02 --seed 7
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import httpx
+
+from loadtest_streams import ROOT, percentile, proc_status, wait_ready
+
+TARGETS = {
+    'server': [sys.executable, '-c',
+               "import sys, server; server.app.run(host='127.0.0.1', port=int(sys.argv[1]), threaded=True)"],
+    'vercel': [sys.executable, '-c',
+               "import sys; sys.path.insert(0, 'api'); import index; "
+               "index.app.run(host='127.0.0.1', port=int(sys.argv[1]), threaded=True)"],
+    'asgi': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1',
+             '--log-level', 'warning', '--port'],
+}
+
+UPSTREAM_OPTIONS = ('tokens', 'interval', 'jitter', 'latency', 'token_bytes', 'error_rate', 'error_status',
+                    'disconnect_rate', 'seed')
+
+
+def cpu_seconds(pid):
+    """User + system CPU time of pid from /proc/<pid>/stat."""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def start_upstream(args):
+    cmd = [sys.executable, 'fake_upstream.py', '--port', str(args.upstream_port)]
+    for name in UPSTREAM_OPTIONS:
+        value = getattr(args, name)
+        if value is not None:
+            cmd += ['--' + name.replace('_', '-'), str(value)]
+    return subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.DEVNULL)
+
+
+def start_proxy(target, port, upstream_port, env_overrides):
+    env = dict(os.environ)
+    env.update(env_overrides)
+    env['CLAUDE_BASE_URL'] = f'http://127.0.0.1:{upstream_port}/v1'
+    env['CLAUDE_API_KEY'] = 'benchmark'
+    return subprocess.Popen(TARGETS[target] + [str(port)], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def one_stream(client, url, index, results):
+    # Distinct prompts so the replay cache and coalescing stay out of the numbers
+    payload = {'messages': [{'role': 'user', 'content': f'benchmark request {index}'}]}
+    start = time.perf_counter()
+    try:
+        async with client.stream('POST', url, json=payload) as response:
+            chunks = []
+            previous = None
+            body = b''
+            async for chunk in response.aiter_bytes():
+                now = time.perf_counter()
+                if previous is None:
+                    results['ttfb'].append(now - start)
+                else:
+                    chunks.append(now - previous)
+                previous = now
+                body += chunk
+        results['bytes'] += len(body)
+        results['inter_chunk'].extend(chunks)
+        if response.status_code == 200 and b'"done": true' in body:
+            results['ok'] += 1
+        elif b'"error"' in body:
+            results['upstream_errors'] += 1
+        else:
+            results['failed'] += 1
+    except httpx.HTTPError:
+        results['failed'] += 1
+
+
+async def run_level(pid, port, concurrency, requests, timeout):
+    results = {'ok': 0, 'failed': 0, 'upstream_errors': 0, 'bytes': 0, 'ttfb': [], 'inter_chunk': []}
+    idle_rss, _ = proc_status(pid)
+    peak = {'rss': idle_rss}
+    queue = asyncio.Queue()
+    for index in range(requests):
+        queue.put_nowait(index)
+
+    async def worker(client, url):
+        while not queue.empty():
+            await one_stream(client, url, queue.get_nowait(), results)
+
+    async def sample_rss(stop):
+        while not stop.is_set():
+            try:
+                peak['rss'] = max(peak['rss'], proc_status(pid)[0])
+            except OSError:
+                return
+            await asyncio.sleep(0.05)
+
+    stop = asyncio.Event()
+    sampler = asyncio.ensure_future(sample_rss(stop))
+    cpu_before = cpu_seconds(pid)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=0)
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        url = f'http://127.0.0.1:{port}/api/chat'
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client, url) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    cpu = cpu_seconds(pid) - cpu_before
+    stop.set()
+    await sampler
+
+    def ms(values, pct):
+        return round(percentile(values, pct) * 1000, 2)
+
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'ok': results['ok'],
+        'upstream_errors': results['upstream_errors'],
+        'failed': results['failed'],
+        'elapsed_s': round(elapsed, 3),
+        'streams_per_s': round(requests / elapsed, 2),
+        'kb_per_s': round(results['bytes'] / 1024 / elapsed, 1),
+        'ttfb_ms': {'p50': ms(results['ttfb'], 50), 'p95': ms(results['ttfb'], 95), 'p99': ms(results['ttfb'], 99)},
+        'inter_chunk_ms': {'p50': ms(results['inter_chunk'], 50), 'p95': ms(results['inter_chunk'], 95),
+                           'p99': ms(results['inter_chunk'], 99)},
+        'proxy_cpu_ms_per_stream': round(cpu * 1000 / requests, 2),
+        'proxy_peak_rss_mb': round(peak['rss'] / 1024, 1),
+    }
+
+
+async def main_async(args):
+    env_overrides = dict(item.split('=', 1) for item in args.env)
+    report = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {name: value for name, value in vars(args).items() if name != 'output'},
+        'results': [],
+    }
+    for target in args.target:
+        # A fresh fake upstream per target replays the same seeded failures
+        upstream = start_upstream(args)
+        proc = start_proxy(target, args.port, args.upstream_port, env_overrides)
+        try:
+            await wait_ready(args.port)
+            print(f"\n== {target} ==")
+            print(f"{'conc':>5} {'ok':>6} {'err':>5} {'fail':>5} {'streams/s':>10} {'KB/s':>9} "
+                  f"{'ttfb p50':>9} {'ttfb p95':>9} {'gap p50':>8} {'gap p99':>8} {'cpu ms':>7} {'rss MB':>7}")
+            for concurrency in args.concurrency:
+                r = await run_level(proc.pid, args.port, concurrency, args.requests or concurrency * 5, args.timeout)
+                r['target'] = target
+                report['results'].append(r)
+                print(f"{concurrency:>5} {r['ok']:>6} {r['upstream_errors']:>5} {r['failed']:>5} "
+                      f"{r['streams_per_s']:>10} {r['kb_per_s']:>9} {r['ttfb_ms']['p50']:>9} "
+                      f"{r['ttfb_ms']['p95']:>9} {r['inter_chunk_ms']['p50']:>8} "
+                      f"{r['inter_chunk_ms']['p99']:>8} {r['proxy_cpu_ms_per_stream']:>7} "
+                      f"{r['proxy_peak_rss_mb']:>7}")
+        finally:
+            proc.terminate()
+            proc.wait()
+            upstream.terminate()
+            upstream.wait()
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', nargs='+', choices=sorted(TARGETS), default=['server', 'vercel'])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--requests', type=int, default=None, help='streams per level (default 5 x concurrency)')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--port', type=int, default=5056)
+    parser.add_argument('--upstream-port', type=int, default=8956)
+    parser.add_argument('--env', nargs='*', default=[], metavar='NAME=VALUE',
+                        help='extra environment for the proxy, e.g. CHAT_STREAM_MODE=reparse')
+    parser.add_argument('--output', default='bench_results.json')
+    upstream = parser.add_argument_group('fake upstream')
+    upstream.add_argument('--tokens', type=int, default=40)
+    upstream.add_argument('--interval', type=float, default=0.02)
+    upstream.add_argument('--jitter', type=float, default=None)
+    upstream.add_argument('--latency', type=float, default=None)
+    upstream.add_argument('--token-bytes', type=int, default=None)
+    upstream.add_argument('--error-rate', type=float, default=None)
+    upstream.add_argument('--error-status', type=int, default=None)
+    upstream.add_argument('--disconnect-rate', type=float, default=None)
+    upstream.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Size report for the template design digests (proxy/templates.py).
+
+For every public/Template*.html it prints bytes and estimated tokens of
+the template and of its digest, what the compaction removed, and the
+time it took. It also checks each digest: compacting it again must not
+change it, and without row and item caps its visible text must be the
+template's text with whitespace collapsed. No network is needed.
+
+Usage:
+    python bench_templates.py [--max-rows 5] [--max-items 8] [--turns 10]
+
+--turns also shows the input tokens the template costs over a session of
+that many turns, since every turn re-sends it.
+"""
+import argparse
+import glob
+import os
+import re
+import sys
+import time
+
+from proxy import preview, templates
+from proxy.context import estimate_text_tokens
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def visible_text(html):
+    out = []
+
+    def walk(node):
+        for child in node.children:
+            if child.tag == '#text':
+                out.append(child.text)
+            elif isinstance(child, preview.Element) and child.tag not in ('script', 'style'):
+                # Block boundaries separate words whether or not there was whitespace
+                block = child.tag not in templates.INLINE_ELEMENTS
+                out.append(' ' if block else '')
+                walk(child)
+                out.append(' ' if block else '')
+
+    walk(preview.parse(html).body)
+    return re.sub(r'\s+', ' ', ''.join(out)).strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-rows', type=int, default=templates.TEMPLATE_CONFIG["max_rows"])
+    parser.add_argument('--max-items', type=int, default=templates.TEMPLATE_CONFIG["max_items"])
+    parser.add_argument('--turns', type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{'template':<24} {'bytes':>8} {'digest':>8} {'tokens':>7} {'digest':>7} {'saved':>6} "
+          f"{'styles':>6} {'rows':>5} {'items':>5} {'ms':>6}")
+    failures = 0
+    totals = [0, 0]
+    for path in sorted(glob.glob(os.path.join(ROOT, 'public', 'Template*.html'))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        with open(path, encoding='utf-8') as f:
+            html = f.read()
+        started = time.perf_counter()
+        digest, report = templates.compact_html(html, args.max_rows, args.max_items)
+        elapsed = time.perf_counter() - started
+        before, after = estimate_text_tokens(html), estimate_text_tokens(digest)
+        totals[0] += before
+        totals[1] += after
+        problems = []
+        if templates.compact_html(digest, args.max_rows, args.max_items)[0] != digest:
+            problems.append('not idempotent')
+        if visible_text(templates.compact_html(html, 0, 0)[0]) != visible_text(html):
+            problems.append('text changed')
+        failures += bool(problems)
+        print(f"{name:<24} {len(html.encode('utf-8')):>8} {len(digest.encode('utf-8')):>8} {before:>7} {after:>7} "
+              f"{(1 - after / before) * 100:>5.1f}% {report['styles_deduped']:>6} {report['rows_dropped']:>5} "
+              f"{report['items_dropped']:>5} {elapsed * 1000:>6.1f}  {', '.join(problems)}")
+    print(f"\nOver a {args.turns}-turn session with one template: up to {totals[0] * args.turns} input tokens "
+          f"for the templates as they are, {totals[1] * args.turns} for their digests")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
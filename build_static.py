@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+Build precompressed, fingerprinted static assets into dist/.
+
+Every file in public/ is written with .gz (and .br when the `brotli`
+package is installed) siblings; style.css and script.js also get a
+content-hash name that index.html is rewritten to reference. The servers
+pick dist/manifest.json up when started with STATIC_MODE=precompressed.
+
+Usage:
+    python build_static.py [--public public] [--dist dist]
+"""
+import argparse
+import shutil
+
+from proxy.static_assets import build_assets, write_dist
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--public', default='public')
+    parser.add_argument('--dist', default='dist')
+    args = parser.parse_args()
+
+    assets, fingerprints = build_assets(args.public)
+    shutil.rmtree(args.dist, ignore_errors=True)
+    manifest = write_dist(assets, fingerprints, args.dist)
+
+    print(f"{'asset':<42} {'identity':>10} {'gzip':>10} {'br':>10}")
+    for name, meta in sorted(manifest['assets'].items()):
+        sizes = meta['encodings']
+        print(f"{name:<42} {sizes['identity']:>10} {sizes.get('gzip', '-'):>10} {sizes.get('br', '-'):>10}")
+    for name, hashed in sorted(fingerprints.items()):
+        print(f"{name} -> {hashed}")
+    print(f"Wrote {len(manifest['assets'])} assets to {args.dist}/")
+
+
+if __name__ == '__main__':
+    main()
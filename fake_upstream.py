@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for CLAUDE_BASE_URL/chat/completions.
+
+Answers every POST to .../chat/completions with an OpenAI-compatible SSE
+stream of `tokens` deltas, one every `interval` seconds, followed by
+`data: [DONE]`. Runs on asyncio so it can serve thousands of concurrent
+streams for load tests.
+
+Failure modes can be injected for benchmarks: a fixed `latency` before the
+response starts, `jitter` on the token interval, `token_bytes` of HTML-like
+content per delta, a fraction of requests answered with `error_status`
+(`error_rate`), and a fraction of streams cut off halfway without a
+terminating chunk (`disconnect_rate`). Pass `seed` for a reproducible
+sequence. GET /stats returns what has been served so far.
+
+Usage:
+    python fake_upstream.py --port 8900 --tokens 50 --interval 0.05
+    python fake_upstream.py --latency 0.8 --error-rate 0.05 --disconnect-rate 0.02 --seed 1
+    CLAUDE_BASE_URL=http://localhost:8900/v1 python server.py
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+DEFAULTS = {
+    "tokens": 50,
+    "interval": 0.05,
+    "jitter": 0.0,
+    "latency": 0.0,
+    "token_bytes": 8,
+    "error_rate": 0.0,
+    "error_status": 500,
+    "disconnect_rate": 0.0,
+    "seed": None,
+}
+
+# Delta text is cut from this so larger payloads still look like the HTML
+# the model usually streams
+FILLER = '<div class="slide-content"><h2>Quarterly overview</h2><p>Revenue grew steadily across regions.</p></div>\n'
+
+
+def delta_content(index, size):
+    prefix = f'token{index} '
+    if size <= len(prefix):
+        return prefix
+    repeated = FILLER * (size // len(FILLER) + 1)
+    return prefix + repeated[:size - len(prefix)]
+
+
+def chunk_frame(index, content, model):
+    chunk = {
+        'id': 'chatcmpl-fake',
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'delta': {'content': content}, 'finish_reason': None}]
+    }
+    return f"data: {json.dumps(chunk)}\n\n".encode('utf-8')
+
+
+async def write_chunk(writer, data):
+    writer.write(b'%x\r\n' % len(data) + data + b'\r\n')
+    await writer.drain()
+
+
+async def send_error(writer, status):
+    body = json.dumps({'error': {'message': 'Injected upstream error', 'type': 'fake_upstream_error'}}).encode('utf-8')
+    writer.write(
+        b'HTTP/1.1 %d Injected Error\r\n'
+        b'Content-Type: application/json\r\n'
+        b'Content-Length: %d\r\n\r\n' % (status, len(body)) + body
+    )
+    await writer.drain()
+
+
+async def stream_completion(writer, options, model, rng, stats):
+    """Stream one completion; returns False if the connection was cut on purpose."""
+    if options["latency"]:
+        await asyncio.sleep(options["latency"])
+    if rng.random() < options["error_rate"]:
+        stats['errors'] += 1
+        await send_error(writer, options["error_status"])
+        return True
+    disconnect_at = options["tokens"] // 2 if rng.random() < options["disconnect_rate"] else None
+
+    writer.write(
+        b'HTTP/1.1 200 OK\r\n'
+        b'Content-Type: text/event-stream\r\n'
+        b'Cache-Control: no-cache\r\n'
+        b'Transfer-Encoding: chunked\r\n\r\n'
+    )
+    for i in range(options["tokens"]):
+        if i == disconnect_at:
+            stats['disconnects'] += 1
+            writer.transport.abort()
+            return False
+        if options["interval"]:
+            jitter = rng.uniform(-options["jitter"], options["jitter"]) if options["jitter"] else 0.0
+            await asyncio.sleep(max(options["interval"] + jitter, 0))
+        await write_chunk(writer, chunk_frame(i, delta_content(i, options["token_bytes"]), model))
+    await write_chunk(writer, b'data: [DONE]\n\n')
+    writer.write(b'0\r\n\r\n')
+    await writer.drain()
+    stats['completed'] += 1
+    return True
+
+
+async def read_request(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    method, path, _ = lines[0].split(' ', 2)
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', '0')))
+    return method, path, headers, body
+
+
+def make_handler(options):
+    rng = random.Random(options["seed"])
+    stats = {'requests': 0, 'completed': 0, 'errors': 0, 'disconnects': 0}
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                method, path, headers, body = await read_request(reader)
+                if method == 'POST' and path.endswith('/chat/completions'):
+                    stats['requests'] += 1
+                    model = 'fake-model'
+                    try:
+                        model = json.loads(body).get('model', model)
+                    except ValueError:
+                        pass
+                    if not await stream_completion(writer, options, model, rng, stats):
+                        break
+                elif method == 'GET' and path == '/stats':
+                    body = json.dumps(stats).encode('utf-8')
+                    writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                                 b'Content-Length: %d\r\n\r\n' % len(body) + body)
+                    await writer.drain()
+                else:
+                    writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')
+                    await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def start(host='127.0.0.1', port=8900, **options):
+    """Start the fake upstream on the running loop and return the server."""
+    merged = dict(DEFAULTS)
+    merged.update(options)
+    return await asyncio.start_server(make_handler(merged), host, port, backlog=4096)
+
+
+async def serve(host, port, **options):
+    server = await start(host, port, **options)
+    print(f"Fake upstream listening on http://{host}:{port}/v1")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--tokens', type=int, default=DEFAULTS["tokens"])
+    parser.add_argument('--interval', type=float, default=DEFAULTS["interval"])
+    parser.add_argument('--jitter', type=float, default=DEFAULTS["jitter"])
+    parser.add_argument('--latency', type=float, default=DEFAULTS["latency"])
+    parser.add_argument('--token-bytes', type=int, default=DEFAULTS["token_bytes"])
+    parser.add_argument('--error-rate', type=float, default=DEFAULTS["error_rate"])
+    parser.add_argument('--error-status', type=int, default=DEFAULTS["error_status"])
+    parser.add_argument('--disconnect-rate', type=float, default=DEFAULTS["disconnect_rate"])
+    parser.add_argument('--seed', type=int, default=DEFAULTS["seed"])
+    args = parser.parse_args()
+    options = {name: getattr(args, name) for name in DEFAULTS}
+    try:
+        asyncio.run(serve(args.host, args.port, **options))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
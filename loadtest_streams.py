@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Concurrent-stream load test: threaded Flask (server.py) vs async (asgi.py).
+
+Starts fake_upstream.py and the proxy (pointed at the fake) in
+subprocesses, then holds N /api/chat streams open at once and reports how
+many finished, time to first byte, and the proxy's resident memory and
+thread count at peak. RSS is read from /proc, so this needs Linux.
+
+Usage:
+    python loadtest_streams.py --target both --streams 100 500 1000
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+TARGETS = {
+    'flask': [sys.executable, '-c',
+              "import sys, server; server.app.run(host='127.0.0.1', port=int(sys.argv[1]), threaded=True)"],
+    'asgi': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1',
+             '--log-level', 'warning', '--port'],
+}
+
+
+def proc_status(pid):
+    """Return (rss_kb, threads) for pid from /proc."""
+    rss = threads = 0
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1])
+            elif line.startswith('Threads:'):
+                threads = int(line.split()[1])
+    return rss, threads
+
+
+def start_proxy(target, port, upstream_port):
+    env = dict(os.environ)
+    env['CLAUDE_BASE_URL'] = f'http://127.0.0.1:{upstream_port}/v1'
+    env['CLAUDE_API_KEY'] = 'loadtest'
+    cmd = TARGETS[target] + [str(port)]
+    return subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def wait_ready(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(f'http://127.0.0.1:{port}/api/test')
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f'proxy on port {port} did not start')
+
+
+async def one_stream(client, url, results):
+    start = time.perf_counter()
+    try:
+        async with client.stream('POST', url, json={'messages': [{'role': 'user', 'content': 'hi'}]}) as response:
+            first = None
+            body = b''
+            async for chunk in response.aiter_bytes():
+                if first is None:
+                    first = time.perf_counter() - start
+                body += chunk
+            if response.status_code == 200 and b'"done": true' in body:
+                results['ok'] += 1
+                results['ttfb'].append(first)
+            else:
+                results['failed'] += 1
+    except httpx.HTTPError:
+        results['failed'] += 1
+
+
+async def sample_peak(pid, stop, peak):
+    while not stop.is_set():
+        try:
+            rss, threads = proc_status(pid)
+        except OSError:
+            return
+        peak['rss'] = max(peak['rss'], rss)
+        peak['threads'] = max(peak['threads'], threads)
+        await asyncio.sleep(0.05)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def run_level(pid, port, streams, timeout):
+    idle_rss, _ = proc_status(pid)
+    results = {'ok': 0, 'failed': 0, 'ttfb': []}
+    peak = {'rss': idle_rss, 'threads': 0}
+    stop = asyncio.Event()
+    sampler = asyncio.ensure_future(sample_peak(pid, stop, peak))
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=0)
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        url = f'http://127.0.0.1:{port}/api/chat'
+        start = time.perf_counter()
+        await asyncio.gather(*(one_stream(client, url, results) for _ in range(streams)))
+        elapsed = time.perf_counter() - start
+
+    stop.set()
+    await sampler
+    return {
+        'streams': streams,
+        'ok': results['ok'],
+        'failed': results['failed'],
+        'elapsed_s': round(elapsed, 2),
+        'ttfb_p50_ms': round(percentile(results['ttfb'], 50) * 1000, 1),
+        'ttfb_p95_ms': round(percentile(results['ttfb'], 95) * 1000, 1),
+        'peak_rss_mb': round(peak['rss'] / 1024, 1),
+        'kb_per_stream': round((peak['rss'] - idle_rss) / max(streams, 1), 1),
+        'peak_threads': peak['threads'],
+    }
+
+
+def start_upstream(args):
+    # Separate process so the fake upstream doesn't compete with the load generator's loop
+    cmd = [sys.executable, 'fake_upstream.py', '--port', str(args.upstream_port),
+           '--tokens', str(args.tokens), '--interval', str(args.interval)]
+    return subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.DEVNULL)
+
+
+async def main_async(args):
+    upstream = start_upstream(args)
+    targets = ['flask', 'asgi'] if args.target == 'both' else [args.target]
+    try:
+        for target in targets:
+            proc = start_proxy(target, args.port, args.upstream_port)
+            try:
+                await wait_ready(args.port)
+                print(f"\n== {target} ({args.tokens} tokens every {args.interval}s per stream) ==")
+                print(f"{'streams':>8} {'ok':>6} {'failed':>7} {'elapsed s':>10} {'ttfb p50':>9} "
+                      f"{'ttfb p95':>9} {'peak MB':>8} {'KB/stream':>10} {'threads':>8}")
+                for streams in args.streams:
+                    r = await run_level(proc.pid, args.port, streams, args.timeout)
+                    print(f"{r['streams']:>8} {r['ok']:>6} {r['failed']:>7} {r['elapsed_s']:>10} "
+                          f"{r['ttfb_p50_ms']:>9} {r['ttfb_p95_ms']:>9} {r['peak_rss_mb']:>8} "
+                          f"{r['kb_per_stream']:>10} {r['peak_threads']:>8}")
+            finally:
+                proc.terminate()
+                proc.wait()
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', choices=['flask', 'asgi', 'both'], default='both')
+    parser.add_argument('--streams', type=int, nargs='+', default=[50, 200, 500])
+    parser.add_argument('--tokens', type=int, default=40)
+    parser.add_argument('--interval', type=float, default=0.1)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--upstream-port', type=int, default=8955)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,6 @@
+"""
+Shared building blocks for the FakeClippy chat proxy.
+
+Used by both the local development server (server.py) and the Vercel
+function (api/index.py).
+"""
@@ -0,0 +1,364 @@
+"""
+Admission control for /api/chat.
+
+Each chat stream holds a worker thread (or coroutine) and an upstream
+connection, so the proxy limits how many it accepts:
+
+- a global cap on concurrent streams (ADMISSION_MAX_STREAMS);
+- optional per-client limits: a token bucket refilled at
+  ADMISSION_CLIENT_RATE requests per second up to ADMISSION_CLIENT_BURST,
+  and at most ADMISSION_CLIENT_MAX_STREAMS streams open at once. A client
+  is its IP address, taken from X-Forwarded-For when ADMISSION_TRUST_PROXY
+  is set (the default on Vercel). Both are off (0) by default: everyone
+  behind one NAT, office proxy or VPN exit shares an address, and a
+  deck's worth of slides is enough to trip a tight limit;
+- a bounded wait queue. When every slot is taken, up to
+  ADMISSION_QUEUE_SIZE requests wait at most ADMISSION_QUEUE_TIMEOUT
+  seconds for one to free up.
+
+Requests over a client limit get 429 and requests that find the queue
+full (or time out in it) get 503, both with Retry-After, so they are
+turned away before any upstream work is done. Queue depth, waits and
+rejections are exported on /api/metrics.
+
+Batch jobs (proxy/batch.py) take a ticket per slide request, without
+charging the client's bucket again, so their upstream streams count
+against the same caps as chats.
+
+On Vercel every function instance handles one request at a time, so only
+the per-client limits matter there, and they apply per warm instance.
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from proxy import metrics
+
+ADMISSION_CONFIG = {
+    "max_streams": int(os.getenv("ADMISSION_MAX_STREAMS", "64")),
+    "queue_size": int(os.getenv("ADMISSION_QUEUE_SIZE", "32")),
+    "queue_timeout": float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "5")),
+    "retry_after": int(os.getenv("ADMISSION_RETRY_AFTER", "2")),
+    # Per-client limits are opt-in: clients are told apart by IP address,
+    # which users behind a shared NAT or proxy have in common
+    "client_rate": float(os.getenv("ADMISSION_CLIENT_RATE", "0")),
+    "client_burst": float(os.getenv("ADMISSION_CLIENT_BURST", "5")),
+    "client_max_streams": int(os.getenv("ADMISSION_CLIENT_MAX_STREAMS", "0")),
+    "trust_proxy": os.getenv("ADMISSION_TRUST_PROXY", "true" if os.getenv("VERCEL") else "false").lower() == "true",
+}
+
+# Token buckets and stream counts are kept for at most this many clients
+MAX_TRACKED_CLIENTS = 10000
+
+QUEUE_DEPTH = metrics.Gauge('fakeclippy_admission_queue_depth', 'Chat requests waiting for a stream slot')
+ADMITTED = metrics.Counter('fakeclippy_admission_admitted_total', 'Chat requests admitted')
+REJECTED = metrics.Counter('fakeclippy_admission_rejected_total', 'Chat requests turned away, by reason',
+                           ('reason',))
+WAIT_SECONDS = metrics.Histogram('fakeclippy_admission_wait_seconds', 'Time admitted requests spent queued')
+
+
+class Rejected(Exception):
+    def __init__(self, status, reason, retry_after):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+    def body(self):
+        messages = {
+            'rate_limited': 'Too many requests, please slow down',
+            'client_streams': 'Too many open chats from this client',
+            'queue_full': 'Server is busy, please retry shortly',
+            'queue_timeout': 'Server is busy, please retry shortly',
+        }
+        return {'error': messages.get(self.reason, self.reason), 'code': self.reason}
+
+    def headers(self):
+        return {'Retry-After': str(self.retry_after)}
+
+
+def client_key(remote_addr, forwarded_for=None):
+    if ADMISSION_CONFIG["trust_proxy"] and forwarded_for:
+        return forwarded_for.split(',')[0].strip()
+    return remote_addr or 'unknown'
+
+
+class _Client:
+    __slots__ = ('tokens', 'updated', 'streams')
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated = now
+        self.streams = 0
+
+
+class _Limits:
+    """Shared bookkeeping; the subclasses only differ in how they wait."""
+
+    def __init__(self, config):
+        self.config = config
+        self.active = 0
+        self.waiting = 0
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _client(self, key, now):
+        client = self._clients.get(key)
+        if client is None:
+            client = self._clients[key] = _Client(self.config["client_burst"], now)
+            while len(self._clients) > MAX_TRACKED_CLIENTS:
+                oldest, entry = next(iter(self._clients.items()))
+                if entry.streams:
+                    break
+                del self._clients[oldest]
+        else:
+            self._clients.move_to_end(key)
+        return client
+
+    def _check_client(self, key, charge=True):
+        """The client's entry if it may start a stream (lock held); raises Rejected for 429s."""
+        now = time.monotonic()
+        client = self._client(key, now)
+        rate = self.config["client_rate"] if charge else 0
+        if rate > 0:
+            client.tokens = min(self.config["client_burst"], client.tokens + (now - client.updated) * rate)
+            client.updated = now
+            if client.tokens < 1:
+                raise Rejected(429, 'rate_limited', (1 - client.tokens) / rate)
+        if 0 < self.config["client_max_streams"] <= client.streams:
+            raise Rejected(429, 'client_streams', self.config["retry_after"])
+        return client
+
+    def _grant(self, client, charge=True):
+        """
+        Count a granted stream against the client (lock held).
+
+        The bucket is only charged here, so a request turned away by the
+        queue does not cost the client a token on top of the 503.
+        """
+        client.streams += 1
+        if charge and self.config["client_rate"] > 0:
+            client.tokens -= 1
+
+    def _reject(self, error):
+        REJECTED.inc(labels=(error.reason,))
+        raise error
+
+    def _saturated(self):
+        return 0 < self.config["max_streams"] <= self.active
+
+    def stats(self):
+        with self._lock:
+            return {'active': self.active, 'waiting': self.waiting, 'clients': len(self._clients)}
+
+
+class Ticket:
+    """An admitted stream; release() gives the slot back (idempotent)."""
+
+    def __init__(self, limits, client):
+        self.limits = limits
+        self.client = client
+        self.released = False
+
+    def release(self):
+        # Reached from the response's close and from a resumable stream's
+        # reader, possibly at once
+        with self.limits._lock:
+            if self.released:
+                return
+            self.released = True
+        self.limits._release(self.client)
+
+    def transfer(self):
+        """Hand the slot to a new Ticket; releasing this one becomes a no-op."""
+        ticket = Ticket(self.limits, self.client)
+        with self.limits._lock:
+            ticket.released = self.released
+            self.released = True
+        return ticket
+
+
+class _LoopTicket:
+    """A Ticket of the async controller held by a worker thread."""
+
+    def __init__(self, ticket, loop):
+        self.ticket = ticket
+        self.loop = loop
+
+    def release(self):
+        try:
+            self.loop.call_soon_threadsafe(self.ticket.release)
+        except RuntimeError:
+            pass  # the loop is closed: the server is shutting down
+
+
+class AdmissionController(_Limits):
+    """Thread-based controller for the Flask apps."""
+
+    def __init__(self, config):
+        super().__init__(config)
+        self._slot_freed = threading.Condition(self._lock)
+
+    def admit(self, key, charge=True):
+        """
+        Wait for a stream slot and return its Ticket; raises Rejected.
+
+        charge=False skips the client's token bucket, for the upstream
+        streams of a request that was already admitted (batch slides).
+        """
+        started = time.monotonic()
+        with self._lock:
+            try:
+                client = self._check_client(key, charge)
+            except Rejected as e:
+                self._reject(e)
+            if self._saturated():
+                if self.waiting >= self.config["queue_size"]:
+                    self._reject(Rejected(503, 'queue_full', self.config["retry_after"]))
+                self.waiting += 1
+                QUEUE_DEPTH.inc()
+                try:
+                    deadline = started + self.config["queue_timeout"]
+                    while self._saturated():
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._reject(Rejected(503, 'queue_timeout', self.config["retry_after"]))
+                        self._slot_freed.wait(remaining)
+                finally:
+                    self.waiting -= 1
+                    QUEUE_DEPTH.dec()
+            self.active += 1
+            self._grant(client, charge)
+        ADMITTED.inc()
+        WAIT_SECONDS.observe(time.monotonic() - started)
+        return Ticket(self, client)
+
+    def _release(self, client):
+        with self._lock:
+            self.active -= 1
+            client.streams -= 1
+            self._slot_freed.notify()
+
+
+class AsyncAdmissionController(_Limits):
+    """Coroutine-based controller for asgi.py; waiters are served in FIFO order."""
+
+    def __init__(self, config):
+        super().__init__(config)
+        self._waiters = deque()
+
+    async def admit(self, key, charge=True):
+        # Imported here so the WSGI entry points do not load asyncio at startup
+        import asyncio
+
+        started = time.monotonic()
+        with self._lock:
+            try:
+                client = self._check_client(key, charge)
+            except Rejected as e:
+                self._reject(e)
+            if self._saturated() and self.waiting >= self.config["queue_size"]:
+                self._reject(Rejected(503, 'queue_full', self.config["retry_after"]))
+            queued = self._saturated()
+            if not queued:
+                self.active += 1
+                self._grant(client, charge)
+
+        if queued:
+            slot = asyncio.get_running_loop().create_future()
+            self._waiters.append(slot)
+            self.waiting += 1
+            QUEUE_DEPTH.inc()
+            try:
+                await asyncio.wait_for(asyncio.shield(slot), self.config["queue_timeout"])
+            except asyncio.TimeoutError:
+                if not slot.done() or not slot.result():
+                    slot.cancel()
+                    self._reject(Rejected(503, 'queue_timeout', self.config["retry_after"]))
+            except asyncio.CancelledError:
+                # A slot handed over while we were being cancelled goes to the next waiter
+                if slot.done() and not slot.cancelled():
+                    self._hand_over()
+                else:
+                    slot.cancel()
+                raise
+            finally:
+                self.waiting -= 1
+                QUEUE_DEPTH.dec()
+            # The releasing stream passed its slot on, so active is unchanged
+            with self._lock:
+                self._grant(client, charge)
+
+        ADMITTED.inc()
+        WAIT_SECONDS.observe(time.monotonic() - started)
+        return Ticket(self, client)
+
+    def admit_threadsafe(self, key, loop, charge=True):
+        """
+        admit() for a worker thread (batch slides) while loop runs.
+
+        Blocks the calling thread; the returned ticket can be released
+        from any thread and hands its slot over on the loop.
+        """
+        import asyncio
+
+        ticket = asyncio.run_coroutine_threadsafe(self.admit(key, charge), loop).result()
+        return _LoopTicket(ticket, loop)
+
+    def _hand_over(self):
+        """Give a freed slot to the first live waiter, or return it to the pool."""
+        while self._waiters:
+            slot = self._waiters.popleft()
+            if not slot.done():
+                slot.set_result(True)
+                return
+        self.active -= 1
+
+    def _release(self, client):
+        client.streams -= 1
+        self._hand_over()
+
+
+class AdmittedStream:
+    """
+    Response body that releases its ticket when the stream ends.
+
+    A plain generator's finally block does not run if the server closes it
+    before the first frame; WSGI servers always call close() on the body.
+    """
+
+    def __init__(self, frames, ticket):
+        self.frames = frames
+        self.ticket = ticket
+
+    def __iter__(self):
+        try:
+            yield from self.frames
+        finally:
+            self.close()
+
+    def close(self):
+        self.ticket.release()
+        close = getattr(self.frames, 'close', None)
+        if close is not None:
+            close()
+
+
+_controller = None
+_async_controller = None
+
+
+def get_controller():
+    global _controller
+    if _controller is None:
+        _controller = AdmissionController(ADMISSION_CONFIG)
+    return _controller
+
+
+def get_async_controller():
+    global _async_controller
+    if _async_controller is None:
+        _async_controller = AsyncAdmissionController(ADMISSION_CONFIG)
+    return _async_controller
@@ -0,0 +1,298 @@
+"""
+Async counterpart of proxy/upstream.py and proxy/chat.py for asgi.py.
+
+One httpx.AsyncClient per base URL keeps keep-alive connections pooled
+across streams, and a streaming chat request only holds a coroutine instead
+of an OS thread, so one worker can relay many long-lived SSE streams.
+"""
+import asyncio
+import time
+
+import httpx
+
+from proxy import metrics, requestlog, routing
+from proxy.blobs import encode_payload
+from proxy.sse import arelay, error_event
+from proxy.upstream import UPSTREAM_CONFIG
+
+_clients = {}
+_counters = {}
+
+
+def get_client(base_url):
+    """Return the shared async client for base_url, creating it on first use."""
+    client = _clients.get(base_url)
+    if client is None:
+        limits = httpx.Limits(
+            # Without pool_block the pool only bounds idle keep-alive
+            # connections, matching the requests adapter in proxy/upstream.py
+            max_connections=UPSTREAM_CONFIG["pool_size"] if UPSTREAM_CONFIG["pool_block"] else None,
+            max_keepalive_connections=UPSTREAM_CONFIG["pool_size"],
+        )
+        timeout = httpx.Timeout(
+            UPSTREAM_CONFIG["read_timeout"],
+            connect=UPSTREAM_CONFIG["connect_timeout"],
+            pool=None,
+        )
+        client = httpx.AsyncClient(limits=limits, timeout=timeout)
+        _clients[base_url] = client
+        _counters[base_url] = {'requests': 0, 'misses': 0}
+    return client
+
+
+def _tracer(base_url):
+    counters = _counters[base_url]
+
+    async def trace(event_name, info):
+        # httpcore only connects when no idle pooled connection was available
+        if event_name == 'connection.connect_tcp.complete':
+            counters['misses'] += 1
+
+    return trace
+
+
+async def open_chat(base_url, api_key, payload):
+    """Open a streaming POST to {base_url}/chat/completions on a pooled connection."""
+    client = get_client(base_url)
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {api_key}'
+    }
+    body = encode_payload(payload)
+    if not isinstance(body, bytes):
+        # httpx would pick the sync iterator and send it chunked
+        headers['Content-Length'] = str(len(body))
+        body = body.__aiter__()
+    request = client.build_request(
+        'POST',
+        f'{base_url}/chat/completions',
+        headers=headers,
+        content=body,
+        extensions={'trace': _tracer(base_url)},
+    )
+    _counters[base_url]['requests'] += 1
+    return await client.send(request, stream=True)
+
+
+async def warm(base_url):
+    client = get_client(base_url)
+    try:
+        response = await client.head(base_url, extensions={'trace': _tracer(base_url)})
+        _counters[base_url]['requests'] += 1
+        await response.aclose()
+    except httpx.HTTPError as e:
+        print(f"Warning: Could not pre-warm upstream connection to {base_url}: {e}")
+        requestlog.event('upstream_warm_failed', upstream=base_url, error=str(e))
+
+
+async def close_all():
+    for client in list(_clients.values()):
+        await client.aclose()
+    _clients.clear()
+
+
+def pool_stats():
+    stats = {}
+    for base_url, counters in _counters.items():
+        stats[base_url] = {
+            'requests': counters['requests'],
+            'hits': max(0, counters['requests'] - counters['misses']),
+            'misses': counters['misses'],
+            'pool_size': UPSTREAM_CONFIG["pool_size"],
+        }
+    return stats
+
+
+class _AsyncAttempt:
+    """Async counterpart of chat._Attempt."""
+
+    def __init__(self, target, payload, mode, trace=None):
+        self.target = target
+        self.payload = target.payload_for(payload)
+        self.mode = mode
+        self.trace = trace
+        self.response = None
+        self.frames = None
+        self.first = None
+        self.error = None
+        self.message = None
+        self.final = False
+        self.refused = False
+        self.probe = False
+        self.started = None
+
+    async def open(self):
+        admitted = self.target.breaker.acquire_probe()
+        if admitted is None:
+            self.refused = True
+            self.fail('Upstream temporarily unavailable')
+            return
+        self.probe = admitted == 'probe'
+        self.target.counters['requests'] += 1
+        self.started = started = time.perf_counter()
+        connect = ttft = None
+        try:
+            try:
+                self.response = await open_chat(self.target.base_url, self.target.api_key, self.payload)
+            except httpx.HTTPError:
+                metrics.UPSTREAM_RESPONSES.inc(labels=('error',))
+                raise
+            connect = time.perf_counter() - started
+            metrics.observe_stage('upstream_connect', connect)
+            metrics.UPSTREAM_RESPONSES.inc(labels=(str(self.response.status_code),))
+
+            if self.response.status_code != 200:
+                self.final = not routing.retryable_status(self.response.status_code)
+                self.fail(f'API request failed with status {self.response.status_code}')
+            else:
+                self.frames = arelay(self.response, self.mode).__aiter__()
+                try:
+                    self.first = await self.frames.__anext__()
+                except StopAsyncIteration:
+                    self.first = None
+                ttft = time.perf_counter() - started
+                metrics.observe_stage('upstream_first_byte', ttft)
+                self.target.record_first_byte(ttft)
+        except asyncio.CancelledError:
+            if self.probe:
+                self.target.breaker.release_probe()
+            await self.close()
+            raise
+        except httpx.TimeoutException:
+            self.fail('Request timed out')
+        except httpx.HTTPError as e:
+            self.fail(f'Request failed: {str(e)}')
+        except Exception as e:
+            self.final = True
+            self.fail(f'Server error: {str(e)}')
+        if self.trace is not None:
+            self.trace.upstream(self.target, self.response.status_code if self.response is not None else None,
+                                connect, ttft, self.message)
+        if self.error is not None:
+            if not self.final:
+                self.target.record_failure()
+            elif self.probe:
+                self.target.breaker.release_probe()
+            await self.close()
+
+    def fail(self, message):
+        self.message = message
+        self.error = error_event(message).encode('utf-8')
+
+    async def close(self):
+        if self.response is not None:
+            await self.response.aclose()
+
+
+async def _open_sequential(candidates, payload, mode, trace):
+    failure = None
+    for target in candidates:
+        attempt = _AsyncAttempt(target, payload, mode, trace)
+        await attempt.open()
+        if attempt.error is None:
+            return attempt, None
+        failure = attempt
+        if attempt.final:
+            break
+    return None, failure
+
+
+async def _open_hedged(router, candidates, payload, mode, trace):
+    """Race the primary against one hedge once it is slower than its usual first byte."""
+    pending = list(candidates)
+    tasks = {}
+    attempts = []
+
+    def launch():
+        attempt = _AsyncAttempt(pending.pop(0), payload, mode, trace)
+        attempts.append(attempt)
+        tasks[asyncio.ensure_future(attempt.open())] = attempt
+
+    launch()
+    hedge_after = router.hedge_delay(candidates[0])
+    winner = None
+    failure = None
+    try:
+        while tasks and winner is None and (failure is None or not failure.final):
+            finished, _running = await asyncio.wait(
+                tasks, timeout=hedge_after if pending and hedge_after else None,
+                return_when=asyncio.FIRST_COMPLETED)
+            if not finished:
+                candidates[0].counters['hedges'] += 1
+                hedge_after = None
+                launch()
+                continue
+            for task in finished:
+                attempt = tasks.pop(task)
+                if attempt.error is None and winner is None:
+                    winner = attempt
+                elif attempt.error is None:
+                    await attempt.close()
+                else:
+                    failure = attempt
+                    if pending and not attempt.final:
+                        # Fail over straight away instead of waiting for the hedge deadline
+                        launch()
+    finally:
+        # Cancelling a request that is still connecting closes its connection
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for attempt in tasks.values():
+            if attempt.started is not None:
+                # It was at least this slow; without the sample routing would
+                # never learn about an upstream that always loses the race
+                attempt.target.observe_ttft(time.perf_counter() - attempt.started)
+            await attempt.close()
+
+    if winner is not None and winner is not attempts[0]:
+        winner.target.counters['hedge_wins'] += 1
+    return winner, failure
+
+
+async def astream_chat(api_config, payload, mode=None, trace=None):
+    """Call the upstream API and yield SSE frames (bytes) for the browser."""
+    def failed(message):
+        if trace is not None:
+            trace.fail(message)
+        return error_event(message).encode('utf-8')
+
+    router = routing.get_router(api_config)
+    candidates = router.candidates()
+    if not candidates:
+        yield failed('All upstream APIs are temporarily unavailable')
+        return
+
+    if router.hedging(candidates):
+        attempt, failure = await _open_hedged(router, candidates, payload, mode, trace)
+    else:
+        attempt, failure = await _open_sequential(candidates, payload, mode, trace)
+    if attempt is None:
+        yield failed(failure.message)
+        return
+
+    try:
+        if attempt.first is not None:
+            frame, _done = attempt.first
+            metrics.TOKENS.inc(metrics.count_deltas(frame))
+            yield frame
+
+        # The relays drain the body after [DONE], so closing afterwards keeps
+        # the connection pooled; closing mid-stream drops it
+        waiting = time.perf_counter()
+        async for frame, _done in attempt.frames:
+            metrics.observe_stage('relay_chunk', time.perf_counter() - waiting)
+            metrics.TOKENS.inc(metrics.count_deltas(frame))
+            yield frame
+            waiting = time.perf_counter()
+
+    except httpx.TimeoutException:
+        attempt.target.record_failure()
+        yield failed('Request timed out')
+    except httpx.HTTPError as e:
+        attempt.target.record_failure()
+        yield failed(f'Request failed: {str(e)}')
+    except Exception as e:
+        yield failed(f'Server error: {str(e)}')
+    finally:
+        await attempt.close()
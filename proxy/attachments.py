@@ -0,0 +1,368 @@
+"""
+Server-side preprocessing of chat attachments.
+
+The browser used to shrink images on a canvas and read documents into the
+prompt itself. POST /api/attachments instead takes the raw file and, in a
+bounded process pool:
+
+- downscales images to ATTACHMENT_IMAGE_MAX_SIDE and re-encodes them as
+  JPEG, lowering quality (and then size) until they fit
+  ATTACHMENT_IMAGE_BUDGET bytes. This needs Pillow (`pip install Pillow`);
+  without it, or for formats Pillow cannot read, the image is stored as
+  uploaded and the response says `processed: false`;
+- extracts the text of HTML files, dropping scripts, styles and comments
+  (ATTACHMENT_HTML=raw keeps the markup);
+- decodes other files as UTF-8 text and normalizes whitespace.
+
+The result goes into the blob store, and the response carries its
+`[[blob:...]]` marker, which /api/chat expands like any other blob.
+Results are cached by the SHA-256 of the upload, the kind it was classified
+as and the settings above, so the same file is only processed once. Each response reports the latency
+and sizes, and GET /api/attachments sums them up.
+
+With ATTACHMENT_WORKERS=0 (the default on Vercel, where functions cannot
+fork worker processes) files are processed on the request thread.
+"""
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from html.parser import HTMLParser
+
+from proxy import blobs, metrics
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # optional: images are then stored as uploaded
+    Image = None
+
+ATTACHMENT_CONFIG = {
+    "workers": int(os.getenv("ATTACHMENT_WORKERS", "0" if os.getenv("VERCEL") else str(min(4, os.cpu_count() or 1)))),
+    # Jobs waiting for a worker beyond the ones running; more get 503
+    "queue_size": int(os.getenv("ATTACHMENT_QUEUE_SIZE", "8")),
+    "timeout": float(os.getenv("ATTACHMENT_TIMEOUT", "30")),
+    "image_budget": int(os.getenv("ATTACHMENT_IMAGE_BUDGET", str(400 * 1024))),
+    "image_max_side": int(os.getenv("ATTACHMENT_IMAGE_MAX_SIDE", "1568")),
+    "html": os.getenv("ATTACHMENT_HTML", "text"),
+}
+
+JPEG_QUALITIES = (85, 75, 65, 55, 45)
+# Each further pass shrinks the image by this factor, down to MIN_SIDE pixels
+DOWNSCALE_STEP = 0.75
+MIN_SIDE = 256
+
+PREPARE_SECONDS = metrics.Histogram('fakeclippy_attachment_prepare_seconds',
+                                    'Time to preprocess an uncached attachment, by kind', ('kind',))
+BYTES_RECEIVED = metrics.Counter('fakeclippy_attachment_bytes_received_total', 'Raw attachment bytes uploaded')
+BYTES_PREPARED = metrics.Counter('fakeclippy_attachment_bytes_prepared_total',
+                                 'Bytes of preprocessed attachments handed to the chat proxy')
+
+
+class AttachmentsBusy(Exception):
+    pass
+
+
+# Worker side: plain functions of bytes, so they can run in another process
+
+def _fit(image, max_side):
+    if max(image.size) <= max_side:
+        return image
+    scale = max_side / max(image.size)
+    return image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
+
+
+def prepare_image(data, budget, max_side):
+    """Return (bytes, content_type, info); the input comes back unchanged if it cannot be improved."""
+    if Image is None:
+        return data, None, {'processed': False, 'reason': 'Pillow is not installed'}
+    try:
+        image = Image.open(io.BytesIO(data))
+        image = ImageOps.exif_transpose(image)
+        image.load()
+    except Exception as e:
+        return data, None, {'processed': False, 'reason': f'unreadable image: {e}'}
+
+    original_size = image.size
+    if image.mode in ('RGBA', 'LA', 'P'):
+        # JPEG has no alpha channel: flatten onto white, like the canvas did
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    side = min(max(image.size), max_side)
+    while True:
+        resized = _fit(image, side)
+        for quality in JPEG_QUALITIES:
+            out = io.BytesIO()
+            resized.save(out, 'JPEG', quality=quality, optimize=True, progressive=True)
+            if out.tell() <= budget:
+                break
+        if out.tell() <= budget or side <= MIN_SIDE:
+            break
+        side = max(MIN_SIDE, int(side * DOWNSCALE_STEP))
+
+    info = {
+        'processed': True,
+        'original_dimensions': list(original_size),
+        'dimensions': list(resized.size),
+        'quality': quality,
+    }
+    if out.tell() >= len(data) and original_size == resized.size:
+        # Already small enough; keep the original encoding
+        return data, None, info
+    return out.getvalue(), 'image/jpeg', info
+
+
+class _TextExtractor(HTMLParser):
+    SKIP = {'script', 'style', 'noscript', 'template', 'svg'}
+    BLOCKS = {'p', 'div', 'section', 'article', 'header', 'footer', 'nav', 'aside', 'main', 'li', 'ul', 'ol',
+              'table', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'br', 'hr', 'pre', 'blockquote', 'title', 'form'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skipping = 0
+        self.title = None
+        self._in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'title':
+            self._in_title = True
+        elif tag in self.SKIP:
+            self.skipping += 1
+        elif tag in self.BLOCKS:
+            self.parts.append('\n')
+        elif tag in ('td', 'th'):
+            self.parts.append('\t')
+        elif tag == 'img':
+            alt = dict(attrs).get('alt')
+            if alt:
+                self.parts.append(f'[image: {alt}]')
+
+    def handle_endtag(self, tag):
+        if tag == 'title':
+            self._in_title = False
+        elif tag in self.SKIP:
+            self.skipping = max(0, self.skipping - 1)
+        elif tag in self.BLOCKS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title = (self.title or '') + data
+        elif not self.skipping:
+            self.parts.append(data)
+
+
+def normalize_text(text):
+    text = unicodedata.normalize('NFC', text.replace('\r\n', '\n').replace('\r', '\n'))
+    text = re.sub(r'[ \t\f\v\u00a0]+', ' ', text)
+    text = re.sub(r' *\n *', '\n', text)
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    return text.strip()
+
+
+def decode_text(data):
+    if data.startswith(b'\xef\xbb\xbf'):
+        data = data[3:]
+    return data.decode('utf-8', errors='replace')
+
+
+def html_to_text(markup):
+    extractor = _TextExtractor()
+    extractor.feed(markup)
+    extractor.close()
+    text = ''.join(extractor.parts)
+    if extractor.title and extractor.title.strip():
+        text = extractor.title.strip() + '\n\n' + text
+    return normalize_text(text)
+
+
+def prepare(data, kind, options):
+    """Worker entry point: return (bytes, content_type or None to keep it, info)."""
+    if kind == 'image':
+        return prepare_image(data, options['image_budget'], options['image_max_side'])
+    text = decode_text(data)
+    if kind == 'html':
+        if options['html'] == 'raw':
+            return data, None, {'processed': False}
+        text = html_to_text(text)
+        return text.encode('utf-8'), 'text/plain', {'processed': True}
+    return normalize_text(text).encode('utf-8'), 'text/plain', {'processed': True}
+
+
+# Request side
+
+def classify(content_type, name):
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    name = (name or '').lower()
+    if content_type == 'image/svg+xml' or name.endswith('.svg'):
+        # Vector images are stored as uploaded; rasterising them is left to the browser
+        return 'svg'
+    if content_type.startswith('image/'):
+        return 'image'
+    if content_type in ('text/html', 'application/xhtml+xml') or name.endswith(('.html', '.htm')):
+        return 'html'
+    return 'text'
+
+
+class AttachmentProcessor:
+    def __init__(self, config, store):
+        self.config = config
+        self.store = store
+        self.options = {key: config[key] for key in ('image_budget', 'image_max_side', 'html')}
+        self.fingerprint = hashlib.sha256(json.dumps(self.options, sort_keys=True).encode()).hexdigest()[:12]
+        self.cache_dir = os.path.join(store.directory, 'prepared')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        workers = max(1, config["workers"])
+        self._slots = threading.BoundedSemaphore(workers + max(0, config["queue_size"]))
+        self._lock = threading.Lock()
+        self.counters = {
+            'files': 0,
+            'cache_hits': 0,
+            'unprocessed': 0,
+            'bytes_received': 0,
+            'bytes_prepared': 0,
+            'prepare_seconds': 0.0,
+        }
+
+    def _executor(self):
+        if self.config["workers"] <= 0:
+            return None
+        with self._pool_lock:
+            if self._pool is None:
+                try:
+                    # forkserver: forking the threaded server process itself is not safe
+                    self._pool = ProcessPoolExecutor(max_workers=self.config["workers"],
+                                                     mp_context=multiprocessing.get_context('forkserver'))
+                except (OSError, NotImplementedError, ValueError):
+                    # No working multiprocessing primitives (e.g. no /dev/shm): process inline
+                    self.config["workers"] = 0
+            return self._pool
+
+    def _run(self, data, kind):
+        if not self._slots.acquire(timeout=self.config["timeout"]):
+            raise AttachmentsBusy('Attachment processing is busy, please retry shortly')
+        release = True
+        try:
+            executor = self._executor()
+            if executor is None:
+                return prepare(data, kind, self.options)
+            future = executor.submit(prepare, data, kind, self.options)
+            try:
+                return future.result(timeout=self.config["timeout"])
+            except FutureTimeout:
+                # A job that already started keeps its worker busy, so its
+                # slot is only given back when it ends; that way
+                # ATTACHMENT_QUEUE_SIZE still bounds the real backlog
+                future.cancel()
+                release = False
+                future.add_done_callback(lambda _: self._slots.release())
+                raise AttachmentsBusy('Attachment processing timed out, please retry shortly')
+            except BrokenProcessPool:
+                # A worker died (e.g. out of memory); start a fresh pool next time
+                with self._pool_lock:
+                    if self._pool is executor:
+                        self._pool = None
+                return prepare(data, kind, self.options)
+        finally:
+            if release:
+                self._slots.release()
+
+    def _cache_path(self, digest, kind):
+        # The same bytes are prepared differently as HTML and as text
+        return os.path.join(self.cache_dir, f'{digest}-{kind}-{self.fingerprint}.json')
+
+    def _cached(self, digest, kind):
+        try:
+            with open(self._cache_path(digest, kind), 'r', encoding='utf-8') as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # The prepared blob may have been evicted from the store since
+        if self.store.get_meta(result['handle']) is None:
+            return None
+        return result
+
+    def process(self, data, content_type=None, name=None):
+        """Preprocess one upload and return its report (see the module docstring)."""
+        if len(data) > self.store.max_blob_bytes:
+            raise blobs.BlobTooLarge(f'Attachment exceeds {self.store.max_blob_bytes} bytes')
+        started = time.perf_counter()
+        digest = hashlib.sha256(data).hexdigest()
+        kind = classify(content_type, name)
+        BYTES_RECEIVED.inc(len(data))
+
+        result = self._cached(digest, kind)
+        cached = result is not None
+        if not cached:
+            if kind == 'svg':
+                prepared, prepared_type, info = data, None, {'processed': False}
+            else:
+                prepared, prepared_type, info = self._run(data, kind)
+            meta, _deduplicated = self.store.put(prepared, prepared_type or content_type, name)
+            result = {
+                'handle': meta['handle'],
+                'marker': blobs.marker(meta['handle']),
+                'content_type': meta['content_type'],
+                'kind': 'image' if kind == 'svg' else kind,
+                'original_bytes': len(data),
+                'prepared_bytes': meta['size'],
+                **info,
+            }
+            PREPARE_SECONDS.observe(time.perf_counter() - started, (result['kind'],))
+            tmp_path = f'{self._cache_path(digest, kind)}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(result, f)
+            os.replace(tmp_path, self._cache_path(digest, kind))
+
+        elapsed = time.perf_counter() - started
+        BYTES_PREPARED.inc(result['prepared_bytes'])
+        with self._lock:
+            self.counters['files'] += 1
+            self.counters['cache_hits'] += cached
+            self.counters['unprocessed'] += not result.get('processed', True)
+            self.counters['bytes_received'] += len(data)
+            self.counters['bytes_prepared'] += result['prepared_bytes']
+            self.counters['prepare_seconds'] += elapsed
+        return dict(result,
+                    name=name,
+                    cached=cached,
+                    ratio=round(result['prepared_bytes'] / len(data), 4) if data else 1.0,
+                    elapsed_ms=round(elapsed * 1000, 1))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        received = stats['bytes_received']
+        stats['ratio'] = round(stats['bytes_prepared'] / received, 4) if received else 1.0
+        stats['avg_ms'] = round(stats.pop('prepare_seconds') * 1000 / stats['files'], 1) if stats['files'] else 0.0
+        stats['workers'] = self.config["workers"]
+        stats['images_supported'] = Image is not None
+        return stats
+
+
+_processor = None
+_processor_lock = threading.Lock()
+
+
+def get_processor():
+    """Return the process-wide attachment processor."""
+    global _processor
+    if _processor is None:
+        with _processor_lock:
+            if _processor is None:
+                _processor = AttachmentProcessor(ATTACHMENT_CONFIG, blobs.get_store())
+    return _processor
@@ -0,0 +1,443 @@
+"""
+Batch deck generation: one job, many slide prompts, generated concurrently.
+
+Building a deck through the chat UI means one sendMessage() per slide, so
+the deck takes the sum of every generation. POST /api/batch takes the
+shared context once (template and attachment messages, usually blob
+markers) and a list of slide prompts:
+
+    {"context": [{"role": "user", "content": "[[blob:...]]"}, ...],
+     "prompts": ["Title slide for ...", "Revenue by region", ...],
+     "concurrency": 4}
+
+The context is checked for missing blobs and fitted to the context budget
+once per job, and every slide request sends the same messages in the same
+order with its prompt last, so upstreams that cache prompt prefixes can
+reuse the shared part. Up to BATCH_CONCURRENCY slides of a job run at
+once, and BATCH_MAX_WORKERS bounds slide requests across all jobs of the
+process. Every slide request also takes its own admission ticket
+(proxy/admission.py) while it streams, so batch slides and chats share
+ADMISSION_MAX_STREAMS; a slide that is turned away waits Retry-After and
+asks again before it takes a BATCH_MAX_WORKERS slot. A slide that fails
+for any other reason is reported as an error and the job goes on. Total
+time is close to the slowest slide rather than the sum.
+
+The response is an SSE stream of progress, in completion order:
+
+    data: {"job_id": "...", "slides": 12, "concurrency": 4}
+    data: {"slide": 3, "status": "running"}
+    data: {"slide": 3, "status": "done", "content": "...", "elapsed_ms": 8123.4}
+    data: {"slide": 5, "status": "error", "error": "Request timed out", "elapsed_ms": 30012.0}
+    data: {"done": true, "job_id": "...", "completed": 11, "failed": 1, "elapsed_ms": 14210.7}
+
+A job keeps running when its client disconnects. Each job is written to
+BATCH_DIR as JSON after every slide, so GET /api/batch/<job_id> can be
+polled while it runs and fetched after it finished (or after a restart,
+with the slides that were done by then). The newest BATCH_MAX_JOBS jobs
+are kept for BATCH_TTL seconds.
+"""
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+
+from proxy import admission, metrics
+from proxy.sse import sse_event
+
+BATCH_CONFIG = {
+    "concurrency": int(os.getenv("BATCH_CONCURRENCY", "4")),
+    "max_workers": int(os.getenv("BATCH_MAX_WORKERS", "16")),
+    "max_slides": int(os.getenv("BATCH_MAX_SLIDES", "50")),
+    # Vercel functions can only write below /tmp
+    "dir": os.getenv("BATCH_DIR", os.path.join(tempfile.gettempdir(), "fakeclippy-batch")
+                     if os.getenv("VERCEL") else os.path.join("data", "batch")),
+    "max_jobs": int(os.getenv("BATCH_MAX_JOBS", "100")),
+    "ttl": float(os.getenv("BATCH_TTL", "86400")),
+}
+
+SLIDES = metrics.Counter('fakeclippy_batch_slides_total', 'Batch slides by outcome: done or error', ('outcome',))
+SLIDE_SECONDS = metrics.Histogram('fakeclippy_batch_slide_seconds', 'Time to generate one batch slide')
+
+_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+# Slide requests in flight across all jobs of the process
+_slots = threading.BoundedSemaphore(max(1, BATCH_CONFIG["max_workers"]))
+
+
+class JobNotFound(Exception):
+    pass
+
+
+def valid_job_id(job_id):
+    return isinstance(job_id, str) and bool(_ID_PATTERN.match(job_id))
+
+
+def parse_request(data):
+    """Return (context, prompts, concurrency) from a POST /api/batch body; ValueError if malformed."""
+    if not isinstance(data, dict):
+        raise ValueError('Expected a JSON object')
+    prompts = data.get('prompts')
+    if not isinstance(prompts, list) or not prompts or not all(isinstance(p, str) and p.strip() for p in prompts):
+        raise ValueError('prompts must be a non-empty list of strings')
+    if len(prompts) > BATCH_CONFIG["max_slides"]:
+        raise ValueError(f'At most {BATCH_CONFIG["max_slides"]} prompts per job')
+    context = data.get('context') or []
+    if not isinstance(context, list) or not all(isinstance(m, dict) and 'role' in m for m in context):
+        raise ValueError('context must be a list of messages')
+    concurrency = data.get('concurrency', BATCH_CONFIG["concurrency"])
+    if not isinstance(concurrency, int) or concurrency < 1:
+        raise ValueError('concurrency must be a positive integer')
+    return context, prompts, min(concurrency, BATCH_CONFIG["concurrency"], len(prompts))
+
+
+def _error_message(frame):
+    """The message of an error event sent in place of a reply, else None."""
+    if isinstance(frame, bytes):
+        frame = frame.decode('utf-8', 'replace')
+    if not frame.startswith('data: {"error"'):
+        return None
+    try:
+        return json.loads(frame[6:].strip())['error']
+    except (ValueError, KeyError):
+        return 'Upstream error'
+
+
+def _admit(admit):
+    """A ticket from admit(), retrying after every rejection."""
+    if admit is None:
+        return None
+    while True:
+        try:
+            return admit()
+        except admission.Rejected as e:
+            time.sleep(e.retry_after)
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 1)
+
+
+class BatchJob:
+    """The slides of one job, their progress events and the threads generating them."""
+
+    def __init__(self, job_id, context, prompts, max_tokens, concurrency, store):
+        self.id = job_id
+        self.context = context
+        self.max_tokens = max_tokens
+        self.concurrency = concurrency
+        self.store = store
+        self.slides = [{'slide': i, 'prompt': prompt, 'status': 'queued', 'content': None, 'error': None,
+                        'elapsed_ms': None} for i, prompt in enumerate(prompts)]
+        self.events = [{'job_id': job_id, 'slides': len(prompts), 'concurrency': concurrency}]
+        self.condition = threading.Condition()
+        self.created = time.time()
+        self.started = time.perf_counter()
+        self.finished = None
+        self.elapsed = None
+        self._next = 0
+        self._running = 0
+
+    def start(self, api_config, trace=None, admit=None):
+        """
+        Start the worker threads.
+
+        admit() is called before every slide request and returns an
+        admission ticket (or raises admission.Rejected); None runs the
+        slides without admission control.
+        """
+        self._running = self.concurrency
+        for n in range(self.concurrency):
+            threading.Thread(target=self._work, args=(api_config, trace, admit),
+                             name=f'batch-{self.id[:8]}-{n}', daemon=True).start()
+
+    def _work(self, api_config, trace, admit):
+        try:
+            while True:
+                with self.condition:
+                    index = self._next
+                    self._next += 1
+                if index >= len(self.slides):
+                    break
+                self._run_slide(index, api_config, trace, admit)
+        finally:
+            with self.condition:
+                self._running -= 1
+                last = self._running == 0
+            if last:
+                self._finish(trace)
+
+    def _run_slide(self, index, api_config, trace, admit):
+        """Generate one slide; whatever goes wrong is published as the slide's error."""
+        ticket = None
+        try:
+            # Admitted before taking a worker slot, so a slide waiting out a
+            # rejection does not keep other jobs' slides from running
+            ticket = _admit(admit)
+            with _slots:
+                self._generate(index, api_config, trace)
+        except Exception as e:
+            self._fail(index, f'Server error: {str(e)}')
+        finally:
+            if ticket is not None:
+                ticket.release()
+
+    def _generate(self, index, api_config, trace):
+        # Imported here: chat pulls in requests, which the job store does not need
+        from proxy.chat import stream_chat
+        from proxy.conversations import ReplyCollector
+
+        slide = self.slides[index]
+        self._publish(index, status='running')
+        payload = {
+            'model': api_config['model'],
+            'messages': self.context + [{'role': 'user', 'content': slide['prompt']}],
+            'stream': True,
+            'max_tokens': self.max_tokens,
+        }
+        started = time.perf_counter()
+        collector = ReplyCollector()
+        error = None
+        frames = stream_chat(api_config, payload, trace=trace)
+        try:
+            for frame in frames:
+                error = error or _error_message(frame)
+                collector.feed(frame)
+        except Exception as e:
+            error = error or f'Server error: {str(e)}'
+        finally:
+            frames.close()
+        elapsed = time.perf_counter() - started
+        content = collector.reply()
+        if error is None and not content:
+            error = 'The reply ended before it was complete'
+        SLIDES.inc(labels=('error' if error else 'done',))
+        SLIDE_SECONDS.observe(elapsed)
+        if trace is not None:
+            trace.event('batch_slide', job_id=self.id, slide=index, elapsed_ms=_ms(elapsed), error=error,
+                        chars=len(content))
+        if error:
+            self._publish(index, status='error', error=error, elapsed_ms=_ms(elapsed))
+        else:
+            self._publish(index, status='done', content=content, elapsed_ms=_ms(elapsed))
+        self.store.save(self)
+
+    def _fail(self, index, error):
+        """Mark a slide that raised as failed, unless its outcome was already published."""
+        with self.condition:
+            if self.slides[index]['status'] in ('done', 'error'):
+                return
+        SLIDES.inc(labels=('error',))
+        self._publish(index, status='error', error=error)
+
+    def _publish(self, index, **changes):
+        with self.condition:
+            self.slides[index].update(changes)
+            self.events.append(dict({'slide': index}, **changes))
+            self.condition.notify_all()
+
+    def _finish(self, trace):
+        with self.condition:
+            self.elapsed = time.perf_counter() - self.started
+            self.finished = time.time()
+            completed, failed = self.counts()
+            self.events.append({'done': True, 'job_id': self.id, 'completed': completed, 'failed': failed,
+                                'elapsed_ms': _ms(self.elapsed)})
+            self.condition.notify_all()
+        try:
+            self.store.save(self)
+        except OSError as e:
+            # Progress readers already have the done event; only the file is stale
+            if trace is not None:
+                trace.event('batch_save_failed', job_id=self.id, error=str(e))
+        if trace is not None:
+            trace.finish(200, 'error' if failed else 'ok', job_id=self.id, slides=len(self.slides),
+                         failed=failed)
+
+    def counts(self):
+        completed = sum(1 for s in self.slides if s['status'] == 'done')
+        failed = sum(1 for s in self.slides if s['status'] == 'error')
+        return completed, failed
+
+    def wait(self, position, timeout=None):
+        """Events after position, waiting up to timeout for one; ([], True) once all were seen."""
+        with self.condition:
+            if position >= len(self.events) and self.finished is None:
+                self.condition.wait(timeout)
+            return self.events[position:], self.finished is not None and position >= len(self.events)
+
+    def frames(self):
+        """SSE frames of the job's progress, from its start until it finishes."""
+        position = 0
+        while True:
+            events, done = self.wait(position)
+            if done:
+                return
+            position += len(events)
+            yield ''.join(sse_event(e) for e in events).encode('utf-8')
+
+    async def aframes(self):
+        """Async counterpart of frames(); waits for progress in a worker thread."""
+        import asyncio
+
+        position = 0
+        while True:
+            events, done = await asyncio.to_thread(self.wait, position, 15)
+            if done:
+                return
+            position += len(events)
+            if events:
+                yield ''.join(sse_event(e) for e in events).encode('utf-8')
+
+    def snapshot(self):
+        with self.condition:
+            completed, failed = self.counts()
+            return {
+                'job_id': self.id,
+                'status': 'running' if self.finished is None else 'finished',
+                'created': self.created,
+                'finished': self.finished,
+                'elapsed_ms': None if self.elapsed is None else _ms(self.elapsed),
+                'concurrency': self.concurrency,
+                'completed': completed,
+                'failed': failed,
+                'slides': [dict(s) for s in self.slides],
+            }
+
+
+class BatchStore:
+    """Running jobs in memory and every job's latest snapshot as a JSON file."""
+
+    def __init__(self, directory, max_jobs, ttl):
+        self.directory = directory
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self._running = {}
+        self._lock = threading.Lock()
+        self.counters = {'started': 0, 'finished': 0, 'evicted': 0}
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, f'{job_id}.json')
+
+    def create(self, context, prompts, max_tokens, concurrency):
+        os.makedirs(self.directory, exist_ok=True)
+        self._evict()
+        job = BatchJob(uuid.uuid4().hex, context, prompts, max_tokens, concurrency, self)
+        with self._lock:
+            self._running[job.id] = job
+            self.counters['started'] += 1
+        self.save(job)
+        return job
+
+    def save(self, job):
+        snapshot = job.snapshot()
+        path = self._path(job.id)
+        temp = f'{path}.{threading.get_ident()}.tmp'
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(temp, path)
+        if snapshot['status'] == 'finished':
+            with self._lock:
+                if self._running.pop(job.id, None) is not None:
+                    self.counters['finished'] += 1
+
+    def get(self, job_id):
+        """The job's latest snapshot; JobNotFound if unknown or expired."""
+        if not valid_job_id(job_id):
+            raise JobNotFound(job_id)
+        with self._lock:
+            job = self._running.get(job_id)
+        if job is not None:
+            return job.snapshot()
+        try:
+            with open(self._path(job_id), encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            raise JobNotFound(job_id)
+        if self.ttl > 0 and time.time() - snapshot['created'] > self.ttl:
+            raise JobNotFound(job_id)
+        if snapshot['status'] == 'running':
+            # Written by a process that stopped before the job finished
+            snapshot['status'] = 'interrupted'
+        return snapshot
+
+    def _evict(self):
+        """Delete expired job files and the oldest beyond max_jobs (the new job takes one slot)."""
+        try:
+            names = [n for n in os.listdir(self.directory) if n.endswith('.json')]
+        except OSError:
+            return
+        entries = []
+        for name in names:
+            try:
+                entries.append((os.path.getmtime(os.path.join(self.directory, name)), name))
+            except OSError:
+                continue
+        entries.sort()
+        now = time.time()
+        with self._lock:
+            running = {f'{job_id}.json' for job_id in self._running}
+        excess = len(entries) - max(0, self.max_jobs - 1)
+        for mtime, name in entries:
+            if name in running:
+                continue
+            if excess > 0 or (self.ttl > 0 and now - mtime > self.ttl):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                excess -= 1
+                self.counters['evicted'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['running'] = len(self._running)
+        stats['directory'] = self.directory
+        stats['concurrency'] = BATCH_CONFIG["concurrency"]
+        stats['max_workers'] = BATCH_CONFIG["max_workers"]
+        return stats
+
+
+def start_job(api_config, data, trace=None, store=None, admit=None):
+    """
+    Validate a POST /api/batch body and start generating its slides.
+
+    admit() returns the admission ticket of one slide request (see
+    BatchJob.start). Raises ValueError for a malformed body and
+    blobs.BlobsMissing when the context references attachments the server
+    no longer has.
+    """
+    from proxy import blobs, context as context_budget
+
+    context, prompts, concurrency = parse_request(data)
+    blobs.check_references(context)
+    # Fit once for the whole job, with the longest prompt as the last turn
+    longest = max(prompts, key=len)
+    fitted, max_tokens = context_budget.fit_context(context + [{'role': 'user', 'content': longest}])
+    job = (store or get_store()).create(fitted[:-1], prompts, max_tokens, concurrency)
+    if trace is not None:
+        trace.event('batch_start', job_id=job.id, model=api_config['model'], slides=len(prompts),
+                    concurrency=concurrency, context_messages=len(job.context), max_tokens=max_tokens)
+    job.start(api_config, trace, admit)
+    return job
+
+
+def stats():
+    return get_store().stats()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Return the process-wide batch job store."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = BatchStore(BATCH_CONFIG["dir"], BATCH_CONFIG["max_jobs"], BATCH_CONFIG["ttl"])
+    return _store
@@ -0,0 +1,386 @@
+"""
+Content-addressed attachment and template blob store.
+
+Uploads are stored once on local disk under their SHA-256 and referenced
+from chat messages as `[[blob:<handle>]]`, where the handle is the first
+32 hex digits of the hash. Conversations then only carry the short marker,
+and the proxy expands markers into the upstream request at send time:
+text blobs are inserted as-is and binary blobs (images) as base64 data
+URLs, exactly what the browser used to inline. The expanded request body
+is streamed from memory-mapped files instead of being built as one string.
+
+The store is an LRU bounded by BLOB_MAX_BYTES; file modification times
+record recency so the order survives restarts.
+"""
+import base64
+import codecs
+import hashlib
+import json
+import mmap
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+BLOB_CONFIG = {
+    # Vercel functions can only write below /tmp
+    "dir": os.getenv("BLOB_DIR", os.path.join(tempfile.gettempdir(), "fakeclippy-blobs")
+                     if os.getenv("VERCEL") else os.path.join("data", "blobs")),
+    "max_bytes": int(os.getenv("BLOB_MAX_BYTES", str(512 * 1024 * 1024))),
+    "max_blob_bytes": int(os.getenv("BLOB_MAX_BLOB_BYTES", str(20 * 1024 * 1024))),
+}
+
+HANDLE_LENGTH = 32
+MARKER_PATTERN = re.compile(r'\[\[blob:([0-9a-f]{%d})\]\]' % HANDLE_LENGTH)
+_HANDLE_PATTERN = re.compile(r'^[0-9a-f]{%d}$' % HANDLE_LENGTH)
+
+# Bytes per read when streaming a blob; a multiple of 3 so base64 chunks
+# concatenate without padding in between.
+READ_SIZE = 3 * 64 * 1024
+
+
+class BlobTooLarge(Exception):
+    pass
+
+
+class BlobsMissing(Exception):
+    def __init__(self, handles):
+        super().__init__(', '.join(handles))
+        self.handles = handles
+
+
+def valid_handle(handle):
+    return isinstance(handle, str) and bool(_HANDLE_PATTERN.match(handle))
+
+
+def marker(handle):
+    return f'[[blob:{handle}]]'
+
+
+def is_text_type(content_type):
+    return (content_type.startswith('text/')
+            or content_type in ('application/json', 'application/javascript', 'application/xml'))
+
+
+class BlobStore:
+    def __init__(self, directory, max_bytes, max_blob_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_blob_bytes = max_blob_bytes
+        self._lock = threading.Lock()
+        self._index = OrderedDict()  # handle -> meta dict, least recently used first
+        self._bytes = 0
+        self.counters = {
+            'uploads': 0,
+            'dedup_hits': 0,
+            'bytes_received': 0,
+            'bytes_deduplicated': 0,
+            'expansions': 0,
+            'bytes_expanded': 0,
+            'evictions': 0,
+        }
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, handle, suffix=''):
+        return os.path.join(self.directory, handle[:2], handle + suffix)
+
+    def _load_index(self):
+        entries = []
+        for root, _dirs, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(root, name), 'r', encoding='utf-8') as f:
+                        meta = json.load(f)
+                    mtime = os.path.getmtime(self._path(meta['handle']))
+                except (OSError, ValueError, KeyError):
+                    continue
+                entries.append((mtime, meta))
+        for _mtime, meta in sorted(entries, key=lambda e: e[0]):
+            self._index[meta['handle']] = meta
+            self._bytes += meta['size']
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and len(self._index) > 1:
+            handle, meta = self._index.popitem(last=False)
+            self._bytes -= meta['size']
+            self.counters['evictions'] += 1
+            for suffix in ('', '.json'):
+                try:
+                    os.remove(self._path(handle, suffix))
+                except OSError:
+                    pass
+
+    def put(self, data, content_type='application/octet-stream', name=None):
+        """Store data and return (meta, deduplicated)."""
+        if len(data) > self.max_blob_bytes:
+            raise BlobTooLarge(f'Blob exceeds {self.max_blob_bytes} bytes')
+        digest = hashlib.sha256(data).hexdigest()
+        handle = digest[:HANDLE_LENGTH]
+        content_type = (content_type or 'application/octet-stream').split(';')[0].strip().lower()
+
+        with self._lock:
+            self.counters['uploads'] += 1
+            self.counters['bytes_received'] += len(data)
+            meta = self._index.get(handle)
+            if meta is not None:
+                self.counters['dedup_hits'] += 1
+                self.counters['bytes_deduplicated'] += len(data)
+                self._touch(handle)
+                return meta, True
+
+        meta = {
+            'handle': handle,
+            'sha256': digest,
+            'size': len(data),
+            'content_type': content_type,
+            'name': name,
+            'created': time.time(),
+        }
+        if is_text_type(content_type):
+            meta['encoded_length'] = self._text_encoded_length(data)
+        else:
+            meta['encoded_length'] = len(self._data_url_prefix(meta)) + 4 * ((len(data) + 2) // 3)
+
+        path = self._path(handle)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with open(self._path(handle, '.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+
+        with self._lock:
+            if handle not in self._index:
+                self._index[handle] = meta
+                self._bytes += meta['size']
+            self._evict()
+        return meta, False
+
+    def _touch(self, handle):
+        self._index.move_to_end(handle)
+        try:
+            os.utime(self._path(handle))
+        except OSError:
+            pass
+
+    def get_meta(self, handle):
+        with self._lock:
+            meta = self._index.get(handle)
+            if meta is not None:
+                self._touch(handle)
+            return meta
+
+    def missing(self, handles):
+        with self._lock:
+            return [h for h in handles if h not in self._index]
+
+    def read(self, handle):
+        with open(self._path(handle), 'rb') as f:
+            return f.read()
+
+    @staticmethod
+    def _data_url_prefix(meta):
+        return f"data:{meta['content_type']};base64,"
+
+    @staticmethod
+    def _text_encoded_length(data):
+        # Length of the text once embedded in a JSON string literal
+        return len(json.dumps(data.decode('utf-8', errors='replace'))) - 2
+
+    def open_encoded(self, handle):
+        """
+        Pin a blob for expansion: (meta, open file), or None if it is gone.
+
+        The open file keeps the blob's data readable even if it is evicted
+        (its file removed) before the expansion is read.
+        """
+        meta = self.get_meta(handle)
+        if meta is None:
+            return None
+        try:
+            f = open(self._path(handle), 'rb')
+        except OSError:
+            return None
+        with self._lock:
+            self.counters['expansions'] += 1
+            self.counters['bytes_expanded'] += meta['encoded_length']
+        return meta, f
+
+    def iter_encoded(self, handle, chunk_size=READ_SIZE):
+        """
+        Yield the blob as JSON-string-safe bytes, read from a memory map.
+
+        Text is JSON-escaped chunk by chunk (an incremental decoder keeps
+        multi-byte characters intact across chunk boundaries); binary data
+        becomes a base64 data URL.
+        """
+        pinned = self.open_encoded(handle)
+        if pinned is None:
+            raise BlobsMissing([handle])
+        meta, f = pinned
+        with f:
+            yield from self._iter_file(meta, f, chunk_size)
+
+    def _iter_file(self, meta, f, chunk_size=READ_SIZE):
+        text = is_text_type(meta['content_type'])
+        if not text:
+            yield self._data_url_prefix(meta).encode('ascii')
+        if meta['size'] == 0:
+            return
+
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for start in range(0, meta['size'], chunk_size):
+                chunk = mapped[start:start + chunk_size]
+                if text:
+                    final = start + chunk_size >= meta['size']
+                    yield json.dumps(decoder.decode(chunk, final))[1:-1].encode('ascii')
+                else:
+                    yield base64.b64encode(chunk)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats.update({
+                'blobs': len(self._index),
+                'bytes_stored': self._bytes,
+                'max_bytes': self.max_bytes,
+            })
+        received = stats['bytes_received']
+        stats['dedup_ratio'] = round(stats['bytes_deduplicated'] / received, 4) if received else 0.0
+        return stats
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Return the process-wide blob store."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = BlobStore(BLOB_CONFIG["dir"], BLOB_CONFIG["max_bytes"], BLOB_CONFIG["max_blob_bytes"])
+    return _store
+
+
+def iter_strings(value):
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from iter_strings(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from iter_strings(item)
+
+
+def referenced_handles(messages):
+    handles = []
+    for text in iter_strings(messages):
+        if '[[blob:' in text:
+            handles.extend(MARKER_PATTERN.findall(text))
+    return list(dict.fromkeys(handles))
+
+
+def check_references(messages, store=None):
+    """Raise BlobsMissing if any blob referenced by messages is not stored."""
+    handles = referenced_handles(messages)
+    if not handles:
+        return
+    missing = (store or get_store()).missing(handles)
+    if missing:
+        raise BlobsMissing(missing)
+
+
+class ExpandedBody:
+    """
+    Upstream request body with blob markers expanded lazily.
+
+    Iterating yields the JSON body in pieces (sync or async); len() gives
+    the exact byte length up front so the request is sent with a
+    Content-Length rather than chunked. The referenced blobs are opened
+    when the length is computed, so an eviction in between cannot change
+    what is sent. The body is read once: the files are closed when
+    iteration ends (or by close()).
+    """
+
+    def __init__(self, encoded, store):
+        self.store = store
+        self.parts = []
+        self.length = 0
+        position = 0
+        try:
+            for match in MARKER_PATTERN.finditer(encoded):
+                literal = encoded[position:match.start()].encode('utf-8')
+                pinned = store.open_encoded(match.group(1))
+                if pinned is None:
+                    raise BlobsMissing([match.group(1)])
+                self.parts.extend([literal, pinned])
+                self.length += len(literal) + pinned[0]['encoded_length']
+                position = match.end()
+        except BaseException:
+            self.close()
+            raise
+        tail = encoded[position:].encode('utf-8')
+        self.parts.append(tail)
+        self.length += len(tail)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        try:
+            for part in self.parts:
+                if isinstance(part, bytes):
+                    if part:
+                        yield part
+                else:
+                    yield from self.store._iter_file(*part)
+        finally:
+            self.close()
+
+    async def __aiter__(self):
+        # Imported here so the WSGI entry points do not load asyncio at startup
+        import asyncio
+
+        try:
+            for part in self.parts:
+                if isinstance(part, bytes):
+                    if part:
+                        yield part
+                    continue
+                # Page faults on the map and JSON escaping stay off the event loop
+                chunks = self.store._iter_file(*part)
+                while True:
+                    chunk = await asyncio.to_thread(next, chunks, None)
+                    if chunk is None:
+                        break
+                    yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        for part in self.parts:
+            if not isinstance(part, bytes):
+                part[1].close()
+
+
+def encode_payload(payload, store=None):
+    """
+    Serialise an upstream payload, expanding blob markers.
+
+    Returns plain bytes when nothing needs expanding, otherwise an
+    ExpandedBody that streams the referenced blobs.
+    """
+    encoded = json.dumps(payload)
+    if '[[blob:' not in encoded or not MARKER_PATTERN.search(encoded):
+        return encoded.encode('utf-8')
+    return ExpandedBody(encoded, store or get_store())
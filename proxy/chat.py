@@ -0,0 +1,232 @@
+"""
+The streaming half of /api/chat, shared by server.py and api/index.py.
+"""
+import queue
+import threading
+import time
+
+import requests
+
+from proxy import metrics, routing, upstream
+from proxy.sse import error_event, relay
+
+
+class _Attempt:
+    """One upstream request, opened until its first relayed frame."""
+
+    def __init__(self, target, payload, mode, trace=None):
+        self.target = target
+        self.payload = target.payload_for(payload)
+        self.mode = mode
+        self.trace = trace
+        self.response = None
+        self.frames = None
+        self.first = None
+        self.error = None
+        self.message = None
+        # final: no point in trying another upstream; refused: never sent
+        self.final = False
+        self.refused = False
+        self.probe = False
+        self.started = None
+        self._lock = threading.Lock()
+        self._abandoned = False
+        self._delivered = False
+        self._opened = False
+
+    def open(self):
+        admitted = self.target.breaker.acquire_probe()
+        if admitted is None:
+            self.refused = True
+            self.fail('Upstream temporarily unavailable')
+            return
+        self.probe = admitted == 'probe'
+        self.target.counters['requests'] += 1
+        self.started = started = time.perf_counter()
+        connect = ttft = None
+        try:
+            # Make streaming request to Claude API over a pooled keep-alive connection
+            try:
+                self.response = upstream.post_chat(self.target.base_url, self.target.api_key, self.payload)
+            except requests.exceptions.RequestException:
+                metrics.UPSTREAM_RESPONSES.inc(labels=('error',))
+                raise
+            connect = time.perf_counter() - started
+            metrics.observe_stage('upstream_connect', connect)
+            metrics.UPSTREAM_RESPONSES.inc(labels=(str(self.response.status_code),))
+
+            if self.response.status_code != 200:
+                self.final = not routing.retryable_status(self.response.status_code)
+                self.fail(f'API request failed with status {self.response.status_code}')
+            else:
+                self.frames = relay(self.response, self.mode)
+                self.first = next(self.frames, None)
+                ttft = time.perf_counter() - started
+                metrics.observe_stage('upstream_first_byte', ttft)
+                with self._lock:
+                    self._opened = True
+                    abandoned = self._abandoned
+                if abandoned:
+                    # abandon() already sampled this loser's time to first byte
+                    self.target.breaker.success()
+                else:
+                    self.target.record_first_byte(ttft)
+        except requests.exceptions.Timeout:
+            self.fail('Request timed out')
+        except requests.exceptions.RequestException as e:
+            self.fail(f'Request failed: {str(e)}')
+        except Exception as e:
+            self.final = True
+            self.fail(f'Server error: {str(e)}')
+        with self._lock:
+            self._opened = True
+        if self.trace is not None:
+            self.trace.upstream(self.target, self.response.status_code if self.response is not None else None,
+                                connect, ttft, self.message)
+        if self.error is not None:
+            if not self.final:
+                self.target.record_failure()
+            elif self.probe:
+                self.target.breaker.release_probe()
+            self.close()
+
+    def fail(self, message):
+        self.message = message
+        self.error = error_event(message)
+
+    def run(self, results):
+        """Thread target for hedged requests: open, then hand over unless already beaten."""
+        self.open()
+        with self._lock:
+            if not self._abandoned:
+                self._delivered = True
+                results.put(self)
+                return
+        self.close()
+
+    def abandon(self):
+        with self._lock:
+            self._abandoned = True
+            delivered = self._delivered
+            waiting = self.started is not None and not self._opened
+        if waiting:
+            # It was at least this slow; without the sample routing would
+            # never learn about an upstream that always loses the race
+            self.target.observe_ttft(time.perf_counter() - self.started)
+        # Undelivered attempts close themselves when their request returns
+        if delivered:
+            self.close()
+
+    def close(self, reuse=False):
+        if self.frames is not None:
+            # Stops the relay (and waits for its reader thread, see
+            # sse.timed_reads) before the connection changes hands
+            self.frames.close()
+        if self.response is not None:
+            upstream.release(self.response, reuse=reuse)
+
+
+def _open_sequential(candidates, payload, mode, trace):
+    failure = None
+    for target in candidates:
+        attempt = _Attempt(target, payload, mode, trace)
+        attempt.open()
+        if attempt.error is None:
+            return attempt, None
+        failure = attempt
+        if attempt.final:
+            break
+    return None, failure
+
+
+def _open_hedged(router, candidates, payload, mode, trace):
+    """Race the primary against one hedge once it is slower than its usual first byte."""
+    results = queue.Queue()
+    pending = list(candidates)
+    attempts = []
+
+    def launch():
+        attempt = _Attempt(pending.pop(0), payload, mode, trace)
+        attempts.append(attempt)
+        threading.Thread(target=attempt.run, args=(results,), daemon=True).start()
+
+    launch()
+    hedge_after = router.hedge_delay(candidates[0])
+    outstanding = 1
+    winner = None
+    failure = None
+    while outstanding:
+        try:
+            attempt = results.get(timeout=hedge_after if pending and hedge_after else None)
+        except queue.Empty:
+            candidates[0].counters['hedges'] += 1
+            hedge_after = None
+            launch()
+            outstanding += 1
+            continue
+        outstanding -= 1
+        if attempt.error is None:
+            winner = attempt
+            break
+        failure = attempt
+        if attempt.final:
+            break
+        if pending:
+            # Fail over straight away instead of waiting for the hedge deadline
+            launch()
+            outstanding += 1
+
+    for attempt in attempts:
+        if attempt is not winner:
+            attempt.abandon()
+    if winner is not None and winner is not attempts[0]:
+        winner.target.counters['hedge_wins'] += 1
+    return winner, failure
+
+
+def stream_chat(api_config, payload, mode=None, trace=None):
+    """Call the upstream API and yield SSE frames for the browser."""
+    def failed(message):
+        if trace is not None:
+            trace.fail(message)
+        return error_event(message)
+
+    router = routing.get_router(api_config)
+    candidates = router.candidates()
+    if not candidates:
+        yield failed('All upstream APIs are temporarily unavailable')
+        return
+
+    if router.hedging(candidates):
+        attempt, failure = _open_hedged(router, candidates, payload, mode, trace)
+    else:
+        attempt, failure = _open_sequential(candidates, payload, mode, trace)
+    if attempt is None:
+        yield failed(failure.message)
+        return
+
+    done = False
+    try:
+        if attempt.first is not None:
+            frame, done = attempt.first
+            metrics.TOKENS.inc(metrics.count_deltas(frame))
+            yield frame
+
+        waiting = time.perf_counter()
+        for frame, done in attempt.frames:
+            metrics.observe_stage('relay_chunk', time.perf_counter() - waiting)
+            metrics.TOKENS.inc(metrics.count_deltas(frame))
+            yield frame
+            waiting = time.perf_counter()
+
+    except requests.exceptions.Timeout:
+        attempt.target.record_failure()
+        yield failed('Request timed out')
+    except requests.exceptions.RequestException as e:
+        attempt.target.record_failure()
+        yield failed(f'Request failed: {str(e)}')
+    except Exception as e:
+        yield failed(f'Server error: {str(e)}')
+    finally:
+        # Return the connection to the pool unless we bailed out mid-stream
+        attempt.close(reuse=done)
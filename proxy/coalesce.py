@@ -0,0 +1,320 @@
+"""
+Single-flight coalescing of identical in-flight chat requests.
+
+When several browsers pick the same Design DNA template at the same moment,
+or a client retries its POST, the proxy would otherwise open one upstream
+stream per request. With COALESCE_REQUESTS=true, requests whose payloads
+hash to the same key (response_cache.payload_key) attach to a single
+upstream stream. Its frames go into a broadcast buffer, and every
+subscriber reads the buffer from the start, so late joiners miss nothing.
+
+The buffer is bounded by COALESCE_BUFFER_BYTES. Once a stream outgrows
+it, the flight stops accepting new subscribers and drops frames that
+every current subscriber has already read. When the slowest subscriber
+falls that far behind, the flight stops reading upstream until it
+catches up, so a slow client applies backpressure to the shared stream
+instead of growing the buffer. The upstream stream is closed when its
+last subscriber disconnects.
+
+Threaded servers use Flight: whichever subscriber runs out of buffered
+frames first reads the next one from upstream while the others wait.
+The async server uses AsyncFlight, where a pump task reads upstream so
+that a cancelled subscriber never interrupts the shared stream.
+"""
+import os
+import threading
+
+from proxy.response_cache import payload_key
+
+COALESCE_CONFIG = {
+    "enabled": os.getenv("COALESCE_REQUESTS", "false").lower() == "true",
+    "buffer_bytes": int(os.getenv("COALESCE_BUFFER_BYTES", str(4 * 1024 * 1024))),
+}
+
+_counters_lock = threading.Lock()
+counters = {'flights': 0, 'joined': 0, 'overflowed': 0, 'abandoned': 0}
+
+
+def _count(name):
+    with _counters_lock:
+        counters[name] += 1
+
+
+class _Buffer:
+    """Frames shared by a flight's subscribers, trimmed once nobody can join."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.frames = []
+        self.base = 0  # absolute index of frames[0]
+        self.size = 0
+        self.done = False
+        self.error = None
+        self.joinable = True
+        self.positions = {}  # subscriber -> absolute index of its next frame
+        self.consumed = {}  # subscriber -> bytes it has read
+        self.appended = 0
+
+    @property
+    def end(self):
+        return self.base + len(self.frames)
+
+    def subscribe(self, subscriber):
+        self.positions[subscriber] = self.base
+        self.consumed[subscriber] = self.appended - self.size
+
+    def unsubscribe(self, subscriber):
+        self.positions.pop(subscriber, None)
+        self.consumed.pop(subscriber, None)
+        self._trim()
+
+    def backlogged(self):
+        """True once the slowest subscriber is more than max_bytes behind upstream."""
+        return bool(self.consumed) and self.appended - min(self.consumed.values()) > self.max_bytes
+
+    def append(self, frame):
+        self.frames.append(frame)
+        self.size += len(frame)
+        self.appended += len(frame)
+        if self.joinable and self.size > self.max_bytes:
+            self.joinable = False
+            _count('overflowed')
+        self._trim()
+
+    def take(self, subscriber):
+        """Return the subscriber's next frame, or None if it has to wait."""
+        position = self.positions[subscriber]
+        if position >= self.end:
+            return None
+        frame = self.frames[position - self.base]
+        self.positions[subscriber] = position + 1
+        self.consumed[subscriber] += len(frame)
+        if not self.joinable and position == self.base:
+            self._trim()
+        return frame
+
+    def _trim(self):
+        if self.joinable or not self.positions:
+            return
+        drop = min(self.positions.values()) - self.base
+        if drop > 0:
+            self.size -= sum(len(f) for f in self.frames[:drop])
+            del self.frames[:drop]
+            self.base += drop
+
+
+class Flight:
+    """One upstream stream shared by any number of threads."""
+
+    def __init__(self, key, source, max_bytes):
+        self.key = key
+        self.source = source
+        self.buffer = _Buffer(max_bytes)
+        self.condition = threading.Condition()
+        self.reading = False
+        self.throttled = False
+
+    def subscribe(self):
+        """Return a subscriber token, or None once the flight is closed to joiners."""
+        with self.condition:
+            if not self.buffer.joinable:
+                return None
+            subscriber = object()
+            self.buffer.subscribe(subscriber)
+            return subscriber
+
+    def frames(self, subscriber):
+        while True:
+            with self.condition:
+                while True:
+                    frame = self.buffer.take(subscriber)
+                    if frame is not None:
+                        if self.throttled:
+                            self.throttled = False
+                            self.condition.notify_all()
+                        break
+                    if self.buffer.done:
+                        break
+                    if not self.reading:
+                        if not self.buffer.backlogged():
+                            break
+                        # Wait for the slowest subscriber rather than read further ahead
+                        self.throttled = True
+                    self.condition.wait()
+                if frame is None:
+                    if self.buffer.error is not None:
+                        raise self.buffer.error
+                    if self.buffer.done:
+                        return
+                    self.reading = True
+            if frame is None:
+                self._read_next()
+            else:
+                yield frame
+
+    def _read_next(self):
+        try:
+            frame = next(self.source)
+        except StopIteration:
+            frame, done, error = None, True, None
+        except Exception as e:
+            frame, done, error = None, True, e
+        else:
+            done, error = False, None
+        with self.condition:
+            if frame is not None:
+                self.buffer.append(frame)
+            if done:
+                self.buffer.done = True
+                self.buffer.error = error
+            closed = done or not self.buffer.joinable
+            self.reading = False
+            self.condition.notify_all()
+        if closed:
+            _release(_flights, self)
+
+    def leave(self, subscriber):
+        with self.condition:
+            self.buffer.unsubscribe(subscriber)
+            abandoned = not self.buffer.positions and not self.buffer.done
+            if abandoned:
+                # Nobody may join a stream that is about to be cut short
+                self.buffer.joinable = False
+                self.buffer.done = True
+            # The slowest subscriber may just have left
+            self.condition.notify_all()
+        if abandoned:
+            _release(_flights, self)
+            _count('abandoned')
+            self.source.close()
+
+
+class AsyncFlight:
+    """One upstream stream shared by any number of coroutines."""
+
+    def __init__(self, key, source, max_bytes):
+        # Imported here so the WSGI entry points do not load asyncio at startup
+        import asyncio
+
+        self.key = key
+        self.source = source
+        self.buffer = _Buffer(max_bytes)
+        self.loop = asyncio.get_running_loop()
+        self.condition = asyncio.Condition()
+        self.drained = asyncio.Event()
+        self.pump_task = None
+
+    def subscribe(self):
+        if not self.buffer.joinable:
+            return None
+        subscriber = object()
+        self.buffer.subscribe(subscriber)
+        if self.pump_task is None:
+            self.pump_task = self.loop.create_task(self._pump())
+        return subscriber
+
+    async def _pump(self):
+        error = None
+        try:
+            async for frame in self.source:
+                async with self.condition:
+                    self.buffer.append(frame)
+                    self.condition.notify_all()
+                if not self.buffer.joinable:
+                    _release(_async_flights, self)
+                while self.buffer.backlogged():
+                    # Let the slowest subscriber catch up before reading further ahead
+                    self.drained.clear()
+                    await self.drained.wait()
+        except Exception as e:  # not CancelledError, which propagates
+            error = e
+        finally:
+            _release(_async_flights, self)
+            self.buffer.done = True
+            self.buffer.error = error
+            async with self.condition:
+                self.condition.notify_all()
+
+    async def frames(self, subscriber):
+        while True:
+            async with self.condition:
+                frame = self.buffer.take(subscriber)
+                while frame is None and not self.buffer.done:
+                    await self.condition.wait()
+                    frame = self.buffer.take(subscriber)
+            self.drained.set()
+            if frame is None:
+                if self.buffer.error is not None:
+                    raise self.buffer.error
+                return
+            yield frame
+
+    def leave(self, subscriber):
+        self.buffer.unsubscribe(subscriber)
+        self.drained.set()
+        if not self.buffer.positions and not self.buffer.done:
+            self.buffer.joinable = False
+            _release(_async_flights, self)
+            _count('abandoned')
+            self.pump_task.cancel()
+
+
+_flights = {}
+_async_flights = {}
+_flights_lock = threading.Lock()
+
+
+def _release(registry, flight):
+    with _flights_lock:
+        if registry.get(flight.key) is flight:
+            del registry[flight.key]
+
+
+def _join(registry, flight_class, payload, produce):
+    """Return (flight, subscriber), starting a new flight if none can be joined."""
+    key = payload_key(payload)
+    with _flights_lock:
+        flight = registry.get(key)
+        subscriber = flight.subscribe() if flight is not None else None
+        joined = subscriber is not None
+        if not joined:
+            flight = flight_class(key, produce(), COALESCE_CONFIG["buffer_bytes"])
+            registry[key] = flight
+            subscriber = flight.subscribe()
+    _count('joined' if joined else 'flights')
+    return flight, subscriber
+
+
+def stream_coalesced(payload, produce):
+    """Yield produce()'s frames, sharing one upstream stream per identical payload."""
+    if not COALESCE_CONFIG["enabled"]:
+        yield from produce()
+        return
+    flight, subscriber = _join(_flights, Flight, payload, produce)
+    try:
+        yield from flight.frames(subscriber)
+    finally:
+        flight.leave(subscriber)
+
+
+async def astream_coalesced(payload, produce):
+    """Async twin of stream_coalesced; produce() returns an async iterator."""
+    if not COALESCE_CONFIG["enabled"]:
+        async for frame in produce():
+            yield frame
+        return
+    flight, subscriber = _join(_async_flights, AsyncFlight, payload, produce)
+    try:
+        async for frame in flight.frames(subscriber):
+            yield frame
+    finally:
+        flight.leave(subscriber)
+
+
+def stats():
+    with _counters_lock:
+        stats = dict(counters)
+    with _flights_lock:
+        stats['in_flight'] = len(_flights) + len(_async_flights)
+    stats['enabled'] = COALESCE_CONFIG["enabled"]
+    return stats
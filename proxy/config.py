@@ -0,0 +1,34 @@
+"""
+API configuration loading for the local entry points.
+"""
+import os
+
+
+def load_api_config(env_file='.env'):
+    """Load API settings from the environment, falling back to a .env file."""
+    api_config = {
+        "api_key": os.getenv("CLAUDE_API_KEY", ""),
+        "base_url": os.getenv("CLAUDE_BASE_URL", "https://www.dmxapi.cn/v1"),
+        "model": os.getenv("CLAUDE_MODEL", "claude-sonnet-4-20250514")
+    }
+
+    # If no API key in environment, try to load from .env file manually
+    if not api_config["api_key"]:
+        try:
+            with open(env_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.startswith('CLAUDE_API_KEY='):
+                        api_config["api_key"] = line.split('=', 1)[1].strip()
+                    elif line.startswith('CLAUDE_BASE_URL='):
+                        api_config["base_url"] = line.split('=', 1)[1].strip()
+                    elif line.startswith('CLAUDE_MODEL='):
+                        api_config["model"] = line.split('=', 1)[1].strip()
+        except FileNotFoundError:
+            print("Warning: .env file not found. Please create one with your API configuration.")
+        except Exception as e:
+            print(f"Warning: Could not read .env file: {e}")
+
+    if not api_config["api_key"]:
+        print("Warning: No API key configured. Please set CLAUDE_API_KEY environment variable or create .env file.")
+
+    return api_config
@@ -0,0 +1,307 @@
+"""
+Token budget for the upstream `messages` list.
+
+Long sessions accumulate template HTML and attachments until every turn is
+slow, expensive and finally too big for the model's context window. Before
+a request goes upstream, fit_context() estimates its size with a local
+heuristic tokenizer (counts are cached per message hash, unless a
+referenced blob is missing) and, only if it is over CONTEXT_TOKEN_BUDGET,
+applies the steps listed in CONTEXT_POLICY in order until it fits:
+
+- attachments: replace attachments in older turns with a short note;
+- templates: keep only the most recent Design DNA template;
+- summarize: collapse older turns into one summary message (cached, so
+  later turns of the same conversation reuse it).
+
+Whatever is still over budget after that is trimmed oldest first. The
+most recent CONTEXT_KEEP_TURNS messages are never rewritten, and
+max_tokens is set from what is left of the budget. The stored
+conversation itself is not modified.
+"""
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from proxy import blobs, metrics
+
+CONTEXT_CONFIG = {
+    "budget": int(os.getenv("CONTEXT_TOKEN_BUDGET", "200000")),
+    "max_output_tokens": int(os.getenv("CONTEXT_MAX_OUTPUT_TOKENS", "10000")),
+    "min_output_tokens": int(os.getenv("CONTEXT_MIN_OUTPUT_TOKENS", "2048")),
+    "policy": [step.strip() for step in os.getenv("CONTEXT_POLICY", "attachments,templates,summarize").split(',')
+               if step.strip()],
+    "keep_turns": int(os.getenv("CONTEXT_KEEP_TURNS", "6")),
+}
+
+# Heuristic tokenizer: ASCII text (English, HTML, base64) averages a little
+# over three characters per token; other scripts are close to one token per
+# character. Erring high keeps requests clear of the real limit.
+ASCII_CHARS_PER_TOKEN = 3.2
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# The frontend's wording for a template turn (sendTemplateInstructionToClaud)
+TEMPLATE_PREFIX = 'This is a slide template in HTML'
+SUMMARY_PREFIX = 'Summary of the earlier conversation (older turns were condensed to fit the context window):'
+SUMMARY_EXCERPT_CHARS = 240
+
+_DATA_URL_PATTERN = re.compile(r'data:[\w.+-]+/[\w.+-]+;base64,[A-Za-z0-9+/=]{64,}')
+_TAG_PATTERN = re.compile(r'<[^>]*>')
+_SPACE_PATTERN = re.compile(r'\s+')
+
+
+def estimate_text_tokens(text):
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return math.ceil(ascii_chars / ASCII_CHARS_PER_TOKEN) + (len(text) - ascii_chars)
+
+
+class _LRU:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+INPUT_TOKENS = metrics.Counter(
+    'fakeclippy_context_input_tokens_total',
+    'Estimated chat input tokens: before fitting (estimated), sent upstream (sent) and saved by fitting (saved)',
+    ('side',),
+)
+OVER_BUDGET = metrics.Counter('fakeclippy_context_over_budget_total', 'Chat requests fitted into the token budget')
+MESSAGES_DROPPED = metrics.Counter('fakeclippy_context_messages_dropped_total',
+                                   'Messages removed from requests to fit the token budget')
+
+_token_counts = _LRU(8192)
+_summaries = _LRU(256)
+_counters_lock = threading.Lock()
+counters = {
+    'requests': 0,
+    'over_budget': 0,
+    'input_tokens': 0,
+    'input_tokens_sent': 0,
+    'input_tokens_saved': 0,
+    'messages_dropped': 0,
+    'summaries_built': 0,
+    'summary_cache_hits': 0,
+}
+
+
+def _message_key(message):
+    encoded = json.dumps(message, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+def _marker_tokens(handle, store):
+    """(tokens, found): found is False when the blob's meta is not in the store."""
+    meta = store.get_meta(handle)
+    if meta is None:
+        return estimate_text_tokens(blobs.marker(handle)), False
+    # Blobs are expanded as text (or a base64 data URL) upstream, so they
+    # cost about as much as the equivalent characters
+    return math.ceil(meta['encoded_length'] / ASCII_CHARS_PER_TOKEN), True
+
+
+def _text_tokens(text, store):
+    """(tokens, complete): complete is False when a referenced blob was missing."""
+    if '[[blob:' not in text:
+        return estimate_text_tokens(text), True
+    tokens = 0
+    complete = True
+    position = 0
+    for match in blobs.MARKER_PATTERN.finditer(text):
+        marker_tokens, found = _marker_tokens(match.group(1), store)
+        tokens += estimate_text_tokens(text[position:match.start()]) + marker_tokens
+        complete = complete and found
+        position = match.end()
+    return tokens + estimate_text_tokens(text[position:]), complete
+
+
+def message_tokens(message, store=None):
+    """Estimated tokens of one message, cached by content hash."""
+    key = _message_key(message)
+    tokens = _token_counts.get(key)
+    if tokens is not None:
+        return tokens
+    store = store or blobs.get_store()
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    complete = True
+    for text in blobs.iter_strings(message.get('content', '')):
+        text_tokens, found = _text_tokens(text, store)
+        tokens += text_tokens
+        complete = complete and found
+    # A blob that is missing now (not uploaded yet, or another instance's
+    # store) may be there on the next request, so its guess is not kept
+    if complete:
+        _token_counts.put(key, tokens)
+    return tokens
+
+
+def count_tokens(messages, store=None):
+    return sum(message_tokens(m, store) for m in messages)
+
+
+def _content_text(message):
+    return '\n'.join(blobs.iter_strings(message.get('content', '')))
+
+
+def _is_template(message):
+    return message.get('role') == 'user' and _content_text(message).startswith(TEMPLATE_PREFIX)
+
+
+def _with_text(message, text):
+    return dict(message, content=text)
+
+
+def _drop_attachments(messages, protected):
+    result = []
+    for index, message in enumerate(messages):
+        text = _content_text(message)
+        if index >= protected or _is_template(message) or ('[[blob:' not in text and 'base64,' not in text):
+            result.append(message)
+            continue
+        text = blobs.MARKER_PATTERN.sub('[attachment omitted to save context]', text)
+        text = _DATA_URL_PATTERN.sub('[attachment omitted to save context]', text)
+        result.append(_with_text(message, text))
+    return result
+
+
+def _keep_active_template(messages, protected):
+    templates = [i for i, m in enumerate(messages) if _is_template(m)]
+    stale = set(i for i in templates[:-1] if i < protected)
+    return [_with_text(m, '[An earlier design template was replaced by a newer one.]') if i in stale else m
+            for i, m in enumerate(messages)]
+
+
+def _excerpt(message):
+    text = blobs.MARKER_PATTERN.sub('[attachment]', _content_text(message))
+    text = _DATA_URL_PATTERN.sub('[attachment]', text)
+    text = _SPACE_PATTERN.sub(' ', _TAG_PATTERN.sub(' ', text)).strip()
+    if len(text) > SUMMARY_EXCERPT_CHARS:
+        text = text[:SUMMARY_EXCERPT_CHARS].rstrip() + '...'
+    return text
+
+
+def _summarize(messages, protected):
+    """Collapse messages before `protected` (except the active template) into one."""
+    templates = [i for i, m in enumerate(messages[:protected]) if _is_template(m)]
+    keep = set(templates[-1:])
+    # The template's acknowledgement stays with it so turns still alternate
+    if keep and templates[-1] + 1 < protected and messages[templates[-1] + 1].get('role') == 'assistant':
+        keep.add(templates[-1] + 1)
+    collapsed = [m for i, m in enumerate(messages[:protected]) if i not in keep and m.get('role') != 'system']
+    if len(collapsed) < 2:
+        return messages
+
+    key = hashlib.sha1(''.join(_message_key(m) for m in collapsed).encode('ascii')).hexdigest()
+    summary = _summaries.get(key)
+    with _counters_lock:
+        counters['summary_cache_hits' if summary is not None else 'summaries_built'] += 1
+    if summary is None:
+        lines = [SUMMARY_PREFIX]
+        for message in collapsed:
+            excerpt = _excerpt(message)
+            if excerpt:
+                lines.append(f"- {message.get('role', 'user')}: {excerpt}")
+        summary = '\n'.join(lines)
+        _summaries.put(key, summary)
+
+    result = [m for m in messages[:protected] if m.get('role') == 'system']
+    result.append({'role': 'system', 'content': summary})
+    result.extend(messages[i] for i in sorted(keep))
+    result.extend(messages[protected:])
+    return result
+
+
+_STEPS = {
+    'attachments': _drop_attachments,
+    'templates': _keep_active_template,
+    'summarize': _summarize,
+}
+
+
+def _trim_oldest(messages, limit, store):
+    system = [m for m in messages if m.get('role') == 'system']
+    turns = [m for m in messages if m.get('role') != 'system']
+    while len(turns) > 1 and count_tokens(system + turns, store) > limit:
+        turns.pop(0)
+        # Upstream expects the conversation to open with a user turn
+        while len(turns) > 1 and turns[0].get('role') != 'user':
+            turns.pop(0)
+    return system + turns
+
+
+def fit_context(messages, store=None):
+    """
+    Fit messages into the token budget.
+
+    Returns (messages, max_tokens). The input list is not modified.
+    """
+    store = store or blobs.get_store()
+    budget = CONTEXT_CONFIG["budget"]
+    limit = budget - CONTEXT_CONFIG["min_output_tokens"]
+    before = count_tokens(messages, store)
+    fitted = messages
+
+    if before > limit:
+        protected = max(len(messages) - CONTEXT_CONFIG["keep_turns"], 0)
+        for name in CONTEXT_CONFIG["policy"]:
+            step = _STEPS.get(name)
+            if step is None:
+                continue
+            fitted = step(fitted, protected)
+            protected = max(len(fitted) - CONTEXT_CONFIG["keep_turns"], 0)
+            if count_tokens(fitted, store) <= limit:
+                break
+        else:
+            fitted = _trim_oldest(fitted, limit, store)
+
+    after = count_tokens(fitted, store)
+    max_tokens = max(min(CONTEXT_CONFIG["max_output_tokens"], budget - after), CONTEXT_CONFIG["min_output_tokens"])
+
+    with _counters_lock:
+        counters['requests'] += 1
+        counters['input_tokens'] += before
+        counters['input_tokens_sent'] += after
+        if fitted is not messages:
+            counters['over_budget'] += 1
+            counters['input_tokens_saved'] += before - after
+            counters['messages_dropped'] += max(len(messages) - len(fitted), 0)
+    INPUT_TOKENS.inc(before, labels=('estimated',))
+    INPUT_TOKENS.inc(after, labels=('sent',))
+    if fitted is not messages:
+        OVER_BUDGET.inc()
+        INPUT_TOKENS.inc(before - after, labels=('saved',))
+        MESSAGES_DROPPED.inc(max(len(messages) - len(fitted), 0))
+    return fitted, max_tokens
+
+
+def stats():
+    with _counters_lock:
+        stats = dict(counters)
+    stats.update({
+        'budget': CONTEXT_CONFIG["budget"],
+        'policy': CONTEXT_CONFIG["policy"],
+        'cached_counts': len(_token_counts),
+        'cached_summaries': len(_summaries),
+    })
+    return stats
@@ -0,0 +1,413 @@
+"""
+Server-side conversation history for /api/chat.
+
+Clients used to POST their whole conversationHistory (templates, inlined
+attachments and all) on every turn. With a conversation store they send
+only the new message plus a conversation ID, and the proxy assembles the
+upstream `messages` list itself.
+
+Two backends are available, picked by CONVERSATION_STORE:
+
+- memory (default): an in-process LRU bounded by count, total size and TTL.
+- sqlite: a local SQLite file, bounded by count and TTL, which survives
+  restarts and is shared by every worker process on the host.
+"""
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from proxy.sse import DONE_FRAME
+
+CONVERSATION_CONFIG = {
+    "backend": os.getenv("CONVERSATION_STORE", "memory"),
+    "max_conversations": int(os.getenv("CONVERSATION_MAX_COUNT", "500")),
+    "max_bytes": int(os.getenv("CONVERSATION_MAX_BYTES", str(64 * 1024 * 1024))),
+    "ttl": float(os.getenv("CONVERSATION_TTL", "3600")),
+    "sqlite_path": os.getenv("CONVERSATION_SQLITE_PATH", os.path.join("data", "conversations.sqlite3")),
+}
+
+_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+class ConversationNotFound(Exception):
+    pass
+
+
+def new_conversation_id():
+    return uuid.uuid4().hex
+
+
+def valid_conversation_id(conversation_id):
+    return isinstance(conversation_id, str) and bool(_ID_PATTERN.match(conversation_id))
+
+
+def _message_size(message):
+    content = message.get('content', '')
+    if isinstance(content, str):
+        return len(content)
+    return len(json.dumps(content))
+
+
+class MemoryConversationStore:
+    """LRU of conversation ID -> list of messages, bounded by count, bytes and TTL."""
+
+    def __init__(self, max_conversations, max_bytes, ttl):
+        self.max_conversations = max_conversations
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._items = OrderedDict()  # id -> [messages, size, last_used]
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _expired(self, entry, now):
+        return self.ttl > 0 and now - entry[2] > self.ttl
+
+    def _drop(self, conversation_id):
+        entry = self._items.pop(conversation_id)
+        self._bytes -= entry[1]
+
+    def _evict(self, now):
+        # Oldest entries sit at the front of the OrderedDict
+        while self._items:
+            oldest_id, oldest = next(iter(self._items.items()))
+            over_limit = len(self._items) > self.max_conversations or self._bytes > self.max_bytes
+            if not over_limit and not self._expired(oldest, now):
+                break
+            self._drop(oldest_id)
+            self.evictions += 1
+
+    def get(self, conversation_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._items.get(conversation_id)
+            if entry is None:
+                return None
+            if self._expired(entry, now):
+                self._drop(conversation_id)
+                return None
+            entry[2] = now
+            self._items.move_to_end(conversation_id)
+            return list(entry[0])
+
+    def _append(self, conversation_id, messages, now):
+        added = sum(_message_size(m) for m in messages)
+        entry = self._items.get(conversation_id)
+        if entry is None:
+            entry = self._items[conversation_id] = [[], 0, now]
+        entry[0].extend(messages)
+        entry[1] += added
+        entry[2] = now
+        self._bytes += added
+        self._items.move_to_end(conversation_id)
+        self._evict(now)
+
+    def append(self, conversation_id, messages):
+        with self._lock:
+            self._append(conversation_id, messages, time.monotonic())
+
+    def replace(self, conversation_id, messages):
+        # One lock hold, so no append for this conversation lands in between
+        with self._lock:
+            if conversation_id in self._items:
+                self._drop(conversation_id)
+            self._append(conversation_id, messages, time.monotonic())
+
+    def delete(self, conversation_id):
+        with self._lock:
+            if conversation_id not in self._items:
+                return False
+            self._drop(conversation_id)
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'memory',
+                'conversations': len(self._items),
+                'bytes': self._bytes,
+                'evictions': self.evictions,
+            }
+
+
+class SQLiteConversationStore:
+    """Conversation history in a local SQLite file, bounded by count and TTL."""
+
+    def __init__(self, path, max_conversations, ttl):
+        import sqlite3  # only this store needs it; keeps it out of cold starts
+
+        self.max_conversations = max_conversations
+        self.ttl = ttl
+        self.evictions = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS conversations ('
+            'id TEXT PRIMARY KEY, updated_at REAL NOT NULL)'
+        )
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS messages ('
+            'conversation_id TEXT NOT NULL, seq INTEGER NOT NULL, message TEXT NOT NULL, '
+            'PRIMARY KEY (conversation_id, seq))'
+        )
+
+    def _evict(self, now):
+        cutoff = now - self.ttl if self.ttl > 0 else None
+        stale = []
+        if cutoff is not None:
+            stale = [row[0] for row in self._db.execute(
+                'SELECT id FROM conversations WHERE updated_at < ?', (cutoff,))]
+        excess = self._db.execute('SELECT COUNT(*) FROM conversations').fetchone()[0] - len(stale) - self.max_conversations
+        if excess > 0:
+            stale += [row[0] for row in self._db.execute(
+                'SELECT id FROM conversations WHERE updated_at >= ? ORDER BY updated_at LIMIT ?',
+                (cutoff or 0, excess))]
+        for conversation_id in stale:
+            self._delete(conversation_id)
+        self.evictions += len(stale)
+
+    def _delete(self, conversation_id):
+        self._db.execute('DELETE FROM messages WHERE conversation_id = ?', (conversation_id,))
+        return self._db.execute('DELETE FROM conversations WHERE id = ?', (conversation_id,)).rowcount > 0
+
+    def get(self, conversation_id):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT updated_at FROM conversations WHERE id = ?', (conversation_id,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl > 0 and now - row[0] > self.ttl:
+                self._delete(conversation_id)
+                return None
+            self._db.execute('UPDATE conversations SET updated_at = ? WHERE id = ?', (now, conversation_id))
+            rows = self._db.execute(
+                'SELECT message FROM messages WHERE conversation_id = ? ORDER BY seq', (conversation_id,))
+            return [json.loads(r[0]) for r in rows]
+
+    def _append(self, conversation_id, messages, now):
+        self._db.execute(
+            'INSERT INTO conversations (id, updated_at) VALUES (?, ?) '
+            'ON CONFLICT(id) DO UPDATE SET updated_at = excluded.updated_at',
+            (conversation_id, now))
+        seq = self._db.execute(
+            'SELECT COALESCE(MAX(seq), -1) + 1 FROM messages WHERE conversation_id = ?',
+            (conversation_id,)).fetchone()[0]
+        self._db.executemany(
+            'INSERT INTO messages (conversation_id, seq, message) VALUES (?, ?, ?)',
+            [(conversation_id, seq + i, json.dumps(m)) for i, m in enumerate(messages)])
+        self._evict(now)
+
+    def append(self, conversation_id, messages):
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN')
+            try:
+                self._append(conversation_id, messages, now)
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+
+    def replace(self, conversation_id, messages):
+        now = time.time()
+        # One transaction, so no append for this conversation lands in between
+        with self._lock:
+            self._db.execute('BEGIN')
+            try:
+                self._delete(conversation_id)
+                self._append(conversation_id, messages, now)
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+
+    def delete(self, conversation_id):
+        with self._lock:
+            return self._delete(conversation_id)
+
+    def stats(self):
+        with self._lock:
+            count = self._db.execute('SELECT COUNT(*) FROM conversations').fetchone()[0]
+            size = self._db.execute('SELECT COALESCE(SUM(LENGTH(message)), 0) FROM messages').fetchone()[0]
+        return {
+            'backend': 'sqlite',
+            'conversations': count,
+            'bytes': size,
+            'evictions': self.evictions,
+        }
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Return the process-wide conversation store configured by CONVERSATION_STORE."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if CONVERSATION_CONFIG["backend"] == 'sqlite':
+                    _store = SQLiteConversationStore(
+                        CONVERSATION_CONFIG["sqlite_path"],
+                        CONVERSATION_CONFIG["max_conversations"],
+                        CONVERSATION_CONFIG["ttl"],
+                    )
+                else:
+                    _store = MemoryConversationStore(
+                        CONVERSATION_CONFIG["max_conversations"],
+                        CONVERSATION_CONFIG["max_bytes"],
+                        CONVERSATION_CONFIG["ttl"],
+                    )
+    return _store
+
+
+def resolve_messages(data, store=None, validate=None):
+    """
+    Work out the upstream `messages` for a /api/chat request body.
+
+    - {"message": {...}} starts a new conversation with that message.
+    - {"conversation_id": id, "message": {...}} appends to a stored
+      conversation; ConversationNotFound if it expired or was evicted.
+    - {"conversation_id": id, "messages": [...]} (re)seeds a conversation
+      with the client's full history, e.g. after ConversationNotFound.
+    - {"messages": [...]} is the original stateless request.
+
+    validate, if given, is called with the assembled messages and may
+    raise to reject the request.
+
+    Nothing is stored here. Returns (conversation_id, messages, turn)
+    where turn is the PendingTurn that record_reply commits once the
+    reply has finished; conversation_id and turn are None for stateless
+    requests.
+    """
+    conversation_id = data.get('conversation_id')
+    message = data.get('message')
+
+    if conversation_id is not None and not valid_conversation_id(conversation_id):
+        raise ConversationNotFound(conversation_id)
+
+    if message is None:
+        messages = data.get('messages', [])
+        if validate is not None:
+            validate(messages)
+        if conversation_id is None:
+            return None, messages, None
+        return conversation_id, messages, PendingTurn(conversation_id, messages, replace=True)
+
+    store = store or get_store()
+    if conversation_id is None:
+        conversation_id = new_conversation_id()
+        history = []
+    else:
+        history = store.get(conversation_id)
+        if history is None:
+            raise ConversationNotFound(conversation_id)
+
+    messages = history + [message]
+    if validate is not None:
+        validate(messages)
+    return conversation_id, messages, PendingTurn(conversation_id, [message])
+
+
+class PendingTurn:
+    """
+    The messages a chat request adds to its conversation.
+
+    They are only written together with the finished reply, so a request
+    that is rejected, fails upstream or is retried by the client leaves
+    the stored history as it was. replace is set when the request
+    re-seeds the conversation with the client's full history.
+    """
+
+    def __init__(self, conversation_id, messages, replace=False):
+        self.conversation_id = conversation_id
+        self.messages = messages
+        self.replace = replace
+
+    def commit(self, reply, store=None):
+        store = store or get_store()
+        messages = self.messages + [{'role': 'assistant', 'content': reply}]
+        if self.replace:
+            store.replace(self.conversation_id, messages)
+        else:
+            store.append(self.conversation_id, messages)
+
+
+class ReplyCollector:
+    """
+    Accumulates the assistant text from outgoing SSE frames.
+
+    Only used for stored conversations, where we have to know the reply in
+    order to keep the history; stateless requests stay on the zero-parse
+    passthrough path.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.pending = b''
+        self.done = False
+
+    def feed(self, frame):
+        if isinstance(frame, str):
+            frame = frame.encode('utf-8')
+        lines = (self.pending + frame).split(b'\n')
+        self.pending = lines.pop()
+        for line in lines:
+            if not line.startswith(b'data: {"'):
+                continue
+            if line == DONE_FRAME.rstrip(b'\n'):
+                self.done = True
+                continue
+            try:
+                chunk = json.loads(line[6:])
+            except ValueError:
+                continue
+            choices = chunk.get('choices') or []
+            if choices:
+                content = (choices[0].get('delta') or {}).get('content')
+                if content:
+                    self.parts.append(content)
+
+    def reply(self):
+        """The full reply, or '' if the stream did not finish."""
+        return ''.join(self.parts) if self.done else ''
+
+
+def record_reply(frames, turn, store=None):
+    """Pass frames through, then store the turn with its reply if the stream finished."""
+    collector = ReplyCollector()
+    try:
+        for frame in frames:
+            collector.feed(frame)
+            yield frame
+    finally:
+        reply = collector.reply()
+        if reply:
+            turn.commit(reply, store)
+
+
+async def arecord_reply(frames, turn, store=None):
+    """Async twin of record_reply; the turn is committed from a worker thread."""
+    # Imported here so the WSGI entry points do not load asyncio at startup
+    import asyncio
+
+    collector = ReplyCollector()
+    try:
+        async for frame in frames:
+            collector.feed(frame)
+            yield frame
+    finally:
+        reply = collector.reply()
+        if reply:
+            # A SQLite store writes to disk; shielded so a cancelled
+            # response still records the reply it received
+            await asyncio.shield(asyncio.to_thread(turn.commit, reply, store))
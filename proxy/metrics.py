@@ -0,0 +1,230 @@
+"""
+Low-overhead metrics for the chat proxy, exposed at /api/metrics.
+
+Counters, gauges and histograms are accumulated in per-thread shards, so
+recording on the relay hot path is a dictionary update with no lock and no
+contention between streams. Shards are only summed when /api/metrics is
+scraped. Shards of finished threads (the threaded dev server runs one
+thread per connection) are folded into a retired shard so their counts
+survive.
+
+Metrics are per process. In the Vercel function every warm instance
+reports its own values, and the `process_start_time_seconds` gauge lets a
+scraper tell instances apart.
+"""
+import bisect
+import threading
+import time
+
+# Seconds; covers sub-millisecond relay steps up to slow upstream starts
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+PROCESS_START_TIME = time.time()
+
+_registry = []
+_shards = []  # (thread, shard) pairs
+_retired = {}
+_shards_lock = threading.Lock()
+_local = threading.local()
+_PRUNE_EVERY = 64
+
+
+def _new_shard():
+    shard = {}
+    with _shards_lock:
+        _shards.append((threading.current_thread(), shard))
+        if len(_shards) % _PRUNE_EVERY == 0:
+            _prune()
+    _local.shard = shard
+    return shard
+
+
+def _shard():
+    try:
+        return _local.shard
+    except AttributeError:
+        return _new_shard()
+
+
+def _merge(target, shard):
+    for key, value in list(shard.items()):
+        if isinstance(value, list):
+            existing = target.get(key)
+            if existing is None:
+                target[key] = list(value)
+            else:
+                for i, v in enumerate(value):
+                    existing[i] += v
+        else:
+            target[key] = target.get(key, 0) + value
+
+
+def _prune():
+    """Fold shards of finished threads into the retired shard (lock held)."""
+    alive = []
+    for thread, shard in _shards:
+        if thread.is_alive():
+            alive.append((thread, shard))
+        else:
+            _merge(_retired, shard)
+    _shards[:] = alive
+
+
+def _snapshot():
+    with _shards_lock:
+        _prune()
+        totals = {}
+        _merge(totals, _retired)
+        for _thread, shard in _shards:
+            _merge(totals, shard)
+    return totals
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def _format_labels(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        shard = _shard()
+        key = (self.name, labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def render(self, totals):
+        for (name, labels), value in sorted(totals.items(), key=lambda item: str(item[0])):
+            if name == self.name:
+                yield f'{self.name}{self._format_labels(labels)} {value}'
+
+
+class Gauge(Counter):
+    """Summed across threads, so inc() and dec() may happen on different threads."""
+    kind = 'gauge'
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        shard = _shard()
+        key = (self.name, labels)
+        counts = shard.get(key)
+        if counts is None:
+            # One slot per bucket, then +Inf, then the sum
+            counts = shard[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self, totals):
+        for (name, labels), counts in sorted(totals.items(), key=lambda item: str(item[0])):
+            if name != self.name:
+                continue
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts[:-1]):
+                cumulative += count
+                yield f'{self.name}_bucket{self._format_labels(labels, [("le", bound)])} {cumulative}'
+            yield f'{self.name}_sum{self._format_labels(labels)} {counts[-1]}'
+            yield f'{self.name}_count{self._format_labels(labels)} {cumulative}'
+
+
+STAGE_SECONDS = Histogram(
+    'fakeclippy_chat_stage_seconds',
+    'Time spent in each stage of /api/chat: parse, upstream_connect (until response headers), '
+    'upstream_first_byte, relay_chunk (waiting for and framing one upstream read), client_write, total',
+    ('stage',))
+REQUESTS = Counter('fakeclippy_chat_requests_total', 'Chat requests accepted for streaming')
+ACTIVE_STREAMS = Gauge('fakeclippy_chat_active_streams', 'Chat streams currently open to clients')
+BYTES_IN = Counter('fakeclippy_chat_request_bytes_total', 'Bytes of chat request bodies received from clients')
+BYTES_OUT = Counter('fakeclippy_chat_response_bytes_total', 'Bytes of chat streams sent to clients')
+TOKENS = Counter('fakeclippy_chat_tokens_relayed_total', 'Upstream delta frames relayed (about one token each)')
+UPSTREAM_RESPONSES = Counter('fakeclippy_upstream_responses_total',
+                             'Upstream chat responses by HTTP status, or "error" when no response arrived',
+                             ('status',))
+START_TIME = Gauge('fakeclippy_process_start_time_seconds', 'Start time of this process (Unix seconds)')
+
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.observe(seconds, (stage,))
+
+
+def record_request(started, body_bytes):
+    """Count an accepted chat request and the time spent parsing it."""
+    observe_stage('parse', time.perf_counter() - started)
+    REQUESTS.inc()
+    BYTES_IN.inc(body_bytes)
+
+
+def count_deltas(frame):
+    """Upstream delta frames in a relayed chunk; [DONE] and error frames are not tokens."""
+    if isinstance(frame, str):
+        frame = frame.encode('utf-8')
+    return (frame.count(b'data:') - frame.count(b'data: [DONE]')
+            - frame.count(b'data: {"done"') - frame.count(b'data: {"error"'))
+
+
+def instrument_stream(frames, started=None):
+    """Wrap the frames sent to a client: active streams, bytes out, write time and total time."""
+    started = started or time.perf_counter()
+    ACTIVE_STREAMS.inc()
+    try:
+        for frame in frames:
+            size = len(frame)
+            before = time.perf_counter()
+            yield frame
+            # The WSGI server writes the frame while the generator is suspended
+            observe_stage('client_write', time.perf_counter() - before)
+            BYTES_OUT.inc(size)
+    finally:
+        ACTIVE_STREAMS.dec()
+        observe_stage('total', time.perf_counter() - started)
+
+
+async def ainstrument_stream(frames, started=None):
+    """Async twin of instrument_stream."""
+    started = started or time.perf_counter()
+    ACTIVE_STREAMS.inc()
+    try:
+        async for frame in frames:
+            size = len(frame)
+            before = time.perf_counter()
+            yield frame
+            observe_stage('client_write', time.perf_counter() - before)
+            BYTES_OUT.inc(size)
+    finally:
+        ACTIVE_STREAMS.dec()
+        observe_stage('total', time.perf_counter() - started)
+
+
+def render():
+    """Return every metric in the Prometheus text exposition format."""
+    totals = _snapshot()
+    totals[(START_TIME.name, ())] = PROCESS_START_TIME
+    lines = []
+    for metric in _registry:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.render(totals))
+    return '\n'.join(lines) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
@@ -0,0 +1,564 @@
+"""
+Incremental live preview: DOM patches between successive HTML replies.
+
+The browser used to rebuild the preview iframe after every reply:
+extractHTML() over the whole message, a new blob: document, and every
+IMAGE_PLACEHOLDER_n image inlined again as a base64 data URL by an
+injected script. POST /api/preview instead keeps the last previewed
+document of each conversation and answers with the operations that turn
+it into the document of the latest reply:
+
+    {"mode": "patch", "base": 3, "version": 4, "ops": [
+        {"op": "text", "path": [1, 1, 3, 0], "node": "#text", "text": "Q3 revenue"},
+        {"op": "attrs", "path": [1, 1, 5], "node": "div", "set": {"class": "card wide"}, "remove": []},
+        {"op": "insert", "path": [1, 1], "node": "main", "index": 9, "html": "<section>...</section>"},
+        {"op": "remove", "path": [1, 1, 7], "node": "section"},
+        {"op": "replace", "path": [0, 3], "node": "style", "html": "<style>...</style>"}]}
+
+A path starts with 0 for <head> or 1 for <body>, followed by indices into
+childNodes (text and comment nodes included). `node` is the expected
+lower-case nodeName of the target (of the parent for inserts), so a client
+whose DOM came out differently can tell and fetch the whole document with
+GET /api/preview/<conversation_id> instead. Ops apply in order, each to
+the tree left by the previous one.
+
+The whole document is sent ({"mode": "document", "html": ...}) when the
+client has no matching base version, when scripts, the doctype or the
+<html> attributes changed (scripts only run on load), when an op would
+touch a <canvas> (charts are drawn by those scripts), or when the patch
+is larger than PREVIEW_PATCH_RATIO of the document.
+
+Images the model was told to reference as src="IMAGE_PLACEHOLDER_n" are
+pointed at /api/blobs/<handle> of the uploaded attachment, so the iframe
+fetches (and caches) them by URL instead of inlining them.
+
+The HTML is taken from the latest assistant message of the stored
+conversation the way extractHTML() picks it: the first ```html fence,
+else the first bare document, else all bare fragments wrapped in a page.
+The parser is html.parser plus the HTML5 tree-building rules that matter
+for generated slides (head/body placement, void elements, implied
+closing of p/li/td/tr, implied tbody).
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from difflib import SequenceMatcher
+from html import escape
+from html.parser import HTMLParser
+
+from proxy import blobs, metrics
+from proxy.segmenter import Segmenter, utf16_len
+
+PREVIEW_CONFIG = {
+    "max_documents": int(os.getenv("PREVIEW_MAX_DOCUMENTS", "200")),
+    "patch_ratio": float(os.getenv("PREVIEW_PATCH_RATIO", "0.5")),
+}
+
+DIFF_SECONDS = metrics.Histogram('fakeclippy_preview_diff_seconds', 'Time to parse and diff a preview document')
+UPDATES = metrics.Counter('fakeclippy_preview_updates_total', 'Preview updates answered, by mode', ('mode',))
+
+VOID_ELEMENTS = frozenset(('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param',
+                           'source', 'track', 'wbr'))
+RAW_TEXT_ELEMENTS = frozenset(('script', 'style'))
+HEAD_ELEMENTS = frozenset(('base', 'link', 'meta', 'noscript', 'script', 'style', 'template', 'title'))
+# Start tags that close these open elements first
+_CLOSES = {
+    'li': ('li',),
+    'dt': ('dt', 'dd'),
+    'dd': ('dt', 'dd'),
+    'tr': ('td', 'th', 'tr'),
+    'td': ('td', 'th'),
+    'th': ('td', 'th'),
+    'option': ('option',),
+    'tbody': ('td', 'th', 'tr', 'tbody', 'thead', 'tfoot'),
+    'thead': ('td', 'th', 'tr', 'tbody', 'thead', 'tfoot'),
+    'tfoot': ('td', 'th', 'tr', 'tbody', 'thead', 'tfoot'),
+}
+_CLOSES_P = frozenset(('address', 'article', 'aside', 'blockquote', 'details', 'div', 'dl', 'fieldset',
+                       'figcaption', 'figure', 'footer', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header',
+                       'hr', 'main', 'menu', 'nav', 'ol', 'p', 'pre', 'section', 'table', 'ul'))
+
+FRAGMENT_PAGE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Claude HTML Preview</title>
+</head>
+<body>
+%s
+</body>
+</html>"""
+IMAGE_PLACEHOLDER_PREFIX = 'IMAGE_PLACEHOLDER_'
+
+
+class Element:
+    __slots__ = ('tag', 'attrs', 'children', '_digest')
+
+    def __init__(self, tag, attrs=()):
+        self.tag = tag
+        self.attrs = list(attrs)
+        self.children = []
+        self._digest = None
+
+    @property
+    def digest(self):
+        """Hash of the whole subtree; equal digests mean equal markup."""
+        if self._digest is None:
+            self._digest = hash((self.tag, tuple(self.attrs), tuple(child.digest for child in self.children)))
+        return self._digest
+
+
+class Text:
+    __slots__ = ('tag', 'text')
+
+    def __init__(self, text, tag='#text'):
+        self.tag = tag  # '#text' or '#comment', as in DOM nodeName
+        self.text = text
+
+    @property
+    def digest(self):
+        return hash((self.tag, self.text))
+
+
+class Document:
+    __slots__ = ('doctype', 'html', 'head', 'body')
+
+    def __init__(self):
+        self.doctype = None
+        self.head = Element('head')
+        self.body = Element('body')
+        self.html = Element('html')
+        self.html.children = [self.head, self.body]
+
+
+class _TreeBuilder(HTMLParser):
+    BEFORE_HEAD, IN_HEAD, AFTER_HEAD, IN_BODY = range(4)
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.document = Document()
+        self.mode = self.BEFORE_HEAD
+        self.stack = [self.document.head]
+
+    @property
+    def current(self):
+        return self.stack[-1]
+
+    def _to_body(self):
+        if self.mode != self.IN_BODY:
+            self.mode = self.IN_BODY
+            self.stack = [self.document.body]
+
+    def _append(self, node):
+        self.current.children.append(node)
+
+    def handle_decl(self, decl):
+        if decl.lower().startswith('doctype') and self.document.doctype is None:
+            self.document.doctype = decl
+
+    def handle_starttag(self, tag, attrs):
+        self._start(tag, attrs, tag in VOID_ELEMENTS)
+
+    def handle_startendtag(self, tag, attrs):
+        # Self-closing syntax (mostly inside <svg>) never leaves the element open
+        self._start(tag, attrs, True)
+
+    def _start(self, tag, attrs, void):
+        document = self.document
+        if tag == 'html':
+            if not document.html.attrs:
+                document.html.attrs = list(attrs)
+            return
+        if tag == 'head':
+            if self.mode == self.BEFORE_HEAD:
+                document.head.attrs = list(attrs)
+                self.mode = self.IN_HEAD
+            return
+        if tag == 'body':
+            if self.mode != self.IN_BODY:
+                document.body.attrs = list(attrs)
+            self._to_body()
+            return
+
+        if self.mode != self.IN_BODY:
+            if tag in HEAD_ELEMENTS and len(self.stack) == 1:
+                # Head elements seen after </head> still go into <head>
+                self.stack = [document.head]
+                if self.mode == self.BEFORE_HEAD:
+                    self.mode = self.IN_HEAD
+            elif self.current is document.head:
+                self._to_body()
+
+        closes = _CLOSES.get(tag, ())
+        while len(self.stack) > 1 and self.current.tag in closes:
+            self.stack.pop()
+        if tag in _CLOSES_P and len(self.stack) > 1 and self.current.tag == 'p':
+            self.stack.pop()
+        if tag == 'tr' and self.current.tag == 'table':
+            tbody = Element('tbody')
+            self._append(tbody)
+            self.stack.append(tbody)
+
+        element = Element(tag, attrs)
+        self._append(element)
+        if not void:
+            self.stack.append(element)
+
+    def handle_endtag(self, tag):
+        if tag == 'head':
+            if self.mode == self.IN_HEAD:
+                self.mode = self.AFTER_HEAD
+                self.stack = [self.document.head]
+            return
+        if tag in ('html', 'body'):
+            return
+        for i in range(len(self.stack) - 1, 0, -1):
+            if self.stack[i].tag == tag:
+                del self.stack[i:]
+                break
+
+    def handle_data(self, data):
+        if self.mode != self.IN_BODY and self.current is self.document.head and len(self.stack) == 1:
+            if not data.strip():
+                # The HTML5 parser keeps whitespace only while inside <head>
+                if self.mode == self.IN_HEAD:
+                    self._text(data)
+                return
+            self._to_body()
+        self._text(data)
+
+    def _text(self, data):
+        children = self.current.children
+        if not children and self.current.tag in ('pre', 'textarea', 'listing') and data.startswith('\n'):
+            data = data[1:]
+            if not data:
+                return
+        if children and children[-1].tag == '#text':
+            children[-1].text += data
+        else:
+            children.append(Text(data))
+
+    def handle_comment(self, data):
+        # Comments before <head> or between </head> and <body> belong to <html>
+        if self.mode in (self.IN_HEAD, self.IN_BODY):
+            self._append(Text(data, '#comment'))
+
+
+def parse(html):
+    builder = _TreeBuilder()
+    builder.feed(html.replace('\r\n', '\n').replace('\r', '\n'))
+    builder.close()
+    return builder.document
+
+
+def parse_fragment(html, context='body'):
+    """Nodes of an HTML fragment, as inserted into a `context` element."""
+    builder = _TreeBuilder()
+    container = Element(context)
+    builder.mode = builder.IN_BODY
+    builder.stack = [container]
+    builder.feed(html)
+    builder.close()
+    return container.children
+
+
+def _serialize(node, out, raw=False):
+    tag = node.tag
+    if tag == '#text':
+        out.append(node.text if raw else escape(node.text, quote=False))
+        return
+    if tag == '#comment':
+        out.append(f'<!--{node.text}-->')
+        return
+    out.append('<' + tag)
+    for name, value in node.attrs:
+        out.append(f' {name}' if value is None else f' {name}="{escape(value)}"')
+    out.append('>')
+    if tag in VOID_ELEMENTS:
+        return
+    raw = tag in RAW_TEXT_ELEMENTS
+    for child in node.children:
+        _serialize(child, out, raw)
+    out.append(f'</{tag}>')
+
+
+def serialize(node):
+    out = []
+    _serialize(node, out)
+    return ''.join(out)
+
+
+def serialize_document(document):
+    doctype = f'<!{document.doctype}>\n' if document.doctype else ''
+    return doctype + serialize(document.html)
+
+
+def extract_html(reply):
+    """The HTML the preview shows for reply, or None, following extractHTML()."""
+    segmenter = Segmenter()
+    events = segmenter.feed(reply) + segmenter.close()
+    blocks = {}
+    for event in events:
+        if event['type'] == 'html_start':
+            blocks[event['block']] = [event['kind'], []]
+        elif event['type'] == 'html_chunk':
+            blocks[event['block']][1].append(event['html'])
+    for wanted in ('fence', 'document'):
+        for kind, parts in blocks.values():
+            if kind == wanted:
+                return ''.join(parts).strip()
+    fragments = [''.join(parts) for kind, parts in blocks.values() if kind == 'fragment']
+    if fragments:
+        return FRAGMENT_PAGE % '\n'.join(fragments)
+    return None
+
+
+def link_images(document, images, asset_base):
+    """Point src="IMAGE_PLACEHOLDER_n" at the uploaded attachments' blob URLs."""
+    urls = {placeholder: asset_base + handle for placeholder, handle in images.items()}
+    pending = [document.html]
+    while pending:
+        node = pending.pop()
+        if node.tag.startswith('#'):
+            continue
+        for i, (name, value) in enumerate(node.attrs):
+            if name == 'src' and value in urls:
+                node.attrs[i] = (name, urls[value])
+        pending.extend(node.children)
+
+
+def _contains(node, tag):
+    if node.tag == tag:
+        return True
+    return any(_contains(child, tag) for child in getattr(node, 'children', ()))
+
+
+def _scripts(node, out):
+    if node.tag == 'script':
+        out.append(node.digest)
+    for child in getattr(node, 'children', ()):
+        _scripts(child, out)
+    return out
+
+
+class NeedsDocument(Exception):
+    """The change cannot be expressed as a safe patch."""
+
+
+class _Differ:
+    def __init__(self):
+        self.ops = []
+
+    def node(self, old, new, path, in_svg):
+        if old.digest == new.digest:
+            return
+        if old.tag != new.tag:
+            self._replace(old, new, path)
+        elif old.tag in ('#text', '#comment'):
+            self.ops.append({'op': 'text', 'path': path, 'node': old.tag, 'text': new.text})
+        elif old.tag == 'canvas':
+            raise NeedsDocument('canvas changed')
+        elif old.tag in RAW_TEXT_ELEMENTS or (in_svg and old.attrs != new.attrs):
+            # setAttribute() would not restore SVG's camelCase attribute names
+            self._replace(old, new, path)
+        else:
+            self.element(old, new, path, in_svg or old.tag == 'svg')
+
+    def element(self, old, new, path, in_svg=False):
+        if old.attrs != new.attrs:
+            before = dict(old.attrs)
+            after = dict(new.attrs)
+            self.ops.append({
+                'op': 'attrs', 'path': path, 'node': old.tag,
+                'set': {name: value for name, value in after.items() if before.get(name, 0) != value},
+                'remove': [name for name in before if name not in after],
+            })
+        self.children(old, new, path, in_svg)
+
+    def children(self, old_parent, new_parent, path, in_svg):
+        old = old_parent.children
+        new = new_parent.children
+        start = 0
+        while start < len(old) and start < len(new) and old[start].digest == new[start].digest:
+            start += 1
+        old_end, new_end = len(old), len(new)
+        while old_end > start and new_end > start and old[old_end - 1].digest == new[new_end - 1].digest:
+            old_end -= 1
+            new_end -= 1
+        if start == old_end and start == new_end:
+            return
+
+        matcher = SequenceMatcher(None, [n.digest for n in old[start:old_end]],
+                                  [n.digest for n in new[start:new_end]], autojunk=False)
+        # Right to left, so the indices of nodes not yet visited stay valid
+        for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+            if tag == 'equal':
+                continue
+            i1, i2, j1, j2 = i1 + start, i2 + start, j1 + start, j2 + start
+            paired = min(i2 - i1, j2 - j1)
+            for i in range(i2 - 1, i1 + paired - 1, -1):
+                if _contains(old[i], 'canvas'):
+                    raise NeedsDocument('canvas removed')
+                self.ops.append({'op': 'remove', 'path': path + [i], 'node': old[i].tag})
+            for k in range(paired):
+                self.node(old[i1 + k], new[j1 + k], path + [i1 + k], in_svg)
+            inserted = new[j1 + paired:j2]
+            if inserted:
+                if any(_contains(node, 'canvas') for node in inserted):
+                    raise NeedsDocument('canvas inserted')
+                self.ops.append({'op': 'insert', 'path': path, 'node': old_parent.tag, 'index': i1 + paired,
+                                 'html': ''.join(serialize(node) for node in inserted)})
+
+    def _replace(self, old, new, path):
+        if _contains(old, 'canvas') or _contains(new, 'canvas'):
+            raise NeedsDocument('canvas replaced')
+        self.ops.append({'op': 'replace', 'path': path, 'node': old.tag, 'html': serialize(new)})
+
+
+def diff_documents(old, new):
+    """Patch ops turning old into new; NeedsDocument if a reload is required."""
+    if old.doctype != new.doctype or old.html.attrs != new.html.attrs:
+        raise NeedsDocument('doctype or <html> changed')
+    if _scripts(old.html, []) != _scripts(new.html, []):
+        raise NeedsDocument('scripts changed')
+    differ = _Differ()
+    differ.element(old.head, new.head, [0])
+    differ.element(old.body, new.body, [1])
+    return differ.ops
+
+
+def latest_reply(messages):
+    for message in reversed(messages):
+        if message.get('role') == 'assistant' and isinstance(message.get('content'), str):
+            return message['content']
+    return None
+
+
+class _Preview:
+    __slots__ = ('version', 'document')
+
+    def __init__(self, version, document):
+        self.version = version
+        self.document = document
+
+
+class PreviewStore:
+    """Last previewed document per conversation, LRU-bounded."""
+
+    def __init__(self, max_documents, patch_ratio):
+        self.max_documents = max_documents
+        self.patch_ratio = patch_ratio
+        self._items = OrderedDict()  # conversation_id -> _Preview
+        self._lock = threading.Lock()
+        self.counters = {'updates': 0, 'patches': 0, 'documents': 0, 'unchanged': 0, 'evictions': 0,
+                         'bytes_sent': 0, 'bytes_full': 0}
+
+    def update(self, conversation_id, reply, base=None, images=None, asset_base=None):
+        """Preview the reply and return the response for a client showing version `base`."""
+        started = time.perf_counter()
+        html = extract_html(reply)
+        if html is None:
+            UPDATES.inc(labels=('none',))
+            return {'mode': 'none'}
+        document = parse(html)
+        if images and asset_base:
+            link_images(document, images, asset_base)
+
+        with self._lock:
+            current = self._items.get(conversation_id)
+        result = None
+        reason = 'no base version'
+        if current is not None and base == current.version:
+            try:
+                ops = diff_documents(current.document, document)
+            except NeedsDocument as e:
+                reason = str(e)
+            else:
+                result = {'mode': 'patch', 'base': base, 'version': base + 1 if ops else base, 'ops': ops}
+        full = serialize_document(document)
+        if result is not None and result['ops']:
+            size = len(json.dumps(result['ops'], ensure_ascii=False))
+            if size > self.patch_ratio * len(full):
+                result, reason = None, 'patch larger than document'
+        if result is None:
+            version = (current.version if current is not None else 0) + 1
+            result = {'mode': 'document', 'version': version, 'html': full, 'reason': reason}
+
+        with self._lock:
+            if result['version'] != base or current is None:
+                self._items[conversation_id] = _Preview(result['version'], document)
+            self._items.move_to_end(conversation_id)
+            while len(self._items) > self.max_documents:
+                self._items.popitem(last=False)
+                self.counters['evictions'] += 1
+            self.counters['updates'] += 1
+            if result['mode'] == 'document':
+                self.counters['documents'] += 1
+                self.counters['bytes_sent'] += len(result['html'])
+            elif result['ops']:
+                self.counters['patches'] += 1
+                self.counters['bytes_sent'] += size
+            else:
+                self.counters['unchanged'] += 1
+            self.counters['bytes_full'] += len(full)
+        kind = result['mode'] if result['mode'] == 'document' or result['ops'] else 'unchanged'
+        UPDATES.inc(labels=(kind,))
+        DIFF_SECONDS.observe(time.perf_counter() - started)
+        return result
+
+    def document(self, conversation_id):
+        """The current document of a conversation, or None."""
+        with self._lock:
+            current = self._items.get(conversation_id)
+        if current is None:
+            return None
+        return {'mode': 'document', 'version': current.version, 'html': serialize_document(current.document)}
+
+    def discard(self, conversation_id):
+        with self._lock:
+            self._items.pop(conversation_id, None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['documents_held'] = len(self._items)
+        full = stats['bytes_full']
+        stats['bytes_saved_ratio'] = round(1 - stats['bytes_sent'] / full, 4) if full else 0.0
+        return stats
+
+
+def preview_reply(conversation_id, messages, data):
+    """
+    Handle a POST /api/preview body for a stored conversation.
+
+    Returns (status, body): 409 while the reply the client saw
+    (`reply_chars`, in UTF-16 units) has not been stored yet.
+    """
+    reply = latest_reply(messages)
+    expected = data.get('reply_chars')
+    if reply is None or (isinstance(expected, int) and utf16_len(reply) != expected):
+        return 409, {'error': 'Reply not recorded yet', 'code': 'reply_not_recorded'}
+    images = data.get('images') if isinstance(data.get('images'), dict) else {}
+    images = {placeholder: handle for placeholder, handle in images.items()
+              if str(placeholder).startswith(IMAGE_PLACEHOLDER_PREFIX) and blobs.valid_handle(handle)}
+    asset_base = data.get('asset_base')
+    if not isinstance(asset_base, str) or not asset_base.startswith(('http://', 'https://')):
+        asset_base = None
+    base = data.get('base') if isinstance(data.get('base'), int) else None
+    return 200, get_store().update(conversation_id, reply, base, images, asset_base)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = PreviewStore(PREVIEW_CONFIG["max_documents"], PREVIEW_CONFIG["patch_ratio"])
+    return _store
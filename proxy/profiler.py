@@ -0,0 +1,256 @@
+"""
+On-demand sampling profiler for a live proxy process.
+
+`POST /api/profile?seconds=10` samples the Python stacks of every thread
+in the process for that long and answers with the aggregated result:
+the hottest functions (self and total samples), a per-route breakdown,
+and the stacks in collapsed form (`root;outer;...;inner count`, one per
+line) that flamegraph.pl, speedscope and similar tools read directly.
+`format=collapsed` returns only those lines as text/plain.
+
+Each stack is rooted at the route its thread is serving, found from the
+WSGI `environ` or ASGI `scope` of the request on that stack, with ids
+collapsed (`GET /api/chat/<id>`). Threads that are not serving a request
+(the server's accept loop, background writers, batch workers) are rooted
+at their thread name. Sampling is wall-clock: a thread blocked on a
+lock, a socket or the GIL is sampled where it waits, which is how lock
+contention shows up. On the async server all requests share the event
+loop thread, so only the coroutine running at each sample is seen.
+
+The endpoint answers 404 unless PROFILER_TOKEN is set, and 403 unless
+the request carries `Authorization: Bearer <PROFILER_TOKEN>`. Only one
+profile runs at a time (409 `profile_running` otherwise).
+
+Overhead. Nothing is installed until a profile is requested: no hooks,
+no tracing, no thread, and this module is only imported by the
+endpoint. While sampling, one thread wakes every PROFILER_INTERVAL
+seconds and walks every thread's stack (at most PROFILER_MAX_DEPTH
+frames) while holding the GIL. When a sweep costs more than
+PROFILER_MAX_OVERHEAD of the time between sweeps, the interval is
+stretched, so sampling never takes more than that share of the
+process's time (2% by default). The report includes the measured cost.
+"""
+import hmac
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+PROFILER_CONFIG = {
+    "token": os.getenv("PROFILER_TOKEN", ""),
+    "interval": float(os.getenv("PROFILER_INTERVAL", "0.01")),
+    "max_seconds": float(os.getenv("PROFILER_MAX_SECONDS", "60")),
+    "max_overhead": float(os.getenv("PROFILER_MAX_OVERHEAD", "0.02")),
+    "max_depth": int(os.getenv("PROFILER_MAX_DEPTH", "128")),
+}
+
+FORMATS = ('json', 'collapsed')
+
+_THREAD_NUMBER = re.compile(r'\d+')
+
+_running = threading.Lock()
+
+
+class ProfilerDisabled(Exception):
+    pass
+
+
+class NotAuthorized(Exception):
+    pass
+
+
+class ProfileRunning(Exception):
+    pass
+
+
+def authorize(authorization):
+    """Check an Authorization header against PROFILER_TOKEN."""
+    token = PROFILER_CONFIG["token"]
+    if not token:
+        raise ProfilerDisabled()
+    scheme, _, credentials = (authorization or '').partition(' ')
+    if scheme.lower() != 'bearer' or not hmac.compare_digest(credentials.strip().encode(), token.encode()):
+        raise NotAuthorized()
+
+
+def parse_options(args):
+    """(seconds, interval, format) from query arguments; raises ValueError."""
+    try:
+        seconds = float(args.get('seconds') or 10)
+        interval = float(args.get('interval') or PROFILER_CONFIG["interval"])
+    except ValueError:
+        raise ValueError('seconds and interval must be numbers')
+    if not 0 < seconds <= PROFILER_CONFIG["max_seconds"]:
+        raise ValueError(f'seconds must be between 0 and {PROFILER_CONFIG["max_seconds"]:g}')
+    if not 0.001 <= interval <= 1:
+        raise ValueError('interval must be between 0.001 and 1')
+    output = args.get('format') or 'json'
+    if output not in FORMATS:
+        raise ValueError(f'format must be one of {", ".join(FORMATS)}')
+    return seconds, interval, output
+
+
+def route_label(method, path):
+    # Path segments after /api/<resource>/ are ids (streams, jobs, blob handles...)
+    if path.startswith('/api/'):
+        parts = path.split('/')
+        if len(parts) > 3 and parts[3]:
+            path = '/'.join(parts[:3]) + '/<id>'
+    elif path != '/':
+        path = '/<static>'
+    return f'{method} {path}'
+
+
+class Profile:
+    """Stacks sampled from every thread but the profiler's own."""
+
+    def __init__(self, interval, max_overhead=None, max_depth=None, exclude=()):
+        self.interval = interval
+        self.max_overhead = max_overhead or PROFILER_CONFIG["max_overhead"]
+        self.max_depth = max_depth or PROFILER_CONFIG["max_depth"]
+        self.exclude = set(exclude)
+        self.stacks = Counter()
+        self.sweeps = 0
+        self.stretched = 0
+        self.cpu = 0.0
+        self.elapsed = 0.0
+        # code object -> (label, name of its request variable or None)
+        self._codes = {}
+        self._routes = {}
+
+    def run(self, seconds):
+        self.exclude.add(threading.get_ident())
+        started = time.monotonic()
+        deadline = started + seconds
+        while True:
+            cost = time.thread_time()
+            self.sweep()
+            cost = time.thread_time() - cost
+            self.cpu += cost
+            self.sweeps += 1
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            # cost / (cost + pause) stays within max_overhead
+            pause = cost * (1 / self.max_overhead - 1)
+            if pause > self.interval:
+                self.stretched += 1
+            time.sleep(min(max(self.interval, pause), deadline - now))
+        self.elapsed = time.monotonic() - started
+
+    def sweep(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident in self.exclude:
+                continue
+            stack = []
+            route = None
+            while frame is not None and len(stack) < self.max_depth:
+                label, variable = self._code(frame)
+                stack.append(label)
+                if route is None and variable is not None:
+                    route = self._route(frame.f_locals.get(variable))
+                frame = frame.f_back
+            if route is None:
+                route = _THREAD_NUMBER.sub('N', names.get(ident, 'thread'))
+            stack.append(route)
+            stack.reverse()
+            self.stacks[tuple(stack)] += 1
+
+    def _code(self, frame):
+        code = frame.f_code
+        entry = self._codes.get(code)
+        if entry is None:
+            variables = code.co_varnames + code.co_cellvars + code.co_freevars
+            variable = 'environ' if 'environ' in variables else 'scope' if 'scope' in variables else None
+            name = getattr(code, 'co_qualname', code.co_name)
+            entry = self._codes[code] = (f"{frame.f_globals.get('__name__', '?')}:{name}", variable)
+        return entry
+
+    def _route(self, request):
+        """Route of a WSGI environ or ASGI scope, or None for anything else."""
+        if not isinstance(request, dict):
+            return None
+        if 'PATH_INFO' in request:
+            key = (request.get('REQUEST_METHOD', '?'), request['PATH_INFO'])
+        elif request.get('type') == 'http':
+            key = (request.get('method', '?'), request.get('path', ''))
+        else:
+            return None
+        label = self._routes.get(key)
+        if label is None:
+            label = self._routes[key] = route_label(*key)
+        return label
+
+    def collapsed(self):
+        return ''.join(f"{';'.join(stack)} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+    def report(self, top=25):
+        samples = sum(self.stacks.values())
+        request_routes = set(self._routes.values())
+        routes = {}
+        for stack, count in self.stacks.items():
+            if stack[0] in request_routes:
+                route = routes.setdefault(stack[0], Counter())
+                route[stack[-1]] += count
+        return {
+            'seconds': round(self.elapsed, 3),
+            'sweeps': self.sweeps,
+            'samples': samples,
+            'top': _top(self.stacks, top, samples),
+            'routes': [
+                {
+                    'route': route,
+                    'samples': sum(frames.values()),
+                    'share': round(sum(frames.values()) / samples, 4) if samples else 0,
+                    'self': [{'frame': frame, 'samples': count} for frame, count in frames.most_common(5)],
+                }
+                for route, frames in sorted(routes.items(), key=lambda item: -sum(item[1].values()))
+            ],
+            'background_samples': samples - sum(sum(frames.values()) for frames in routes.values()),
+            'overhead': {
+                'interval': self.interval,
+                'effective_interval': round(self.elapsed / self.sweeps, 6) if self.sweeps else None,
+                'stretched_sweeps': self.stretched,
+                'sampler_cpu_seconds': round(self.cpu, 6),
+                'per_sweep_us': round(self.cpu / self.sweeps * 1e6, 1) if self.sweeps else None,
+                'share_of_wall_time': round(self.cpu / self.elapsed, 5) if self.elapsed else 0,
+            },
+            'collapsed': self.collapsed(),
+        }
+
+
+def _top(stacks, limit, samples):
+    """Frames by self samples (innermost) with their total (anywhere on the stack)."""
+    own = Counter()
+    total = Counter()
+    for stack, count in stacks.items():
+        own[stack[-1]] += count
+        for frame in set(stack[1:]):
+            total[frame] += count
+    return [
+        {'frame': frame, 'self': count, 'total': total[frame],
+         'self_share': round(count / samples, 4)}
+        for frame, count in own.most_common(limit)
+    ]
+
+
+def profile(seconds, interval=None):
+    """
+    Sample all threads for seconds and return the Profile.
+
+    Blocks the calling thread, which is left out of the samples.
+    Raises ProfileRunning when another profile is in progress.
+    """
+    if not _running.acquire(blocking=False):
+        raise ProfileRunning()
+    try:
+        result = Profile(interval or PROFILER_CONFIG["interval"], exclude=(threading.get_ident(),))
+        sampler = threading.Thread(target=result.run, args=(seconds,), name='profiler', daemon=True)
+        sampler.start()
+        sampler.join()
+        return result
+    finally:
+        _running.release()
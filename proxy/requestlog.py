@@ -0,0 +1,281 @@
+"""
+Structured JSON request logs, written off the request path.
+
+Every /api/chat request gets a request id: the client's X-Request-Id when
+it sent a usable one, otherwise a fresh one. The id is returned in the
+X-Request-Id header of the stream and carried by each record the request
+produces, one JSON object per line:
+
+    {"ts": ..., "event": "chat_start", "request_id": "...", "model": ..., "bytes_in": ..., "messages": 4, ...}
+    {"ts": ..., "event": "upstream", "request_id": "...", "upstream": "...", "status": 200,
+     "connect_ms": 180.2, "first_byte_ms": 912.5, "error": null}
+    {"ts": ..., "event": "chunk", "request_id": "...", "seq": 12, "bytes": 131, "elapsed_ms": 1204.9}
+    {"ts": ..., "event": "chat_end", "request_id": "...", "status": 200, "outcome": "ok",
+     "duration_ms": 5310.4, "first_byte_ms": 915.0, "bytes_out": 48213, "frames": 377, "upstream_calls": 1}
+
+`outcome` is ok, error (an error event was sent in the stream),
+client_closed, or why the request was answered without a stream
+(rejected, conversation_not_found, blob_not_found, server_error).
+Resumed streams (GET /api/chat/<stream_id>) log `chat_resume` in place
+of chat_start and can also end as bad_request, stream_not_found or
+replay_unavailable. Upstream warm-up failures are logged as
+`upstream_warm_failed`.
+
+Request threads and coroutines only build a dict and put it on a bounded
+queue without waiting. A daemon thread serializes records in batches and
+appends them to REQUEST_LOG_FILE, rotated at REQUEST_LOG_MAX_BYTES. When
+the queue is full the record is dropped and counted instead. Per-chunk
+records are sampled per request (REQUEST_LOG_CHUNK_SAMPLE), so a sampled
+request has every chunk and the others pay one attribute check per frame.
+"""
+import json
+import os
+import queue
+import random
+import re
+import tempfile
+import threading
+import time
+
+from proxy import metrics
+
+LOG_CONFIG = {
+    "enabled": os.getenv("REQUEST_LOG", "true").lower() == "true",
+    "path": os.getenv("REQUEST_LOG_FILE", os.path.join(tempfile.gettempdir(), "fakeclippy-logs", "requests.log")
+                      if os.getenv("VERCEL") else os.path.join("data", "logs", "requests.log")),
+    "max_bytes": int(os.getenv("REQUEST_LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+    "backups": int(os.getenv("REQUEST_LOG_BACKUPS", "5")),
+    "queue_size": int(os.getenv("REQUEST_LOG_QUEUE_SIZE", "10000")),
+    "chunk_sample": float(os.getenv("REQUEST_LOG_CHUNK_SAMPLE", "0.01")),
+}
+
+# Records serialized and written per file write
+BATCH_SIZE = 256
+
+RECORDS = metrics.Counter('fakeclippy_log_records_total',
+                          'Structured log records: written, dropped (queue full) or failed (write error)', ('fate',))
+
+_REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._:-]{8,64}$')
+
+
+def request_id(header=None):
+    """The client's request id if it is usable, else a new random one."""
+    if header and _REQUEST_ID_PATTERN.match(header):
+        return header
+    return os.urandom(16).hex()
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+class RequestLog:
+    """Bounded queue of records drained to a rotating file by one thread."""
+
+    def __init__(self, path, max_bytes, backups, queue_size):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.counters = {'queued': 0, 'written': 0, 'dropped': 0, 'failed': 0}
+
+    def emit(self, event, fields, request_id=None):
+        """Queue a record; never blocks."""
+        record = {'ts': round(time.time(), 6), 'event': event}
+        if request_id is not None:
+            record['request_id'] = request_id
+        record.update(fields)
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.counters['dropped'] += 1
+            RECORDS.inc(labels=('dropped',))
+            return
+        self.counters['queued'] += 1
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                import atexit
+
+                self._thread = threading.Thread(target=self._run, name='request-log', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        # Imported here: the logging package is only needed by the writer
+        import logging
+        from logging.handlers import RotatingFileHandler
+
+        handler = None
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < BATCH_SIZE:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                if handler is None:
+                    os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                    handler = RotatingFileHandler(self.path, maxBytes=self.max_bytes, backupCount=self.backups,
+                                                  encoding='utf-8', delay=True)
+                    # Let write errors reach the counters below instead of printing a traceback
+                    handler.handleError = self._raise
+                lines = '\n'.join(json.dumps(record, ensure_ascii=False, default=str) for record in batch)
+                handler.handle(logging.makeLogRecord({'msg': lines}))
+            except Exception:
+                self.counters['failed'] += len(batch)
+                RECORDS.inc(len(batch), labels=('failed',))
+            else:
+                self.counters['written'] += len(batch)
+                RECORDS.inc(len(batch), labels=('written',))
+            for _ in batch:
+                self._queue.task_done()
+
+    @staticmethod
+    def _raise(record):
+        raise
+
+    def flush(self, timeout=2.0):
+        """Wait up to timeout seconds for queued records to be written."""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['queue_depth'] = self._queue.qsize()
+        stats['path'] = self.path
+        stats['chunk_sample'] = LOG_CONFIG["chunk_sample"]
+        return stats
+
+
+class Trace:
+    """The records of one chat request; a no-op when logging is disabled."""
+
+    def __init__(self, log, request_id, sample_chunks=False):
+        self.log = log
+        self.request_id = request_id
+        self.sample_chunks = sample_chunks
+        self.started = time.perf_counter()
+        self.first_byte = None
+        self.bytes_out = 0
+        self.frames = 0
+        self.upstream_calls = 0
+        self.error = None
+        self.ended = False
+
+    def event(self, name, **fields):
+        if self.log is not None:
+            self.log.emit(name, fields, self.request_id)
+
+    def upstream(self, target, status=None, connect=None, first_byte=None, error=None):
+        """One upstream attempt, once it has its first frame or has failed."""
+        self.upstream_calls += 1
+        self.event('upstream', upstream=target.name, status=status, connect_ms=_ms(connect),
+                   first_byte_ms=_ms(first_byte), error=error)
+
+    def fail(self, message):
+        """An error event is being sent to the client in place of (the rest of) the reply."""
+        if self.error is None:
+            self.error = message
+
+    def frame(self, size):
+        now = time.perf_counter()
+        if self.first_byte is None:
+            self.first_byte = now - self.started
+        self.frames += 1
+        self.bytes_out += size
+        if self.sample_chunks:
+            self.event('chunk', seq=self.frames, bytes=size, elapsed_ms=_ms(now - self.started))
+
+    def finish(self, status, outcome=None, **fields):
+        """Write the chat_end record; later calls are ignored."""
+        if self.ended:
+            return
+        self.ended = True
+        if outcome is None:
+            outcome = 'error' if self.error is not None else 'ok'
+        fields.setdefault('error', self.error)
+        self.event('chat_end', status=status, outcome=outcome, duration_ms=_ms(time.perf_counter() - self.started),
+                   first_byte_ms=_ms(self.first_byte), bytes_out=self.bytes_out, frames=self.frames,
+                   upstream_calls=self.upstream_calls, **fields)
+
+
+def start(request_id):
+    """Begin the trace of a chat request."""
+    log = get_log()
+    return Trace(log, request_id, log is not None and random.random() < LOG_CONFIG["chunk_sample"])
+
+
+def event(name, **fields):
+    """A record that belongs to no request."""
+    log = get_log()
+    if log is not None:
+        log.emit(name, fields)
+
+
+class TracedStream:
+    """
+    Response body that records frame sizes, the first byte and how the stream ended.
+
+    The trace is finished in close(), which WSGI servers call even when
+    the body was never iterated (see admission.AdmittedStream).
+    """
+
+    def __init__(self, frames, trace):
+        self.frames = frames
+        self.trace = trace
+        self.completed = False
+
+    def __iter__(self):
+        trace = self.trace
+        for frame in self.frames:
+            trace.frame(len(frame))
+            yield frame
+        self.completed = True
+
+    def close(self):
+        self.trace.finish(200, None if self.completed else 'client_closed')
+        close = getattr(self.frames, 'close', None)
+        if close is not None:
+            close()
+
+
+async def atraced(frames, trace):
+    """Async counterpart of TracedStream; the caller finishes the trace if this never started."""
+    completed = False
+    try:
+        async for frame in frames:
+            trace.frame(len(frame))
+            yield frame
+        completed = True
+    finally:
+        trace.finish(200, None if completed else 'client_closed')
+
+
+def stats():
+    log = get_log()
+    if log is None:
+        return {'enabled': False}
+    return dict(log.stats(), enabled=True)
+
+
+_log = None
+_log_lock = threading.Lock()
+
+
+def get_log():
+    """The process-wide log, or None when REQUEST_LOG is false."""
+    global _log
+    if _log is None and LOG_CONFIG["enabled"]:
+        with _log_lock:
+            if _log is None:
+                _log = RequestLog(LOG_CONFIG["path"], LOG_CONFIG["max_bytes"], LOG_CONFIG["backups"],
+                                  LOG_CONFIG["queue_size"])
+    return _log
@@ -0,0 +1,148 @@
+"""
+Opt-in cache of finished chat responses.
+
+Picking a Design DNA template sends the same prompt and template to the
+model every time, so with RESPONSE_CACHE=true the proxy remembers the SSE
+frames of each completed stream, keyed on a canonical hash of the upstream
+payload (model, messages and parameters). An identical request is replayed
+frame by frame in the same `data: {...}` / `{"done": true}` framing, so the
+frontend cannot tell the difference.
+
+Only streams that reached [DONE] are stored. Entries expire after a TTL
+and the cache is bounded by entry count and total bytes (LRU).
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from proxy.sse import DONE_FRAME
+
+RESPONSE_CACHE_CONFIG = {
+    "enabled": os.getenv("RESPONSE_CACHE", "false").lower() == "true",
+    "ttl": float(os.getenv("RESPONSE_CACHE_TTL", "86400")),
+    "max_entries": int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "200")),
+    "max_bytes": int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+}
+
+
+def payload_key(payload):
+    """Canonical hash of an upstream payload; `stream` does not change the answer."""
+    canonical = {k: v for k, v in payload.items() if k != 'stream'}
+    encoded = json.dumps(canonical, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def _as_bytes(frame):
+    return frame.encode('utf-8') if isinstance(frame, str) else frame
+
+
+class ResponseCache:
+    def __init__(self, ttl, max_entries, max_bytes):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()  # key -> (frames, size, stored_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {'lookups': 0, 'hits': 0, 'stores': 0, 'evictions': 0, 'bytes_saved': 0}
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            self.counters['lookups'] += 1
+            entry = self._items.get(key)
+            if entry is not None and self.ttl > 0 and now - entry[2] > self.ttl:
+                self._drop(key)
+                entry = None
+            if entry is None:
+                return None
+            self._items.move_to_end(key)
+            self.counters['hits'] += 1
+            self.counters['bytes_saved'] += entry[1]
+            return entry[0]
+
+    def put(self, key, frames):
+        size = sum(len(f) for f in frames)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self._drop(key)
+            self._items[key] = (frames, size, time.monotonic())
+            self._bytes += size
+            self.counters['stores'] += 1
+            while len(self._items) > self.max_entries or self._bytes > self.max_bytes:
+                self._drop(next(iter(self._items)))
+                self.counters['evictions'] += 1
+
+    def _drop(self, key):
+        _frames, size, _stored_at = self._items.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats.update({
+                'enabled': RESPONSE_CACHE_CONFIG["enabled"],
+                'entries': len(self._items),
+                'bytes': self._bytes,
+            })
+        lookups = stats['lookups']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+cache = ResponseCache(
+    RESPONSE_CACHE_CONFIG["ttl"],
+    RESPONSE_CACHE_CONFIG["max_entries"],
+    RESPONSE_CACHE_CONFIG["max_bytes"],
+)
+
+
+def _finished(frames):
+    return bool(frames) and frames[-1].endswith(DONE_FRAME)
+
+
+def stream_with_cache(payload, produce):
+    """Replay a cached response for payload, or stream produce() and cache it."""
+    if not RESPONSE_CACHE_CONFIG["enabled"]:
+        yield from produce()
+        return
+
+    key = payload_key(payload)
+    cached = cache.get(key)
+    if cached is not None:
+        yield from cached
+        return
+
+    recorded = []
+    for frame in produce():
+        recorded.append(_as_bytes(frame))
+        yield frame
+    if _finished(recorded):
+        cache.put(key, recorded)
+
+
+async def astream_with_cache(payload, produce):
+    """Async twin of stream_with_cache; produce() returns an async iterator."""
+    if not RESPONSE_CACHE_CONFIG["enabled"]:
+        async for frame in produce():
+            yield frame
+        return
+
+    key = payload_key(payload)
+    cached = cache.get(key)
+    if cached is not None:
+        for frame in cached:
+            yield frame
+        return
+
+    recorded = []
+    async for frame in produce():
+        recorded.append(_as_bytes(frame))
+        yield frame
+    if _finished(recorded):
+        cache.put(key, recorded)
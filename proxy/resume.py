@@ -0,0 +1,454 @@
+"""
+Resumable chat streams: numbered frames, a replay buffer and a grace period.
+
+When the browser's connection dropped mid-reply, the partial reply was
+lost and the retry paid for a whole new generation. Now every /api/chat
+stream gets a random stream id (X-Stream-Id header) and the last event
+of each relayed frame carries an SSE `id:` line numbering the frames so
+far, which costs one short line per frame:
+
+    data: {"choices": [...]}\\n
+    id: 41\\n\\n
+
+Frames are kept in a per-stream replay buffer of at most
+RESUME_BUFFER_BYTES (the oldest are dropped beyond that).
+`GET /api/chat/<stream_id>` with `Last-Event-ID: 41` replays frame 42
+onward and then follows the live stream. The answer is 404
+`stream_not_found` when the stream is unknown or expired, and 410
+`replay_unavailable` when the buffer no longer holds the next frame. A
+reader that falls so far behind the live stream that its next frame is
+dropped gets an error event with code `replay_unavailable` instead of
+a silently truncated reply.
+
+A client disconnect does not close the upstream request. It keeps being
+read into the buffer, and if nobody reattaches within RESUME_GRACE
+seconds the upstream is closed and the buffer released. The stream
+takes over the request's admission ticket, so the upstream read keeps
+its slot until it finishes or is closed, not just while a client is
+attached; a client reattaching to it meanwhile is not admitted again (its
+own stream would count against it). A finished
+stream stays replayable for RESUME_GRACE seconds. At most
+RESUME_MAX_STREAMS streams are tracked; beyond that finished ones are
+evicted first, and a stream that does not fit is served without ids.
+
+Threaded servers read upstream from the client's own thread while one is
+attached, and from a background thread only after it has gone. The async
+server reads upstream from a pump task, so a cancelled request never
+interrupts it. On Vercel an instance does no work between requests, so
+resuming is off there by default.
+"""
+import os
+import threading
+import time
+
+from proxy import metrics
+from proxy.sse import sse_event
+
+RESUME_CONFIG = {
+    "enabled": os.getenv("RESUME_STREAMS", "false" if os.getenv("VERCEL") else "true").lower() == "true",
+    "buffer_bytes": int(os.getenv("RESUME_BUFFER_BYTES", str(8 * 1024 * 1024))),
+    "grace": float(os.getenv("RESUME_GRACE", "60")),
+    "max_streams": int(os.getenv("RESUME_MAX_STREAMS", "256")),
+}
+
+EVENTS = metrics.Counter('fakeclippy_resumable_stream_events_total',
+                         'Resumable stream lifecycle: started, detached, resumed, not_found, unavailable, '
+                         'aborted (nobody reattached in time), expired, untracked', ('event',))
+
+_counters_lock = threading.Lock()
+counters = {'started': 0, 'detached': 0, 'resumed': 0, 'not_found': 0, 'unavailable': 0, 'aborted': 0,
+            'expired': 0, 'untracked': 0}
+
+
+def _count(name):
+    with _counters_lock:
+        counters[name] += 1
+    EVENTS.inc(labels=(name,))
+
+
+class StreamNotFound(Exception):
+    pass
+
+
+class ReplayUnavailable(Exception):
+    pass
+
+
+def parse_event_id(value):
+    """Frames the client has (its Last-Event-ID); ValueError if malformed."""
+    if value is None or value == '':
+        return 0
+    if not value.isdigit():
+        raise ValueError(f'Invalid Last-Event-ID: {value!r}')
+    return int(value)
+
+
+def _bytes(frame):
+    return frame.encode('utf-8') if isinstance(frame, str) else frame
+
+
+def _tag(frame, number):
+    # On the frame's last event rather than an event of its own
+    if frame.endswith(b'\n\n'):
+        return frame[:-1] + b'id: %d\n\n' % number
+    return frame + b'id: %d\n\n' % number
+
+
+def _behind(position):
+    """The event ending a reader whose next frame was dropped from the buffer."""
+    _count('unavailable')
+    event = sse_event({'error': 'The reply could not be relayed in full, please retry',
+                       'code': 'replay_unavailable'})
+    # Numbered like the last frame the reader has, so clients hand it on
+    return _tag(_bytes(event), position)
+
+
+def _release(ticket):
+    if ticket is not None:
+        ticket.release()
+
+
+class _Replay:
+    """Frames of one stream, numbered from 1, trimmed from the front at max_bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.frames = []
+        self.base = 0  # frames before frames[0] that were dropped
+        self.size = 0
+        self.done = False
+        self.error = None
+
+    @property
+    def end(self):
+        return self.base + len(self.frames)
+
+    def append(self, frame):
+        self.frames.append(frame)
+        self.size += len(frame)
+        if self.size > self.max_bytes:
+            drop = 0
+            while self.size > self.max_bytes and drop < len(self.frames) - 1:
+                self.size -= len(self.frames[drop])
+                drop += 1
+            del self.frames[:drop]
+            self.base += drop
+
+    def check(self, position):
+        if position < self.base or position > self.end:
+            raise ReplayUnavailable(f'Frames after {position} are no longer buffered')
+
+
+class ResumableStream:
+    """A chat stream that outlives its client's connection, for threaded servers."""
+
+    def __init__(self, stream_id, source, max_bytes, grace, ticket=None):
+        self.id = stream_id
+        self.source = source
+        self.grace = grace
+        self.ticket = ticket
+        self.replay = _Replay(max_bytes)
+        self.condition = threading.Condition()
+        self.reading = False
+        self.pumping = False
+        self.aborted = False
+        self.subscribers = 0
+        self.detached_at = time.monotonic()
+        self.expires = None
+
+    def attach(self, position):
+        """(frames, held): frames after `position`, tagged with ids, following the live stream (see resume())."""
+        with self.condition:
+            if self.aborted:
+                raise StreamNotFound(self.id)
+            self.replay.check(position)
+            held = self._holds_ticket()
+        return self._frames(position), held
+
+    def _holds_ticket(self):
+        """Whether the upstream read still holds the admission ticket (lock held)."""
+        return self.ticket is not None and not self.replay.done
+
+    def _frames(self, position):
+        with self.condition:
+            self.subscribers += 1
+            self.detached_at = None
+        try:
+            while True:
+                with self.condition:
+                    while True:
+                        replay = self.replay
+                        behind = position < replay.base
+                        if behind:
+                            frame = None
+                            break
+                        if position < replay.end:
+                            frame = replay.frames[position - replay.base]
+                            break
+                        if replay.done:
+                            if replay.error is not None and not self.aborted:
+                                raise replay.error
+                            return
+                        if not self.reading and not self.pumping:
+                            self.reading = True
+                            frame = None
+                            break
+                        self.condition.wait()
+                if behind:
+                    yield _behind(position)
+                    return
+                if frame is None:
+                    self._read_next()
+                else:
+                    position += 1
+                    yield _tag(frame, position)
+        finally:
+            with self.condition:
+                self.subscribers -= 1
+                detached = self.subscribers == 0 and not self.replay.done
+                if detached:
+                    self.detached_at = time.monotonic()
+                pump = detached and not self.pumping
+                self.pumping = self.pumping or pump
+            if detached:
+                _count('detached')
+            if pump:
+                threading.Thread(target=self._pump, name=f'resume-{self.id[:8]}', daemon=True).start()
+
+    def _read_next(self):
+        try:
+            frame = next(self.source)
+        except StopIteration:
+            frame, done, error = None, True, None
+        except Exception as e:
+            frame, done, error = None, True, e
+        else:
+            done, error = False, None
+        with self.condition:
+            if frame is not None:
+                self.replay.append(_bytes(frame))
+            if done:
+                self.replay.done = True
+                self.replay.error = error
+                self.expires = time.monotonic() + self.grace
+            self.reading = False
+            self.condition.notify_all()
+        if done:
+            _release(self.ticket)
+
+    def _pump(self):
+        """Keep reading upstream while no client is attached, until done or the grace period ends."""
+        while True:
+            with self.condition:
+                while self.reading:
+                    self.condition.wait()
+                if self.replay.done:
+                    return
+                if self.subscribers == 0 and time.monotonic() - self.detached_at > self.grace:
+                    break
+                self.reading = True
+            self._read_next()
+        self.abort()
+
+    def abort(self):
+        """Close the upstream unless it is attached or being read; returns whether it was closed."""
+        with self.condition:
+            if self.reading or self.replay.done or self.subscribers:
+                return False
+            self.aborted = True
+            self.replay.done = True
+            self.expires = time.monotonic()
+            self.condition.notify_all()
+        _count('aborted')
+        self.source.close()
+        _release(self.ticket)
+        return True
+
+    def expired(self, now):
+        """Whether the registry should forget this stream (aborting it if it was never read)."""
+        if self.expires is not None:
+            return now >= self.expires
+        if self.subscribers == 0 and not self.pumping and now - self.detached_at > self.grace:
+            return self.abort()
+        return False
+
+
+class AsyncResumableStream:
+    """Async counterpart of ResumableStream; a pump task reads upstream from the start."""
+
+    def __init__(self, stream_id, source, max_bytes, grace, ticket=None):
+        # Imported here so the WSGI entry points do not load asyncio at startup
+        import asyncio
+
+        self.id = stream_id
+        self.source = source
+        self.grace = grace
+        self.ticket = ticket
+        self.replay = _Replay(max_bytes)
+        self.loop = asyncio.get_running_loop()
+        self.condition = asyncio.Condition()
+        self.aborted = False
+        self.subscribers = 0
+        self.detached_at = time.monotonic()
+        self.expires = None
+        self.pump_task = self.loop.create_task(self._pump())
+        self.loop.call_later(grace, self._check)
+
+    async def _pump(self):
+        error = None
+        try:
+            async for frame in self.source:
+                async with self.condition:
+                    self.replay.append(_bytes(frame))
+                    self.condition.notify_all()
+        except Exception as e:  # not CancelledError, which propagates
+            error = e
+        finally:
+            self.replay.done = True
+            self.replay.error = error
+            self.expires = time.monotonic() + (0 if self.aborted else self.grace)
+            _release(self.ticket)
+            async with self.condition:
+                self.condition.notify_all()
+
+    def _check(self):
+        if self.subscribers == 0 and not self.replay.done and time.monotonic() - self.detached_at >= self.grace:
+            self.aborted = True
+            _count('aborted')
+            # Cancelling the read closes the upstream response
+            self.pump_task.cancel()
+
+    def attach(self, position):
+        if self.aborted:
+            raise StreamNotFound(self.id)
+        self.replay.check(position)
+        return self._frames(position), self.ticket is not None and not self.replay.done
+
+    async def _frames(self, position):
+        self.subscribers += 1
+        self.detached_at = None
+        try:
+            while True:
+                async with self.condition:
+                    while position >= self.replay.end and not self.replay.done:
+                        await self.condition.wait()
+                replay = self.replay
+                if position < replay.base:
+                    yield _behind(position)
+                    return
+                if position >= replay.end:
+                    if replay.error is not None:
+                        raise replay.error
+                    return
+                frame = replay.frames[position - replay.base]
+                position += 1
+                yield _tag(frame, position)
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.replay.done:
+                self.detached_at = time.monotonic()
+                _count('detached')
+                self.loop.call_later(self.grace, self._check)
+
+    def expired(self, now):
+        return self.expires is not None and now >= self.expires
+
+
+_streams = {}
+_async_streams = {}
+_streams_lock = threading.Lock()
+
+
+def _register(registry, stream_class, source, ticket):
+    """Return the new stream, or None if RESUME_MAX_STREAMS are tracked and all still running."""
+    now = time.monotonic()
+    with _streams_lock:
+        _sweep(registry, now)
+        if len(registry) >= RESUME_CONFIG["max_streams"]:
+            finished = [s for s in registry.values() if s.expires is not None]
+            if not finished:
+                return None
+            del registry[min(finished, key=lambda s: s.expires).id]
+        stream = stream_class(os.urandom(16).hex(), source, RESUME_CONFIG["buffer_bytes"], RESUME_CONFIG["grace"],
+                              ticket.transfer() if ticket is not None else None)
+        registry[stream.id] = stream
+    _count('started')
+    return stream
+
+
+def _sweep(registry, now):
+    """Forget expired streams (lock held)."""
+    for stream_id, stream in list(registry.items()):
+        if stream.expired(now):
+            del registry[stream_id]
+            if not stream.aborted:
+                _count('expired')
+
+
+def _lookup(registry, stream_id, position):
+    with _streams_lock:
+        _sweep(registry, time.monotonic())
+        stream = registry.get(stream_id)
+    if stream is None:
+        _count('not_found')
+        raise StreamNotFound(stream_id)
+    try:
+        attached = stream.attach(position)
+    except ReplayUnavailable:
+        _count('unavailable')
+        raise
+    _count('resumed')
+    return attached
+
+
+def resumable(frames, ticket=None):
+    """
+    Return (stream_id, frames) for a new chat stream; stream_id is None when not resumable.
+
+    A resumable stream takes over the admission ticket and releases it
+    once the upstream is done; releasing the caller's ticket does nothing.
+    """
+    if not RESUME_CONFIG["enabled"]:
+        return None, frames
+    stream = _register(_streams, ResumableStream, iter(frames), ticket)
+    if stream is None:
+        _count('untracked')
+        return None, frames
+    return stream.id, stream.attach(0)[0]
+
+
+def aresumable(frames, ticket=None):
+    """Async twin of resumable; call from a coroutine, frames is an async iterator."""
+    if not RESUME_CONFIG["enabled"]:
+        return None, frames
+    stream = _register(_async_streams, AsyncResumableStream, frames, ticket)
+    if stream is None:
+        _count('untracked')
+        return None, frames
+    return stream.id, stream.attach(0)[0]
+
+
+def resume(stream_id, last_event_id):
+    """
+    (frames, held) for the frames after last_event_id of a stream; StreamNotFound or ReplayUnavailable.
+
+    held is True while the stream's upstream read holds its admission
+    ticket, in which case the reconnect needs no ticket of its own.
+    """
+    return _lookup(_streams, stream_id, last_event_id)
+
+
+def aresume(stream_id, last_event_id):
+    return _lookup(_async_streams, stream_id, last_event_id)
+
+
+def stats():
+    with _counters_lock:
+        stats = dict(counters)
+    with _streams_lock:
+        streams = list(_streams.values()) + list(_async_streams.values())
+    stats['tracked'] = len(streams)
+    stats['detached_now'] = sum(1 for s in streams if s.subscribers == 0 and not s.replay.done)
+    stats['buffered_bytes'] = sum(s.replay.size for s in streams)
+    stats['enabled'] = RESUME_CONFIG["enabled"]
+    return stats
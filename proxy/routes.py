@@ -0,0 +1,324 @@
+"""
+Auxiliary /api routes shared by the Flask apps in server.py and api/index.py.
+
+/api/chat itself stays in each entry point; everything that only reports
+on or manages proxy state lives here so both apps expose the same set.
+"""
+import time
+from urllib.parse import unquote
+
+from flask import Blueprint, Response, jsonify, request
+
+from proxy import admission, blobs, coalesce, context, metrics, requestlog, resume, routing, upstream, wire
+from proxy.conversations import get_store, valid_conversation_id
+from proxy.response_cache import cache as response_cache
+
+api = Blueprint('proxy_api', __name__)
+
+
+def conversation_not_found():
+    return jsonify({'error': 'Conversation not found', 'code': 'conversation_not_found'}), 404
+
+
+def blobs_missing(e):
+    return jsonify({'error': 'Attachment not found', 'code': 'blob_not_found', 'handles': e.handles}), 409
+
+
+def admission_rejected(e):
+    return jsonify(e.body()), e.status, e.headers()
+
+
+@api.route('/api/chat/<stream_id>', methods=['GET'])
+def resume_chat(stream_id):
+    started = time.perf_counter()
+    trace = requestlog.start(requestlog.request_id(request.headers.get('X-Request-Id')))
+    try:
+        position = resume.parse_event_id(request.headers.get('Last-Event-ID', request.args.get('last_event_id')))
+    except ValueError as e:
+        trace.fail(str(e))
+        trace.finish(400, 'bad_request')
+        return jsonify({'error': str(e)}), 400
+    try:
+        frames, held = resume.resume(stream_id, position)
+    except resume.StreamNotFound:
+        trace.finish(404, 'stream_not_found')
+        return jsonify({'error': 'Stream not found', 'code': 'stream_not_found'}), 404
+    except resume.ReplayUnavailable as e:
+        trace.finish(410, 'replay_unavailable')
+        return jsonify({'error': str(e), 'code': 'replay_unavailable'}), 410
+
+    client = admission.client_key(request.remote_addr, request.headers.get('X-Forwarded-For'))
+    trace.event('chat_resume', stream_id=stream_id, last_event_id=position, client=client)
+    ticket = None
+    if not held:
+        # A stream still reading upstream keeps its own slot, so only a
+        # replay of a finished one is admitted
+        try:
+            ticket = admission.get_controller().admit(client)
+        except admission.Rejected as e:
+            trace.finish(e.status, 'rejected', reason=e.reason)
+            return admission_rejected(e)
+    headers = {'Cache-Control': 'no-cache', 'X-Stream-Id': stream_id, 'X-Request-Id': trace.request_id}
+    encoding = wire.negotiate(request.headers.get('Accept-Encoding'))
+    if encoding:
+        frames = wire.compress_stream(frames, encoding)
+        headers.update(wire.compression_headers(encoding))
+    frames = requestlog.TracedStream(metrics.instrument_stream(frames, started), trace)
+    if ticket is not None:
+        frames = admission.AdmittedStream(frames, ticket)
+    return Response(frames, content_type='text/plain', headers=headers)
+
+
+@api.route('/api/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@api.route('/api/upstream/stats', methods=['GET'])
+def upstream_stats():
+    return jsonify({
+        'pools': upstream.pool_stats(),
+        'coalescing': coalesce.stats(),
+        'routing': routing.stats(),
+        'admission': admission.get_controller().stats(),
+        'resume': resume.stats(),
+    })
+
+
+@api.route('/api/cache', methods=['GET'])
+def response_cache_stats():
+    return jsonify(response_cache.stats())
+
+
+@api.route('/api/logs', methods=['GET'])
+def request_log_stats():
+    return jsonify(requestlog.stats())
+
+
+@api.route('/api/context', methods=['GET'])
+def context_stats():
+    return jsonify(context.stats())
+
+
+@api.route('/api/conversations', methods=['GET'])
+def conversation_stats():
+    return jsonify(get_store().stats())
+
+
+@api.route('/api/conversations/<conversation_id>', methods=['GET'])
+def get_conversation(conversation_id):
+    messages = get_store().get(conversation_id) if valid_conversation_id(conversation_id) else None
+    if messages is None:
+        return conversation_not_found()
+    return jsonify({'conversation_id': conversation_id, 'messages': messages})
+
+
+@api.route('/api/conversations/<conversation_id>', methods=['DELETE'])
+def delete_conversation(conversation_id):
+    if not valid_conversation_id(conversation_id) or not get_store().delete(conversation_id):
+        return conversation_not_found()
+    from proxy import preview
+
+    preview.get_store().discard(conversation_id)
+    return jsonify({'deleted': conversation_id})
+
+
+@api.route('/api/preview', methods=['POST'])
+def update_preview():
+    # Imported on first use, like attachments: the HTML parser and differ are not needed to chat
+    from proxy import preview
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {}
+    conversation_id = data.get('conversation_id')
+    messages = get_store().get(conversation_id) if valid_conversation_id(conversation_id) else None
+    if messages is None:
+        return conversation_not_found()
+    status, body = preview.preview_reply(conversation_id, messages, data)
+    return jsonify(body), status
+
+
+@api.route('/api/preview', methods=['GET'])
+def preview_stats():
+    from proxy import preview
+
+    return jsonify(preview.get_store().stats())
+
+
+@api.route('/api/preview/<conversation_id>', methods=['GET'])
+def get_preview(conversation_id):
+    from proxy import preview
+
+    document = preview.get_store().document(conversation_id) if valid_conversation_id(conversation_id) else None
+    if document is None:
+        return jsonify({'error': 'Preview not found', 'code': 'preview_not_found'}), 404
+    return jsonify(document)
+
+
+@api.route('/api/blobs', methods=['POST'])
+def upload_blob():
+    upload = request.files.get('file')
+    if upload is not None:
+        data = upload.read()
+        content_type = upload.mimetype
+        name = upload.filename
+    else:
+        data = request.get_data(cache=False)
+        content_type = request.content_type
+        name = request.headers.get('X-Blob-Name')
+    try:
+        meta, deduplicated = blobs.get_store().put(data, content_type, name)
+    except blobs.BlobTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    return jsonify({
+        'handle': meta['handle'],
+        'marker': blobs.marker(meta['handle']),
+        'size': meta['size'],
+        'content_type': meta['content_type'],
+        'deduplicated': deduplicated,
+    })
+
+
+@api.route('/api/attachments', methods=['POST'])
+def upload_attachment():
+    # Imported on first use: Pillow and multiprocessing would slow every cold start
+    from proxy import attachments
+
+    upload = request.files.get('file')
+    if upload is not None:
+        data = upload.read()
+        content_type = upload.mimetype
+        name = upload.filename
+    else:
+        data = request.get_data(cache=False)
+        content_type = request.content_type
+        name = unquote(request.headers.get('X-Blob-Name', '')) or None
+    try:
+        return jsonify(attachments.get_processor().process(data, content_type, name))
+    except blobs.BlobTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    except attachments.AttachmentsBusy as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '2'}
+
+
+@api.route('/api/attachments', methods=['GET'])
+def attachment_stats():
+    from proxy import attachments
+
+    return jsonify(attachments.get_processor().stats())
+
+
+@api.route('/api/blobs', methods=['GET'])
+def blob_stats():
+    return jsonify(blobs.get_store().stats())
+
+
+@api.route('/api/blobs/<handle>', methods=['GET'])
+def get_blob(handle):
+    store = blobs.get_store()
+    meta = store.get_meta(handle) if blobs.valid_handle(handle) else None
+    if meta is None:
+        return jsonify({'error': 'Attachment not found', 'code': 'blob_not_found', 'handles': [handle]}), 404
+    # Content-addressed, so a handle's bytes never change
+    headers = {'ETag': f'"{handle}"', 'Cache-Control': 'public, max-age=31536000, immutable'}
+    if request.if_none_match.contains(handle):
+        return Response(status=304, headers=headers)
+    body = b'' if request.method == 'HEAD' else store.read(handle)
+    response = Response(body, content_type=meta['content_type'], headers=headers)
+    if request.method == 'HEAD':
+        response.content_length = meta['size']
+    return response
+
+
+def start_batch(api_config):
+    """POST /api/batch, which needs the entry point's API config like /api/chat."""
+    # Imported on first use: batch jobs are not part of the chat path
+    from proxy import batch
+
+    trace = requestlog.start(requestlog.request_id(request.headers.get('X-Request-Id')))
+    client = admission.client_key(request.remote_addr, request.headers.get('X-Forwarded-For'))
+    try:
+        ticket = admission.get_controller().admit(client)
+    except admission.Rejected as e:
+        trace.finish(e.status, 'rejected', reason=e.reason)
+        return admission_rejected(e)
+    try:
+        # Each slide request takes its own ticket; the job's was charged to the client already
+        job = batch.start_job(api_config, request.get_json(silent=True), trace,
+                              admit=lambda: admission.get_controller().admit(client, charge=False))
+    except ValueError as e:
+        trace.fail(str(e))
+        trace.finish(400, 'bad_request')
+        return jsonify({'error': str(e)}), 400
+    except blobs.BlobsMissing as e:
+        trace.finish(409, 'blob_not_found')
+        return blobs_missing(e)
+    finally:
+        # The progress stream holds no upstream connection; holding a slot
+        # for it could leave the job's own slides waiting behind it
+        ticket.release()
+    headers = {'Cache-Control': 'no-cache', 'X-Job-Id': job.id, 'X-Request-Id': trace.request_id}
+    return Response(job.frames(), content_type='text/plain', headers=headers)
+
+
+@api.route('/api/batch', methods=['GET'])
+def batch_stats():
+    from proxy import batch
+
+    return jsonify(batch.stats())
+
+
+@api.route('/api/batch/<job_id>', methods=['GET'])
+def get_batch_job(job_id):
+    from proxy import batch
+
+    try:
+        return jsonify(batch.get_store().get(job_id))
+    except batch.JobNotFound:
+        return jsonify({'error': 'Job not found', 'code': 'job_not_found'}), 404
+
+
+@api.route('/api/templates', methods=['GET'])
+def template_stats():
+    # Imported on first use: building the digests parses every template
+    from proxy import templates
+
+    return jsonify(templates.get_digests().stats())
+
+
+@api.route('/api/templates/<name>', methods=['GET'])
+def get_template_digest(name):
+    from proxy import templates
+
+    try:
+        digest = templates.get_digests().get(name)
+    except templates.TemplateNotFound:
+        return jsonify({'error': 'Template not found', 'code': 'template_not_found'}), 404
+    headers = {'ETag': f'"{digest.etag}"', 'Cache-Control': 'no-cache'}
+    if request.if_none_match.contains(digest.etag):
+        return Response(status=304, headers=headers)
+    return Response(digest.html, content_type='text/html; charset=utf-8', headers=headers)
+
+
+@api.route('/api/profile', methods=['POST'])
+def run_profile():
+    # Imported on first use, so the profiler costs nothing until it is asked for
+    from proxy import profiler
+
+    try:
+        profiler.authorize(request.headers.get('Authorization'))
+    except profiler.ProfilerDisabled:
+        return jsonify({'error': 'Not found'}), 404
+    except profiler.NotAuthorized:
+        return jsonify({'error': 'Forbidden', 'code': 'forbidden'}), 403
+    try:
+        seconds, interval, output = profiler.parse_options(request.args)
+        result = profiler.profile(seconds, interval)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except profiler.ProfileRunning:
+        return jsonify({'error': 'A profile is already running', 'code': 'profile_running'}), 409
+    if output == 'collapsed':
+        return Response(result.collapsed(), content_type='text/plain; charset=utf-8')
+    return jsonify(result.report())
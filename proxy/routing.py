@@ -0,0 +1,253 @@
+"""
+Routing across several OpenAI-compatible upstreams.
+
+By default the proxy talks to the single CLAUDE_BASE_URL/CLAUDE_MODEL.
+UPSTREAMS takes a JSON list of extra or replacement backends:
+
+    UPSTREAMS='[{"base_url": "https://a.example/v1", "weight": 3},
+                {"base_url": "https://b.example/v1", "api_key": "...", "model": "...", "weight": 1}]'
+
+Missing api_key/model fields fall back to the CLAUDE_* settings. Each
+request picks its primary upstream at random, in proportion to weight
+divided by the upstream's observed time to first token (an EWMA). Faster
+backends therefore get more traffic without starving the others of the
+samples they need.
+
+With UPSTREAM_HEDGE=true, the proxy sends a second request to the next
+best upstream if the first byte has not arrived by the primary's
+UPSTREAM_HEDGE_PERCENTILE time to first token. Whichever answers first is
+relayed and the other is cancelled. Requests that fail before the first
+byte fail over to the next upstream.
+
+Each upstream has a circuit breaker. After UPSTREAM_BREAKER_FAILURES
+consecutive failures it stops receiving traffic for
+UPSTREAM_BREAKER_COOLDOWN seconds. After that a single probe request
+decides whether it closes again. Only connection errors, timeouts, 429
+and 5xx answers count as failures and fail over to the next upstream;
+any other status is the request's fault and goes straight back to the
+client.
+"""
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+
+ROUTING_CONFIG = {
+    "upstreams": os.getenv("UPSTREAMS", ""),
+    "hedge": os.getenv("UPSTREAM_HEDGE", "false").lower() == "true",
+    "hedge_percentile": float(os.getenv("UPSTREAM_HEDGE_PERCENTILE", "95")),
+    # Used until an upstream has enough samples for a percentile
+    "hedge_delay": float(os.getenv("UPSTREAM_HEDGE_DELAY", "2.0")),
+    "hedge_min_delay": float(os.getenv("UPSTREAM_HEDGE_MIN_DELAY", "0.25")),
+    "breaker_failures": int(os.getenv("UPSTREAM_BREAKER_FAILURES", "5")),
+    "breaker_cooldown": float(os.getenv("UPSTREAM_BREAKER_COOLDOWN", "30")),
+}
+
+# Samples kept per upstream for the hedge percentile, and the minimum needed
+TTFT_WINDOW = 200
+TTFT_MIN_SAMPLES = 10
+EWMA_ALPHA = 0.2
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def retryable_status(status):
+    """Whether an upstream answer may succeed elsewhere (and counts against the breaker)."""
+    return status == 429 or status >= 500
+
+
+class CircuitBreaker:
+    """
+    closed -> open after N consecutive failures -> half_open probe after the cooldown.
+
+    available() only looks; a request claims its way through with
+    acquire_probe() when it is actually sent.
+    """
+
+    def __init__(self, failures, cooldown):
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def available(self):
+        """Whether a request could be sent now; changes nothing."""
+        if self.threshold <= 0:
+            return True
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open':
+                return time.monotonic() - self.opened_at >= self.cooldown
+            return not self.probing
+
+    def acquire_probe(self):
+        """
+        Admit a request that is about to be sent.
+
+        Returns None if the breaker refuses it, 'probe' if it took the
+        single half-open probe (settled by success(), failure() or
+        release_probe()), and 'closed' otherwise.
+        """
+        if self.threshold <= 0:
+            return 'closed'
+        with self._lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = 'half_open'
+                self.probing = False
+            if self.state == 'closed':
+                return 'closed'
+            if self.state == 'half_open' and not self.probing:
+                self.probing = True
+                return 'probe'
+            return None
+
+    def release_probe(self):
+        """Give the probe back when its request ended without a verdict on the upstream."""
+        with self._lock:
+            if self.state == 'half_open':
+                self.probing = False
+
+    def success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self.probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == 'half_open' or (self.threshold > 0 and self.failures >= self.threshold):
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+
+class Upstream:
+    def __init__(self, base_url, api_key, model, weight=1.0, name=None):
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.model = model
+        self.weight = float(weight)
+        self.name = name or self.base_url
+        self.breaker = CircuitBreaker(ROUTING_CONFIG["breaker_failures"], ROUTING_CONFIG["breaker_cooldown"])
+        self.ttft_samples = deque(maxlen=TTFT_WINDOW)
+        self.ttft_ewma = None
+        self.counters = {'requests': 0, 'failures': 0, 'hedges': 0, 'hedge_wins': 0}
+
+    def payload_for(self, payload):
+        if not self.model or payload.get('model') == self.model:
+            return payload
+        return dict(payload, model=self.model)
+
+    def observe_ttft(self, seconds):
+        self.ttft_samples.append(seconds)
+        self.ttft_ewma = seconds if self.ttft_ewma is None else (
+            EWMA_ALPHA * seconds + (1 - EWMA_ALPHA) * self.ttft_ewma)
+
+    def record_first_byte(self, seconds):
+        self.observe_ttft(seconds)
+        self.breaker.success()
+
+    def record_failure(self):
+        self.counters['failures'] += 1
+        self.breaker.failure()
+
+    def stats(self):
+        samples = list(self.ttft_samples)
+        return {
+            'name': self.name,
+            'base_url': self.base_url,
+            'model': self.model,
+            'weight': self.weight,
+            'breaker': self.breaker.state,
+            'ttft_ewma_ms': round(self.ttft_ewma * 1000, 1) if self.ttft_ewma is not None else None,
+            'ttft_p50_ms': round(percentile(samples, 50) * 1000, 1),
+            'ttft_p95_ms': round(percentile(samples, 95) * 1000, 1),
+            **self.counters,
+        }
+
+
+class Router:
+    def __init__(self, upstreams, rng=None):
+        self.upstreams = upstreams
+        self.rng = rng or random.Random()
+
+    def _score(self, upstream, default_ttft):
+        return upstream.weight / max(upstream.ttft_ewma or default_ttft, 0.001)
+
+    def candidates(self):
+        """Upstreams to try, primary first; upstreams with an open breaker are left out."""
+        available = [u for u in self.upstreams if u.breaker.available()]
+        if len(available) < 2:
+            return available
+        observed = [u.ttft_ewma for u in available if u.ttft_ewma is not None]
+        # Unmeasured upstreams are assumed to be as fast as the best one
+        default_ttft = min(observed) if observed else 1.0
+        scores = [self._score(u, default_ttft) for u in available]
+        primary = self.rng.choices(range(len(available)), weights=scores)[0]
+        rest = sorted((i for i in range(len(available)) if i != primary), key=lambda i: -scores[i])
+        return [available[primary]] + [available[i] for i in rest]
+
+    def hedging(self, candidates):
+        return ROUTING_CONFIG["hedge"] and len(candidates) > 1
+
+    def hedge_delay(self, upstream):
+        samples = list(upstream.ttft_samples)
+        if len(samples) < TTFT_MIN_SAMPLES:
+            delay = ROUTING_CONFIG["hedge_delay"]
+        else:
+            delay = percentile(samples, ROUTING_CONFIG["hedge_percentile"])
+        return max(delay, ROUTING_CONFIG["hedge_min_delay"])
+
+    def stats(self):
+        return {
+            'hedge': ROUTING_CONFIG["hedge"],
+            'upstreams': [u.stats() for u in self.upstreams],
+        }
+
+
+def load_upstreams(api_config):
+    """Build the upstream list from UPSTREAMS, or from api_config alone."""
+    if not ROUTING_CONFIG["upstreams"].strip():
+        return [Upstream(api_config["base_url"], api_config["api_key"], api_config["model"])]
+    upstreams = []
+    for entry in json.loads(ROUTING_CONFIG["upstreams"]):
+        upstreams.append(Upstream(
+            entry["base_url"],
+            entry.get("api_key") or api_config["api_key"],
+            entry.get("model") or api_config["model"],
+            entry.get("weight", 1.0),
+            entry.get("name"),
+        ))
+    return upstreams
+
+
+_routers = {}
+_routers_lock = threading.Lock()
+
+
+def get_router(api_config):
+    """Return the process-wide router for api_config."""
+    key = (api_config["base_url"], api_config["api_key"], api_config["model"])
+    router = _routers.get(key)
+    if router is None:
+        with _routers_lock:
+            router = _routers.get(key)
+            if router is None:
+                router = _routers[key] = Router(load_upstreams(api_config))
+    return router
+
+
+def stats():
+    return [router.stats() for router in list(_routers.values())]
@@ -0,0 +1,348 @@
+"""
+Incremental text/HTML segmentation of chat replies.
+
+The browser used to re-run its HTML detection regexes over the whole
+accumulated reply after every delta, which is quadratic in the reply
+length. A request with `"stream_format": "segments"` instead gets the
+reply as typed events that the client only has to append:
+
+    data: {"type": "text", "offset": 0, "text": "Here is your slide:\\n\\n"}
+    data: {"type": "html_start", "offset": 20, "block": 0, "kind": "fence", "marker": "```html\\n"}
+    data: {"type": "html_chunk", "offset": 28, "block": 0, "html": "<!DOCTYPE html>..."}
+    data: {"type": "html_end", "offset": 9120, "block": 0, "complete": true, "marker": "```"}
+    data: {"done": true}
+
+`kind` is `fence` for a ```html code block, `document` for a bare
+<!DOCTYPE>/<html> document and `fragment` for a bare top-level element
+(div, section, table, ...). Offsets count UTF-16 code units into the
+reply, like JavaScript string indices. The text, html and marker strings
+concatenated in event order are exactly the reply. `complete` is false
+when the stream ended inside the block. Error frames pass through
+unchanged.
+
+Segmenter is a single-pass state machine. Each character is scanned a
+bounded number of times: text that might still turn into a fence or tag
+(a trailing `<div` or ``` line) is held back until the next delta decides
+it. Inline code spans and non-HTML code fences are kept as text, so a
+reply that talks about `<div>` is not mistaken for markup.
+"""
+import json
+import re
+
+from proxy.sse import DONE_FRAME, sse_event
+
+# Elements that start a bare HTML fragment, as in the frontend's getCleanMessageForHTML()
+FRAGMENT_TAGS = ('div', 'section', 'article', 'form', 'table', 'style', 'script',
+                 'body', 'head', 'nav', 'header', 'footer')
+HTML_FENCE_LANGUAGES = ('html', 'htm')
+
+TEXT, CODE_SPAN, CODE_FENCE, HTML_FENCE, HTML_DOCUMENT, HTML_FRAGMENT = range(6)
+
+_TEXT_TOKEN = re.compile(
+    r'^[ ]{0,3}(?P<fence>`{3,})(?P<info>[^`\n]*)\n'
+    r'|(?P<span>`+)'
+    r'|<(?P<doctype>!doctype)(?=[\s>])'
+    r'|<(?P<document>html)(?=[\s>])'
+    r'|<(?P<fragment>' + '|'.join(FRAGMENT_TAGS) + r')(?=[\s>/])',
+    re.IGNORECASE | re.MULTILINE)
+# A last line that may still become a fence: indentation, a short backtick run or an unfinished opener
+_PARTIAL_FENCE = re.compile(r'[ ]{0,3}(?:`{3,}[^`\n]*|`{0,2})\Z')
+_DOCUMENT_END = re.compile(r'</html\s*>', re.IGNORECASE)
+_HTML_FENCE_END = re.compile(r'`{3,}')
+# Longest tag prefix that may be cut off at the end of a delta: "</html   >" or "<!doctype "
+_TAG_LOOKBEHIND = 16
+
+
+def utf16_len(text):
+    return len(text) if text.isascii() else len(text.encode('utf-16-le')) // 2
+
+
+class Segmenter:
+    """
+    Turns reply deltas into segment events.
+
+    feed() returns the events completed by a delta; close() flushes what is
+    held back at the end of the stream.
+    """
+
+    def __init__(self):
+        # buf[pos - 1] is the last consumed character, kept so that `^`
+        # still knows whether buf[pos] starts a line
+        self.buf = '\n'
+        self.pos = 1
+        self.offset = 0
+        self.state = TEXT
+        self.closer = None
+        self.depth = 0
+        self.block = -1
+        self.events = []
+        self._handlers = {
+            TEXT: self._text,
+            CODE_SPAN: self._code_span,
+            CODE_FENCE: self._code_fence,
+            HTML_FENCE: self._html_fence,
+            HTML_DOCUMENT: self._html_document,
+            HTML_FRAGMENT: self._html_fragment,
+        }
+
+    def feed(self, text):
+        self.buf += text
+        self._scan(final=False)
+        return self._take()
+
+    def close(self):
+        self._scan(final=True)
+        if self.state in (HTML_FENCE, HTML_DOCUMENT, HTML_FRAGMENT):
+            self._end_block(complete=False)
+        self.state = TEXT
+        return self._take()
+
+    def _take(self):
+        # Drop everything consumed but the context character
+        self.buf = self.buf[self.pos - 1:]
+        self.pos = 1
+        events, self.events = self.events, []
+        return events
+
+    def _scan(self, final):
+        # Each handler returns True after a state change and False once it needs more input
+        while self.pos < len(self.buf) and self._handlers[self.state](final):
+            pass
+
+    # Emitting
+
+    def _consume(self, end, field):
+        """Emit buf[pos:end] as 'text' or 'html', merging with the previous event."""
+        if end <= self.pos:
+            return
+        piece = self.buf[self.pos:end]
+        if self.events and field in self.events[-1]:
+            self.events[-1][field] += piece
+        elif field == 'text':
+            self.events.append({'type': 'text', 'offset': self.offset, 'text': piece})
+        else:
+            self.events.append({'type': 'html_chunk', 'offset': self.offset, 'block': self.block, 'html': piece})
+        self.offset += utf16_len(piece)
+        self.pos = end
+
+    def _marker(self, end):
+        marker = self.buf[self.pos:end]
+        self.offset += utf16_len(marker)
+        self.pos = end
+        return marker
+
+    def _start_block(self, kind, state, marker_end=None):
+        self.block += 1
+        event = {'type': 'html_start', 'offset': self.offset, 'block': self.block, 'kind': kind}
+        if marker_end is not None:
+            event['marker'] = self._marker(marker_end)
+        self.events.append(event)
+        self.state = state
+
+    def _end_block(self, complete=True, marker_end=None):
+        event = {'type': 'html_end', 'offset': self.offset, 'block': self.block, 'complete': complete}
+        if marker_end is not None:
+            event['marker'] = self._marker(marker_end)
+        self.events.append(event)
+        self.state = TEXT
+
+    def _tag_hold(self, final):
+        """Index from which a tag may still be completed by the next delta."""
+        if final:
+            return len(self.buf)
+        start = self.buf.find('<', max(self.pos, len(self.buf) - _TAG_LOOKBEHIND))
+        return len(self.buf) if start == -1 else start
+
+    def _fence_hold(self, final):
+        """Index of a trailing, still incomplete fence line."""
+        if final:
+            return len(self.buf)
+        line = self.buf.rfind('\n', self.pos - 1) + 1
+        if line >= self.pos and _PARTIAL_FENCE.match(self.buf, line):
+            return line
+        return len(self.buf)
+
+    # States
+
+    def _text(self, final):
+        buf = self.buf
+        m = _TEXT_TOKEN.search(buf, self.pos)
+        if m is None:
+            self._consume(min(self._tag_hold(final), self._fence_hold(final)), 'text')
+            return False
+
+        if m.group('fence'):
+            self._consume(m.start(), 'text')
+            info = m.group('info').strip().lower()
+            if info.split(' ')[0] in HTML_FENCE_LANGUAGES:
+                self._start_block('fence', HTML_FENCE, marker_end=m.end())
+            else:
+                self.closer = re.compile(r'^[ ]{0,3}`{%d,}[ \t]*(?:\n|\Z)' % len(m.group('fence')), re.MULTILINE)
+                self._consume(m.end(), 'text')
+                self.state = CODE_FENCE
+            return True
+
+        if m.group('span'):
+            hold = self._fence_hold(final)
+            if hold <= m.start() or (not final and m.end() == len(buf)):
+                # An unfinished fence line, or a run that may still grow
+                self._consume(min(hold, m.start()), 'text')
+                return False
+            # A span ends at a backtick run of the same length, or at a blank line
+            self.closer = re.compile(r'(?<!`)`{%d}(?!`)|\n[ \t]*\n' % len(m.group('span')))
+            self._consume(m.end(), 'text')
+            self.state = CODE_SPAN
+            return True
+
+        self._consume(m.start(), 'text')
+        if m.group('fragment'):
+            self.closer = re.compile(r'<(/?)%s(?=[\s>/])' % m.group('fragment').lower(), re.IGNORECASE)
+            self.depth = 0
+            self._start_block('fragment', HTML_FRAGMENT)
+        else:
+            self._start_block('document', HTML_DOCUMENT)
+        return True
+
+    def _code_span(self, final):
+        buf = self.buf
+        m = self.closer.search(buf, self.pos)
+        if m is not None and (final or m.end() < len(buf)):
+            self._consume(m.end(), 'text')
+            self.state = TEXT
+            return True
+        hold = len(buf) if final else len(buf.rstrip('` \t\n'))
+        if m is not None:
+            hold = min(hold, m.start())
+        self._consume(hold, 'text')
+        return False
+
+    def _code_fence(self, final):
+        m = self.closer.search(self.buf, self.pos)
+        # Without a newline the closing line may still go on
+        if m is not None and (final or self.buf[m.end() - 1] == '\n'):
+            self._consume(m.end(), 'text')
+            self.state = TEXT
+            return True
+        self._consume(self._fence_hold(final) if m is None else m.start(), 'text')
+        return False
+
+    def _html_fence(self, final):
+        m = _HTML_FENCE_END.search(self.buf, self.pos)
+        if m is not None and (final or m.end() < len(self.buf)):
+            self._consume(m.start(), 'html')
+            self._end_block(marker_end=m.end())
+            return True
+        if m is not None:
+            hold = m.start()
+        elif final:
+            hold = len(self.buf)
+        else:
+            # A trailing "`" or "``" may become the closing fence
+            hold = len(self.buf.rstrip('`'))
+        self._consume(hold, 'html')
+        return False
+
+    def _html_document(self, final):
+        m = _DOCUMENT_END.search(self.buf, self.pos)
+        if m is not None:
+            self._consume(m.end(), 'html')
+            self._end_block()
+            return True
+        self._consume(self._tag_hold(final), 'html')
+        return False
+
+    def _html_fragment(self, final):
+        # Nested elements of the same name are counted, so the block ends at the matching close tag
+        counted = self.pos
+        for m in self.closer.finditer(self.buf, self.pos):
+            if not m.group(1):
+                self.depth += 1
+                counted = m.end()
+                continue
+            if self.depth > 1:
+                self.depth -= 1
+                counted = m.end()
+                continue
+            close = self.buf.find('>', m.end())
+            if close == -1 and not final:
+                # Wait for the rest of the closing tag
+                self._consume(m.start(), 'html')
+                return False
+            self.depth = 0
+            self._consume(len(self.buf) if close == -1 else close + 1, 'html')
+            self._end_block()
+            return True
+        # Tags counted above must not be scanned again
+        self._consume(max(self._tag_hold(final), counted), 'html')
+        return False
+
+
+def _content(payload):
+    """Delta text of an upstream chunk payload, or None for other frames."""
+    try:
+        chunk = json.loads(payload)
+    except ValueError:
+        return None
+    if not isinstance(chunk, dict):
+        return None
+    choices = chunk.get('choices') or []
+    if not choices:
+        return ''
+    return (choices[0].get('delta') or {}).get('content') or ''
+
+
+class _Reframer:
+    """Splits relayed frames into lines and re-frames them as segment events."""
+
+    def __init__(self):
+        self.segmenter = Segmenter()
+        self.pending = b''
+
+    def feed(self, frame):
+        if isinstance(frame, str):
+            frame = frame.encode('utf-8')
+        lines = (self.pending + frame).split(b'\n')
+        self.pending = lines.pop()
+        out = []
+        for line in lines:
+            if not line.startswith(b'data: {'):
+                continue
+            payload = line[6:]
+            content = _content(payload)
+            if content:
+                out.extend(self.segmenter.feed(content))
+            elif payload.startswith((b'{"done"', b'{"error"')):
+                # Finish any open block before the end-of-stream or error frame
+                out.extend(self.segmenter.close())
+                out.append(DONE_FRAME if payload.startswith(b'{"done"') else line + b'\n\n')
+        return self._encode(out)
+
+    def close(self):
+        return self._encode(self.segmenter.close())
+
+    def _encode(self, out):
+        return b''.join(item if isinstance(item, bytes) else sse_event(item).encode('utf-8') for item in out)
+
+
+def segment_stream(frames):
+    """Re-frame a chat stream as segment events."""
+    reframer = _Reframer()
+    for frame in frames:
+        data = reframer.feed(frame)
+        if data:
+            yield data
+    data = reframer.close()
+    if data:
+        yield data
+
+
+async def asegment_stream(frames):
+    """Async twin of segment_stream."""
+    reframer = _Reframer()
+    async for frame in frames:
+        data = reframer.feed(frame)
+        if data:
+            yield data
+    data = reframer.close()
+    if data:
+        yield data
@@ -0,0 +1,347 @@
+"""
+Relaying upstream SSE chat chunks to the browser.
+
+Two relay modes are available:
+
+- reparse: the original behaviour. Every upstream chunk is decoded,
+  json.loads'ed and json.dumps'ed again before it is forwarded.
+- passthrough: upstream `data:` payloads are forwarded byte-for-byte. Only
+  `[DONE]` and error frames are recognised, and all frames that arrive in
+  one network read (or within STREAM_CONFIG["flush_interval"]) are written
+  out together. Held frames are written when the interval runs out even
+  if upstream sends nothing more: with a nonzero interval the upstream is
+  read with a timeout (timed_reads/atimed_reads).
+
+Both modes emit the same framing the frontend expects: `data: {...}\n\n`
+per chunk, `data: {"done": true}\n\n` at the end and
+`data: {"error": "..."}\n\n` on failure.
+"""
+import json
+import os
+import queue
+import threading
+import time
+
+STREAM_CONFIG = {
+    "mode": os.getenv("CHAT_STREAM_MODE", "passthrough"),
+    "chunk_size": int(os.getenv("CHAT_STREAM_CHUNK_SIZE", "16384")),
+    # Seconds to keep coalescing frames before writing them out, at most:
+    # held frames are written when it runs out, without waiting for the
+    # next read. 0 writes once per upstream network read, which never
+    # delays a frame.
+    "flush_interval": float(os.getenv("CHAT_STREAM_FLUSH_INTERVAL", "0")),
+    "flush_bytes": int(os.getenv("CHAT_STREAM_FLUSH_BYTES", "8192")),
+}
+
+DONE_FRAME = b'data: {"done": true}\n\n'
+
+_END = object()
+
+
+def sse_event(obj):
+    return f"data: {json.dumps(obj)}\n\n"
+
+
+def error_event(message):
+    return sse_event({'error': message})
+
+
+def relay_reparse(response):
+    """Yield (frame, done) pairs, re-serialising every chunk."""
+    for line in response.iter_lines():
+        if line:
+            line = line.decode('utf-8')
+            if line.startswith('data: '):
+                data_content = line[6:]  # Remove 'data: ' prefix
+                if data_content.strip() == '[DONE]':
+                    yield sse_event({'done': True}), True
+                    return
+                try:
+                    chunk_data = json.loads(data_content)
+                    yield sse_event(chunk_data), False
+                except json.JSONDecodeError:
+                    continue
+
+
+def _data_payload(line):
+    """Return the payload of a `data:` line, or None for anything else."""
+    if not line.startswith(b'data:'):
+        return None
+    payload = line[5:]
+    if payload[:1] == b' ':
+        payload = payload[1:]
+    return payload.rstrip(b'\r')
+
+
+class FrameScanner:
+    """
+    Incrementally splits raw upstream bytes into browser-ready frames.
+
+    A payload is forwarded when it looks like a JSON object; the frontend
+    does the real parse anyway. Only `[DONE]` and error payloads are
+    inspected, and scanning stops after either.
+    """
+
+    def __init__(self):
+        self.pending = b''
+        self.done = False
+        self.stopped = False
+
+    def feed(self, chunk):
+        """Return the list of frames completed by chunk."""
+        frames = []
+        if self.stopped:
+            return frames
+        lines = (self.pending + chunk).split(b'\n')
+        self.pending = lines.pop()
+
+        for line in lines:
+            payload = _data_payload(line)
+            if not payload:
+                continue
+            if payload.strip() == b'[DONE]':
+                frames.append(DONE_FRAME)
+                self.done = self.stopped = True
+                break
+            if payload[:1] != b'{' or payload[-1:] != b'}':
+                continue
+            frames.append(b'data: ' + payload + b'\n\n')
+            if payload.startswith(b'{"error"'):
+                self.stopped = True
+                break
+        return frames
+
+    def close(self):
+        """Handle a final line that arrived without a trailing newline."""
+        if self.stopped or not self.pending:
+            return []
+        pending, self.pending = self.pending, b''
+        return self.feed(pending + b'\n')
+
+
+class Coalescer:
+    """Decides when buffered frames should be written to the client."""
+
+    def __init__(self, flush_interval=None, flush_bytes=None):
+        self.flush_interval = STREAM_CONFIG["flush_interval"] if flush_interval is None else flush_interval
+        self.flush_bytes = flush_bytes or STREAM_CONFIG["flush_bytes"]
+        self.out = []
+        self.size = 0
+        self.last_flush = time.monotonic()
+
+    def add(self, frames):
+        self.out.extend(frames)
+        self.size += sum(len(f) for f in frames)
+
+    def ready(self):
+        return bool(self.out) and (
+            self.size >= self.flush_bytes
+            or time.monotonic() - self.last_flush >= self.flush_interval
+        )
+
+    def timeout(self):
+        """Seconds until the held frames are due, or None when nothing is held."""
+        if not self.out:
+            return None
+        return max(0.0, self.last_flush + self.flush_interval - time.monotonic())
+
+    def take(self):
+        data = b''.join(self.out)
+        self.out = []
+        self.size = 0
+        self.last_flush = time.monotonic()
+        return data
+
+
+def timed_reads(iterable, timeout):
+    """
+    Yield the items of iterable, and None whenever timeout() seconds pass without one.
+
+    timeout() is asked before every wait and returns None to wait for the
+    next item however long it takes. The items are read by a helper thread,
+    at most one ahead. Closing this generator waits for the helper's read
+    in flight to return and for the helper to close the iterable, so the
+    caller may release or close what it reads from (an upstream response)
+    without another thread still using it.
+    """
+    items = queue.Queue(maxsize=1)
+    closed = threading.Event()
+
+    def put(entry):
+        while not closed.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put((item, None)):
+                    break
+            else:
+                put((_END, None))
+        except Exception as e:
+            put((_END, e))
+        finally:
+            if closed.is_set():
+                close = getattr(iterator, 'close', None)
+                if close is not None:
+                    close()
+
+    reader = threading.Thread(target=read, name='timed-read', daemon=True)
+    reader.start()
+    try:
+        while True:
+            try:
+                item, error = items.get(timeout=timeout())
+            except queue.Empty:
+                yield None
+                continue
+            if item is _END:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        closed.set()
+        reader.join()
+
+
+async def atimed_reads(iterable, timeout):
+    """Async twin of timed_reads: a pending read is kept across timeouts, not cancelled."""
+    # Imported here so the WSGI entry points do not load asyncio at startup
+    import asyncio
+
+    iterator = iterable.__aiter__()
+    read = None
+    try:
+        while True:
+            if read is None:
+                read = asyncio.ensure_future(iterator.__anext__())
+            done, _ = await asyncio.wait((read,), timeout=timeout())
+            if not done:
+                yield None
+                continue
+            finished, read = read, None
+            try:
+                item = finished.result()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        if read is not None:
+            read.cancel()
+            await asyncio.gather(read, return_exceptions=True)
+
+
+def relay_passthrough(response, chunk_size=None, flush_interval=None, flush_bytes=None):
+    """
+    Yield (frame_bytes, done) pairs without decoding upstream JSON.
+
+    Frames are buffered until the current network read is exhausted and
+    flush_interval has elapsed, or until flush_bytes have accumulated.
+    Frames held for flush_interval are written without waiting for the
+    next read.
+    """
+    scanner = FrameScanner()
+    coalescer = Coalescer(flush_interval, flush_bytes)
+
+    chunks = response.iter_content(chunk_size=chunk_size or STREAM_CONFIG["chunk_size"])
+    reads = timed_reads(chunks, coalescer.timeout) if coalescer.flush_interval > 0 else chunks
+    try:
+        for chunk in reads:
+            if chunk is None:
+                # Nothing new within the flush interval
+                yield coalescer.take(), False
+                continue
+            if not chunk:
+                continue
+            coalescer.add(scanner.feed(chunk))
+            if scanner.stopped:
+                yield coalescer.take(), scanner.done
+                return
+            if coalescer.ready():
+                yield coalescer.take(), False
+    finally:
+        if reads is not chunks:
+            reads.close()
+
+    coalescer.add(scanner.close())
+    if coalescer.out:
+        yield coalescer.take(), scanner.done
+
+
+async def arelay_passthrough(response, flush_interval=None, flush_bytes=None):
+    """Async twin of relay_passthrough for an httpx streaming response."""
+    scanner = FrameScanner()
+    coalescer = Coalescer(flush_interval, flush_bytes)
+
+    chunks = response.aiter_bytes()
+    reads = atimed_reads(chunks, coalescer.timeout) if coalescer.flush_interval > 0 else chunks
+    try:
+        async for chunk in reads:
+            if chunk is None:
+                # Nothing new within the flush interval
+                yield coalescer.take(), False
+                continue
+            if not chunk:
+                continue
+            coalescer.add(scanner.feed(chunk))
+            if scanner.stopped:
+                yield coalescer.take(), scanner.done
+                if scanner.done:
+                    if reads is not chunks:
+                        await reads.aclose()
+                    await _drain(chunks)
+                return
+            if coalescer.ready():
+                yield coalescer.take(), False
+    finally:
+        if reads is not chunks:
+            await reads.aclose()
+
+    coalescer.add(scanner.close())
+    if coalescer.out:
+        yield coalescer.take(), scanner.done
+
+
+def relay(response, mode=None):
+    mode = mode or STREAM_CONFIG["mode"]
+    if mode == 'reparse':
+        return relay_reparse(response)
+    return relay_passthrough(response)
+
+
+async def _drain(iterator):
+    # httpx only returns a connection to the pool once the body was read to
+    # the end, and a partially iterated stream cannot be resumed elsewhere
+    async for _ in iterator:
+        pass
+
+
+async def arelay_reparse(response):
+    """Async twin of relay_reparse for an httpx streaming response."""
+    lines = response.aiter_lines()
+    async for line in lines:
+        if line.startswith('data: '):
+            data_content = line[6:]
+            if data_content.strip() == '[DONE]':
+                yield sse_event({'done': True}).encode('utf-8'), True
+                await _drain(lines)
+                return
+            try:
+                chunk_data = json.loads(data_content)
+                yield sse_event(chunk_data).encode('utf-8'), False
+            except json.JSONDecodeError:
+                continue
+
+
+def arelay(response, mode=None):
+    mode = mode or STREAM_CONFIG["mode"]
+    if mode == 'reparse':
+        return arelay_reparse(response)
+    return arelay_passthrough(response)
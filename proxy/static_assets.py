@@ -0,0 +1,217 @@
+"""
+Precompressed, fingerprinted static assets served from memory.
+
+build_assets() turns public/ into a table of ready-to-send responses:
+
+- every file is compressed once with gzip (and brotli when the `brotli`
+  package is installed) and only kept compressed when that is smaller;
+- assets referenced from index.html get a content-hash name
+  (script.js -> script.3f2a9c1b7d.js) and index.html is rewritten to use
+  them, so they can be cached as immutable;
+- every representation carries a strong ETag for If-None-Match.
+
+build_static.py writes the table to dist/ with a manifest; the servers
+load that (or build it in memory from public/) when STATIC_MODE is
+`precompressed`. The default `directory` mode keeps serving public/ from
+disk, which is handier while editing the frontend.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+STATIC_CONFIG = {
+    "mode": os.getenv("STATIC_MODE", "directory"),
+    "dist_dir": os.getenv("STATIC_DIST_DIR", "dist"),
+}
+
+# Text assets that are referenced by name from index.html and can safely
+# move to a fingerprinted URL
+FINGERPRINT_EXTENSIONS = ('.css', '.js')
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml', 'image/x-icon',
+                      'image/vnd.microsoft.icon')
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+_REFERENCE_PATTERN = re.compile(r'(?P<attr>\b(?:href|src)=["\'])(?P<path>[^"\':?#]+)(?P<end>["\'])')
+
+
+def _content_type(name):
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    if content_type.startswith('text/') or content_type == 'application/javascript':
+        content_type += '; charset=utf-8'
+    return content_type
+
+
+def fingerprint_name(name, body):
+    root, ext = os.path.splitext(name)
+    return f'{root}.{hashlib.sha256(body).hexdigest()[:10]}{ext}'
+
+
+def _encodings(body, content_type):
+    """Return {encoding: bytes} for the representations worth keeping."""
+    encodings = {'identity': body}
+    if not content_type.startswith(COMPRESSIBLE_TYPES):
+        return encodings
+    compressed = gzip.compress(body, compresslevel=9, mtime=0)
+    if len(compressed) < len(body):
+        encodings['gzip'] = compressed
+    if brotli is not None:
+        compressed = brotli.compress(body, quality=11)
+        if len(compressed) < len(body):
+            encodings['br'] = compressed
+    return encodings
+
+
+def _entry(body, content_type, cache_control):
+    digest = hashlib.sha256(body).hexdigest()[:16]
+    return {
+        'content_type': content_type,
+        'cache_control': cache_control,
+        'etag': digest,
+        'bodies': _encodings(body, content_type),
+    }
+
+
+def build_assets(public_dir='public'):
+    """Build the asset table {url_path: entry} plus {name: fingerprinted_name}."""
+    assets = {}
+    fingerprints = {}
+    sources = {}
+    for root, _dirs, files in os.walk(public_dir):
+        for filename in files:
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, public_dir).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                sources[name] = f.read()
+
+    for name, body in sources.items():
+        content_type = _content_type(name)
+        # The original name stays available (templates and bookmarks use it)
+        # but has to be revalidated; the fingerprinted copy never changes
+        assets[name] = _entry(body, content_type, REVALIDATE)
+        if name.endswith(FINGERPRINT_EXTENSIONS):
+            hashed = fingerprint_name(name, body)
+            fingerprints[name] = hashed
+            assets[hashed] = _entry(body, content_type, IMMUTABLE)
+
+    if 'index.html' in sources:
+        def rewrite(match):
+            path = match.group('path')
+            return match.group('attr') + fingerprints.get(path, path) + match.group('end')
+
+        index = _REFERENCE_PATTERN.sub(rewrite, sources['index.html'].decode('utf-8')).encode('utf-8')
+        assets['index.html'] = _entry(index, _content_type('index.html'), REVALIDATE)
+
+    return assets, fingerprints
+
+
+_SUFFIXES = {'identity': '', 'gzip': '.gz', 'br': '.br'}
+
+
+def write_dist(assets, fingerprints, dist_dir):
+    """Write every representation plus manifest.json to dist_dir."""
+    manifest = {'fingerprints': fingerprints, 'assets': {}}
+    for name, entry in assets.items():
+        target = os.path.join(dist_dir, name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        for encoding, body in entry['bodies'].items():
+            with open(target + _SUFFIXES[encoding], 'wb') as f:
+                f.write(body)
+        manifest['assets'][name] = {
+            'content_type': entry['content_type'],
+            'cache_control': entry['cache_control'],
+            'etag': entry['etag'],
+            'encodings': {encoding: len(body) for encoding, body in entry['bodies'].items()},
+        }
+    with open(os.path.join(dist_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_dist(dist_dir):
+    """Load a table written by write_dist, or None if there is no build."""
+    try:
+        with open(os.path.join(dist_dir, 'manifest.json'), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    assets = {}
+    for name, meta in manifest['assets'].items():
+        bodies = {}
+        for encoding in meta['encodings']:
+            with open(os.path.join(dist_dir, name) + _SUFFIXES[encoding], 'rb') as f:
+                bodies[encoding] = f.read()
+        assets[name] = {
+            'content_type': meta['content_type'],
+            'cache_control': meta['cache_control'],
+            'etag': meta['etag'],
+            'bodies': bodies,
+        }
+    return assets
+
+
+def load_assets(public_dir='public', dist_dir=None):
+    """Prefer the prebuilt dist/ table; fall back to building from public/."""
+    assets = load_dist(dist_dir or STATIC_CONFIG["dist_dir"])
+    if assets is None:
+        assets, _fingerprints = build_assets(public_dir)
+    return assets
+
+
+_assets = None
+
+
+def get_assets(public_dir='public'):
+    """Return the process-wide asset table, loading it on first use."""
+    global _assets
+    if _assets is None:
+        _assets = load_assets(public_dir)
+    return _assets
+
+
+def accepts_encoding(accept_encoding, encoding):
+    """Whether an Accept-Encoding header allows encoding (q=0 refuses it)."""
+    for part in accept_encoding.split(','):
+        token, _, params = part.strip().partition(';')
+        if token.strip().lower() == encoding:
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+
+def select(entry, accept_encoding, if_none_match):
+    """
+    Pick the response for a request.
+
+    Returns (status, body, headers) where headers is a list of
+    (name, value) pairs; status is 304 when the client's copy is current.
+    """
+    accept_encoding = accept_encoding or ''
+    encoding = 'identity'
+    for candidate in ('br', 'gzip'):
+        if candidate in entry['bodies'] and accepts_encoding(accept_encoding, candidate):
+            encoding = candidate
+            break
+
+    etag = f'"{entry["etag"]}"' if encoding == 'identity' else f'"{entry["etag"]}-{encoding}"'
+    headers = [
+        ('ETag', etag),
+        ('Cache-Control', entry['cache_control']),
+        ('Vary', 'Accept-Encoding'),
+    ]
+    if if_none_match and (if_none_match.strip() == '*' or etag in [t.strip() for t in if_none_match.split(',')]):
+        return 304, b'', headers
+
+    body = entry['bodies'][encoding]
+    headers.append(('Content-Type', entry['content_type']))
+    if encoding != 'identity':
+        headers.append(('Content-Encoding', encoding))
+    return 200, body, headers
@@ -0,0 +1,337 @@
+"""
+Design digests: compacted copies of the slide templates in public/.
+
+Picking a template sends its whole HTML as a Design DNA turn, and every
+later turn sends it again. Comments, indentation, repeated inline styles
+and long sample tables and lists cost input tokens each time without
+telling the model anything more about the design. A digest is the same
+template with:
+
+- comments dropped and whitespace collapsed (whitespace between tags is
+  removed unless it separates inline content, a run of spaces inside
+  text becomes one space);
+- CSS in <style> and style="" minified, script text trimmed line by line;
+- style="" values used more than once moved into one class each
+  (`.ds1{...}` in a <style> at the end of <head>), when that is shorter;
+- table body rows beyond TEMPLATE_MAX_ROWS and list items beyond
+  TEMPLATE_MAX_ITEMS replaced by a comment saying how many were left out.
+
+Digests are for the model to read, not for rendering: a style moved into
+a class loses to more specific stylesheet rules where the inline style
+did not. They are built once per process from the Template*.html files
+in TEMPLATE_DIR (at startup for the local servers, on first use in the
+Vercel function) and stored as blobs, so the browser's upload of the
+digest it fetched from GET /api/templates/<name> finds it already there.
+GET /api/templates reports bytes and estimated tokens before and after.
+"""
+import glob
+import hashlib
+import os
+import re
+import threading
+import time
+from html import escape
+
+from proxy import blobs, metrics, preview
+from proxy.context import estimate_text_tokens
+
+TEMPLATE_CONFIG = {
+    "dir": os.getenv("TEMPLATE_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                  "public")),
+    "digest": os.getenv("TEMPLATE_DIGEST", "true").lower() == "true",
+    "max_rows": int(os.getenv("TEMPLATE_MAX_ROWS", "5")),
+    "max_items": int(os.getenv("TEMPLATE_MAX_ITEMS", "8")),
+}
+
+COMPACT_SECONDS = metrics.Histogram('fakeclippy_template_compact_seconds', 'Time to build one design digest')
+
+_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+_CSS_STRING = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')''')
+_CSS_COMMENT = re.compile(r'/\*.*?\*/', re.S)
+_CSS_SPACE = re.compile(r'\s+')
+_CSS_PUNCTUATION = re.compile(r'\s*([{};,>])\s*')
+_CSS_COLON = re.compile(r':\s+')
+_CSS_DECLARATION_COLON = re.compile(r'\s*:\s*')
+_CSS_BLOCK = re.compile(r'\{[^{}]*\}')
+_SPACE = re.compile(r'\s+')
+# Elements whose text keeps its whitespace
+_PRESERVE = frozenset(('pre', 'textarea'))
+# Whitespace between two of these (or text) renders as a space; next to anything else it can go
+INLINE_ELEMENTS = frozenset(('a', 'abbr', 'b', 'bdi', 'bdo', 'br', 'button', 'cite', 'code', 'data', 'dfn', 'em',
+                             'i', 'img', 'input', 'kbd', 'label', 'mark', 'q', 's', 'samp', 'select', 'small',
+                             'span', 'strong', 'sub', 'sup', 'svg', 'textarea', 'time', 'u', 'var', 'wbr'))
+_ELIDED = re.compile(r'^ \d+ more (rows|items) like these $')
+
+
+class TemplateNotFound(Exception):
+    pass
+
+
+def minify_css(css, declarations=False):
+    """
+    CSS without comments and optional whitespace; quoted strings are kept as they are.
+
+    declarations is for a style="" value, where every colon separates a
+    property from its value (in a stylesheet `a :hover` differs from `a:hover`).
+    """
+    parts = _CSS_STRING.split(_CSS_COMMENT.sub('', css))
+    for i in range(0, len(parts), 2):
+        text = _CSS_SPACE.sub(' ', parts[i])
+        text = _CSS_PUNCTUATION.sub(r'\1', text)
+        if declarations:
+            text = _CSS_DECLARATION_COLON.sub(':', text)
+        else:
+            text = _CSS_COLON.sub(':', text)
+            text = _CSS_BLOCK.sub(lambda m: _CSS_DECLARATION_COLON.sub(':', m.group()), text)
+        parts[i] = text
+    return ''.join(parts).replace(';}', '}').strip().rstrip(';')
+
+
+def trim_script(js):
+    """Script text with blank lines, whole-line // comments and indentation removed."""
+    lines = (line.strip() for line in js.split('\n'))
+    return '\n'.join(line for line in lines if line and not line.startswith('//'))
+
+
+class _Compactor:
+    def __init__(self, max_rows, max_items):
+        self.max_rows = max_rows
+        self.max_items = max_items
+        self.report = {'styles_deduped': 0, 'rows_dropped': 0, 'items_dropped': 0}
+        self.styled = {}  # minified style -> elements that carry it
+
+    def compact(self, document):
+        for root in (document.head, document.body):
+            self._walk(root, False)
+        self._dedupe_styles(document)
+        return document
+
+    def _walk(self, node, preserve):
+        preserve = preserve or node.tag in _PRESERVE
+        children = []
+        for index, child in enumerate(node.children):
+            if child.tag == '#comment':
+                if _ELIDED.match(child.text):
+                    children.append(child)
+                continue
+            if child.tag == '#text':
+                if node.tag == 'style':
+                    child.text = minify_css(child.text)
+                elif node.tag == 'script':
+                    child.text = trim_script(child.text)
+                elif not preserve:
+                    if not child.text.strip() and not (_inline(children[-1] if children else None) and
+                                                       _inline(_next_node(node.children, index))):
+                        continue
+                    child.text = _SPACE.sub(' ', child.text)
+                if child.text:
+                    children.append(child)
+                continue
+            style = dict(child.attrs).get('style')
+            if style is not None:
+                style = minify_css(style, declarations=True)
+                child.attrs = [(k, style if k == 'style' else v) for k, v in child.attrs if k != 'style' or style]
+                if style:
+                    self.styled.setdefault(style, []).append(child)
+            self._walk(child, preserve)
+            children.append(child)
+        node.children = self._cap(node, children)
+
+    def _cap(self, node, children):
+        if node.tag == 'tbody':
+            limit, item, counter = self.max_rows, 'tr', 'rows_dropped'
+        elif node.tag in ('ul', 'ol'):
+            limit, item, counter = self.max_items, 'li', 'items_dropped'
+        else:
+            return children
+        items = [c for c in children if c.tag == item]
+        if limit <= 0 or len(items) <= limit:
+            return children
+        dropped = set(map(id, items[limit:]))
+        kept = [c for c in children if id(c) not in dropped]
+        noun = 'rows' if item == 'tr' else 'items'
+        kept.append(preview.Text(f' {len(dropped)} more {noun} like these ', '#comment'))
+        self.report[counter] += len(dropped)
+        return kept
+
+    def _dedupe_styles(self, document):
+        used = set()
+        present = set()
+        for element in _elements(document.html):
+            used.update((dict(element.attrs).get('class') or '').split())
+            present.add(id(element))
+        rules = []
+        number = 0
+        for style, elements in self.styled.items():
+            # Rows and items dropped by the caps no longer count
+            elements = [e for e in elements if id(e) in present]
+            if len(elements) < 2:
+                continue
+            number += 1
+            name = f'ds{number}'
+            while name in used:
+                number += 1
+                name = f'ds{number}'
+            rule = f'.{name}{{{style}}}'
+            # ' style=""' per element today, against the rule plus ' ds1' (or ' class=""') per element
+            if len(rule) + len(elements) * (len(name) + 9) >= len(elements) * (len(style) + 9):
+                continue
+            for element in elements:
+                attrs = [(k, v) for k, v in element.attrs if k != 'style']
+                classes = dict(attrs).get('class')
+                if classes:
+                    attrs = [(k, f'{v} {name}' if k == 'class' else v) for k, v in attrs]
+                else:
+                    attrs.append(('class', name))
+                element.attrs = attrs
+            rules.append(rule)
+            self.report['styles_deduped'] += 1
+        if rules:
+            style = preview.Element('style')
+            style.children.append(preview.Text(''.join(rules)))
+            document.head.children.append(style)
+
+
+def _inline(node):
+    return node is not None and (node.tag == '#text' or node.tag in INLINE_ELEMENTS)
+
+
+def _next_node(children, index):
+    for child in children[index + 1:]:
+        if child.tag != '#comment':
+            return child
+    return None
+
+
+def _elements(node):
+    for child in node.children:
+        if isinstance(child, preview.Element):
+            yield child
+            yield from _elements(child)
+
+
+def _serialize(node, out, raw=False):
+    # preview.serialize with only & and " escaped in attributes, which is all HTML needs
+    tag = node.tag
+    if tag == '#text':
+        out.append(node.text if raw else escape(node.text, quote=False))
+        return
+    if tag == '#comment':
+        out.append(f'<!--{node.text}-->')
+        return
+    out.append('<' + tag)
+    for name, value in node.attrs:
+        out.append(f' {name}' if value is None else ' {}="{}"'.format(name, value.replace('&', '&amp;')
+                                                                       .replace('"', '&quot;')))
+    out.append('>')
+    if tag in preview.VOID_ELEMENTS:
+        return
+    raw = tag in preview.RAW_TEXT_ELEMENTS
+    for child in node.children:
+        _serialize(child, out, raw)
+    out.append(f'</{tag}>')
+
+
+def compact_html(html, max_rows=None, max_items=None):
+    """Return (digest HTML, report) for a template."""
+    compactor = _Compactor(TEMPLATE_CONFIG["max_rows"] if max_rows is None else max_rows,
+                           TEMPLATE_CONFIG["max_items"] if max_items is None else max_items)
+    document = compactor.compact(preview.parse(html))
+    out = [f'<!{document.doctype}>'] if document.doctype else []
+    _serialize(document.html, out)
+    return ''.join(out), compactor.report
+
+
+class _Digest:
+    __slots__ = ('name', 'html', 'etag', 'report')
+
+    def __init__(self, name, html, etag, report):
+        self.name = name
+        self.html = html
+        self.etag = etag
+        self.report = report
+
+
+class TemplateDigests:
+    """The digests of every template in a directory, built together on first use."""
+
+    def __init__(self, directory, enabled=True):
+        self.directory = directory
+        self.enabled = enabled
+        self._digests = None
+        self._lock = threading.Lock()
+        self.built_ms = None
+
+    def _build(self):
+        started = time.perf_counter()
+        digests = {}
+        for path in sorted(glob.glob(os.path.join(self.directory, 'Template*.html'))):
+            name = os.path.splitext(os.path.basename(path))[0]
+            with open(path, encoding='utf-8') as f:
+                original = f.read()
+            compact_started = time.perf_counter()
+            if self.enabled:
+                html, report = compact_html(original)
+            else:
+                html, report = original, {}
+            elapsed = time.perf_counter() - compact_started
+            COMPACT_SECONDS.observe(elapsed)
+            data = html.encode('utf-8')
+            try:
+                # The browser uploads what it fetched; this makes that a HEAD hit
+                blobs.get_store().put(data, 'text/html', f'{name}.html')
+            except (OSError, blobs.BlobTooLarge):
+                pass
+            tokens_before = estimate_text_tokens(original)
+            tokens_after = estimate_text_tokens(html)
+            report = dict(report, name=name, bytes_before=len(original.encode('utf-8')), bytes_after=len(data),
+                          tokens_before=tokens_before, tokens_after=tokens_after,
+                          tokens_saved_pct=round((1 - tokens_after / tokens_before) * 100, 1) if tokens_before else 0,
+                          compact_ms=round(elapsed * 1000, 2))
+            digests[name] = _Digest(name, html, hashlib.sha256(data).hexdigest()[:32], report)
+        self.built_ms = round((time.perf_counter() - started) * 1000, 2)
+        return digests
+
+    def _all(self):
+        if self._digests is None:
+            with self._lock:
+                if self._digests is None:
+                    self._digests = self._build()
+        return self._digests
+
+    def get(self, name):
+        """The digest of a template by name (file name without .html); TemplateNotFound if none."""
+        digest = self._all().get(name) if isinstance(name, str) and _NAME_PATTERN.match(name) else None
+        if digest is None:
+            raise TemplateNotFound(name)
+        return digest
+
+    def warm(self):
+        self._all()
+
+    def stats(self):
+        digests = self._all()
+        return {
+            'enabled': self.enabled,
+            'directory': self.directory,
+            'max_rows': TEMPLATE_CONFIG["max_rows"],
+            'max_items': TEMPLATE_CONFIG["max_items"],
+            'built_ms': self.built_ms,
+            'bytes_before': sum(d.report['bytes_before'] for d in digests.values()),
+            'bytes_after': sum(d.report['bytes_after'] for d in digests.values()),
+            'templates': [d.report for d in digests.values()],
+        }
+
+
+_digests = None
+_digests_lock = threading.Lock()
+
+
+def get_digests():
+    """Return the process-wide template digests for TEMPLATE_DIR."""
+    global _digests
+    if _digests is None:
+        with _digests_lock:
+            if _digests is None:
+                _digests = TemplateDigests(TEMPLATE_CONFIG["dir"], TEMPLATE_CONFIG["digest"])
+    return _digests
@@ -0,0 +1,142 @@
+"""
+Pooled keep-alive HTTP client for the upstream chat completions API.
+
+Every base URL gets one requests.Session with a bounded urllib3 connection
+pool, so consecutive /api/chat turns reuse the same TCP/TLS connection
+instead of paying a fresh handshake per message.
+"""
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from proxy.blobs import encode_payload
+
+UPSTREAM_CONFIG = {
+    "pool_size": int(os.getenv("UPSTREAM_POOL_SIZE", "10")),
+    "pool_block": os.getenv("UPSTREAM_POOL_BLOCK", "false").lower() == "true",
+    "connect_timeout": float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5")),
+    "read_timeout": float(os.getenv("UPSTREAM_READ_TIMEOUT", "30")),
+}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(base_url):
+    """Return the shared session for base_url, creating it on first use."""
+    session = _sessions.get(base_url)
+    if session is not None:
+        return session
+
+    with _sessions_lock:
+        session = _sessions.get(base_url)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=UPSTREAM_CONFIG["pool_size"],
+                pool_block=UPSTREAM_CONFIG["pool_block"],
+                max_retries=0,
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[base_url] = session
+    return session
+
+
+def timeouts():
+    return (UPSTREAM_CONFIG["connect_timeout"], UPSTREAM_CONFIG["read_timeout"])
+
+
+def post_chat(base_url, api_key, payload):
+    """
+    Open a streaming POST to {base_url}/chat/completions on a pooled connection.
+
+    Blob markers in the payload are expanded while the body is sent.
+    """
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {api_key}'
+    }
+    return get_session(base_url).post(
+        f'{base_url}/chat/completions',
+        headers=headers,
+        data=encode_payload(payload),
+        stream=True,
+        timeout=timeouts()
+    )
+
+
+def release(response, reuse=True):
+    """
+    Hand the response's connection back to the pool.
+
+    requests' Response.close() drops the socket when the body was not fully
+    read, which defeats keep-alive after we stop at [DONE]. Draining the
+    (already finished) remainder keeps the connection reusable. Pass
+    reuse=False when aborting mid-stream so we don't read a whole generation
+    just to recycle a socket.
+    """
+    raw = response.raw
+    try:
+        if reuse:
+            raw.drain_conn()
+            raw.release_conn()
+        else:
+            response.close()
+    except Exception:
+        response.close()
+
+
+def _warm(base_url):
+    try:
+        response = get_session(base_url).head(base_url, timeout=timeouts())
+        response.close()
+    except requests.exceptions.RequestException as e:
+        print(f"Warning: Could not pre-warm upstream connection to {base_url}: {e}")
+        # Imported here so warming starts before the rest of the proxy loads (see api/index.py)
+        from proxy import requestlog
+
+        requestlog.event('upstream_warm_failed', upstream=base_url, error=str(e))
+
+
+def warm(base_url, background=True):
+    """Open a pooled connection to base_url ahead of the first chat request."""
+    if not background:
+        _warm(base_url)
+        return
+    threading.Thread(target=_warm, args=(base_url,), daemon=True).start()
+
+
+def pool_stats():
+    """
+    Report connection reuse per base URL.
+
+    urllib3 counts every request and every newly opened connection per host
+    pool; a request that did not need a new connection was a pool hit.
+    """
+    stats = {}
+    for base_url, session in list(_sessions.items()):
+        requests_made = 0
+        connections_opened = 0
+        idle = 0
+        adapter = session.get_adapter(base_url)
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_made += pool.num_requests
+            connections_opened += pool.num_connections
+            if pool.pool is not None:
+                idle += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+        stats[base_url] = {
+            'requests': requests_made,
+            'hits': max(0, requests_made - connections_opened),
+            'misses': connections_opened,
+            'idle_connections': idle,
+            'pool_size': UPSTREAM_CONFIG["pool_size"],
+        }
+    return stats
@@ -0,0 +1,267 @@
+"""
+What a chat stream costs on the wire: compact frames and compression.
+
+Compact frames. Every upstream chunk repeats its id, object, created,
+model and choice index around a delta of a few characters, so most of a
+relayed reply is envelope. A request with `"stream_format": "compact"`
+gets only what the browser reads:
+
+    data: {"c":"Here is your slide"}
+    data: {"f":"stop"}
+    data: {"done": true}
+
+Deltas relayed together are merged into one `c` frame, `f` carries a
+finish_reason, and done and error frames pass through unchanged. Chunks
+without content or finish_reason (the role-only first chunk, usage) are
+dropped.
+
+Streaming compression. With STREAM_COMPRESSION enabled, a chat stream is
+compressed with the best encoding the client accepts (br when the
+`brotli` package is installed, then gzip, then deflate). Compressors
+buffer, so the compressed stream is sync-flushed to make what was
+relayed decodable right away: after every frame by default, or with
+STREAM_COMPRESSION_FLUSH_INTERVAL / _FLUSH_BYTES once that many seconds
+or raw bytes are pending. The interval is a deadline: held bytes are
+flushed when it runs out even if no further frame arrives (the source
+is read with a timeout, see sse.timed_reads). The compression context is shared by the
+whole reply, which is why repeated envelopes compress so well even when
+every frame is flushed. bench_wire.py measures both against the plain
+framing.
+"""
+import json
+import os
+import time
+import zlib
+
+from proxy import metrics
+from proxy.sse import atimed_reads, timed_reads
+from proxy.static_assets import accepts_encoding
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+COMPRESSION_CONFIG = {
+    # Opt-in: behind a proxy or platform that compresses or buffers
+    # responses itself, a compressed stream only adds work
+    "enabled": os.getenv("STREAM_COMPRESSION", "false").lower() == "true",
+    "encodings": [e.strip() for e in os.getenv("STREAM_COMPRESSION_ENCODINGS", "br,gzip,deflate").split(',')
+                  if e.strip()],
+    "level": int(os.getenv("STREAM_COMPRESSION_LEVEL", "6")),
+    # Seconds of relayed frames to hold before a sync flush; 0 flushes
+    # after every frame, so compression never delays a delta
+    "flush_interval": float(os.getenv("STREAM_COMPRESSION_FLUSH_INTERVAL", "0")),
+    "flush_bytes": int(os.getenv("STREAM_COMPRESSION_FLUSH_BYTES", "4096")),
+}
+
+# zlib wbits: a gzip container, or a zlib stream for `deflate`
+# (RFC 9110 deflate is zlib-wrapped, which is what browsers expect)
+_WBITS = {'gzip': 31, 'deflate': 15}
+
+COMPRESSED_BYTES = metrics.Counter(
+    'fakeclippy_stream_compression_bytes_total',
+    'Chat stream bytes before (raw) and after (wire) streaming compression',
+    ('encoding', 'side'),
+)
+COMPRESSION_FLUSHES = metrics.Counter(
+    'fakeclippy_stream_compression_flushes_total', 'Sync flushes of compressed chat streams', ('encoding',))
+
+
+def available_encodings():
+    return [e for e in COMPRESSION_CONFIG["encodings"] if e in _WBITS or (e == 'br' and brotli is not None)]
+
+
+def negotiate(accept_encoding):
+    """The encoding to compress a chat stream with, or None to send it as is."""
+    if not COMPRESSION_CONFIG["enabled"] or not accept_encoding:
+        return None
+    for encoding in available_encodings():
+        if accepts_encoding(accept_encoding, encoding):
+            return encoding
+    return None
+
+
+class StreamCompressor:
+    """
+    Compresses one chat stream, deciding when to sync-flush.
+
+    feed() returns the bytes to write for a relayed frame, which is empty
+    while the flush policy holds it back; flush() writes what is held once
+    timeout() has run out; finish() ends the stream.
+    """
+
+    def __init__(self, encoding, level=None, flush_interval=None, flush_bytes=None):
+        level = COMPRESSION_CONFIG["level"] if level is None else level
+        self.encoding = encoding
+        self.flush_interval = COMPRESSION_CONFIG["flush_interval"] if flush_interval is None else flush_interval
+        self.flush_bytes = flush_bytes or COMPRESSION_CONFIG["flush_bytes"]
+        if encoding == 'br':
+            # Brotli quality runs 0-11; map the zlib-style level onto it
+            self.compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=min(level, 11), lgwin=18)
+        else:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, _WBITS[encoding])
+        self.pending = 0
+        self.last_flush = None
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.flushes = 0
+
+    def feed(self, frame, now=None):
+        if isinstance(frame, str):
+            frame = frame.encode('utf-8')
+        now = time.monotonic() if now is None else now
+        if self.last_flush is None:
+            self.last_flush = now
+        data = self._compress(frame)
+        self.pending += len(frame)
+        self.raw_bytes += len(frame)
+        self.wire_bytes += len(data)
+        if self.pending and (self.pending >= self.flush_bytes or now - self.last_flush >= self.flush_interval):
+            data += self.flush(now)
+        return data
+
+    def timeout(self, now=None):
+        """Seconds until held bytes are due for a flush, or None when nothing is held."""
+        if not self.pending:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(0.0, self.last_flush + self.flush_interval - now)
+
+    def flush(self, now=None):
+        """Sync-flush the held bytes and return them."""
+        if not self.pending:
+            return b''
+        data = self._flush()
+        self.pending = 0
+        self.last_flush = time.monotonic() if now is None else now
+        self.wire_bytes += len(data)
+        return data
+
+    def finish(self):
+        if self.encoding == 'br':
+            data = self.compressor.finish()
+        else:
+            data = self.compressor.flush(zlib.Z_FINISH)
+        self.wire_bytes += len(data)
+        return data
+
+    def _compress(self, data):
+        if self.encoding == 'br':
+            return self.compressor.process(data)
+        return self.compressor.compress(data)
+
+    def _flush(self):
+        self.flushes += 1
+        if self.encoding == 'br':
+            return self.compressor.flush()
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def record(self):
+        COMPRESSED_BYTES.inc(self.raw_bytes, labels=(self.encoding, 'raw'))
+        COMPRESSED_BYTES.inc(self.wire_bytes, labels=(self.encoding, 'wire'))
+        COMPRESSION_FLUSHES.inc(self.flushes, labels=(self.encoding,))
+
+
+def compress_stream(frames, encoding, flush_interval=None, flush_bytes=None):
+    """Compress a relayed chat stream for a Content-Encoding: <encoding> response."""
+    compressor = StreamCompressor(encoding, flush_interval=flush_interval, flush_bytes=flush_bytes)
+    reads = timed_reads(frames, compressor.timeout) if compressor.flush_interval > 0 else frames
+    try:
+        for frame in reads:
+            # None: the flush interval ran out before the next frame
+            data = compressor.flush() if frame is None else compressor.feed(frame)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        if reads is not frames:
+            reads.close()
+        compressor.record()
+
+
+async def acompress_stream(frames, encoding, flush_interval=None, flush_bytes=None):
+    """Async twin of compress_stream."""
+    compressor = StreamCompressor(encoding, flush_interval=flush_interval, flush_bytes=flush_bytes)
+    reads = atimed_reads(frames, compressor.timeout) if compressor.flush_interval > 0 else frames
+    try:
+        async for frame in reads:
+            data = compressor.flush() if frame is None else compressor.feed(frame)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        if reads is not frames:
+            await reads.aclose()
+        compressor.record()
+
+
+def compression_headers(encoding):
+    return {'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'}
+
+
+def _compact_event(obj):
+    return b'data: ' + json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n\n'
+
+
+class _Compactor:
+    """Splits relayed frames into lines and re-frames them as compact events."""
+
+    def __init__(self):
+        self.pending = b''
+
+    def feed(self, frame):
+        if isinstance(frame, str):
+            frame = frame.encode('utf-8')
+        lines = (self.pending + frame).split(b'\n')
+        self.pending = lines.pop()
+        out = []
+        text = []
+        for line in lines:
+            if not line.startswith(b'data: {'):
+                continue
+            payload = line[6:]
+            if payload.startswith((b'{"done"', b'{"error"')):
+                out.extend(self._text(text))
+                out.append(line + b'\n\n')
+                continue
+            try:
+                chunk = json.loads(payload)
+            except ValueError:
+                continue
+            choices = chunk.get('choices') if isinstance(chunk, dict) else None
+            if not choices:
+                continue
+            content = (choices[0].get('delta') or {}).get('content')
+            if content:
+                text.append(content)
+            if choices[0].get('finish_reason'):
+                out.extend(self._text(text))
+                out.append(_compact_event({'f': choices[0]['finish_reason']}))
+        out.extend(self._text(text))
+        return b''.join(out)
+
+    def _text(self, text):
+        if not text:
+            return []
+        event = _compact_event({'c': ''.join(text)})
+        text.clear()
+        return [event]
+
+
+def compact_stream(frames):
+    """Re-frame a chat stream as compact events."""
+    compactor = _Compactor()
+    for frame in frames:
+        data = compactor.feed(frame)
+        if data:
+            yield data
+
+
+async def acompact_stream(frames):
+    """Async twin of compact_stream."""
+    compactor = _Compactor()
+    async for frame in frames:
+        data = compactor.feed(frame)
+        if data:
+            yield data
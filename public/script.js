@@ -12,10 +12,245 @@ let selectedTemplate = null;
 const API_CONFIG = {
     baseUrl: window.location.hostname === 'localhost' ? 
         "http://localhost:5000/api" : 
-        "/api"
+        "/api",
+    // 'compact' asks for compact reply frames (see proxy/wire.py); by default
+    // the upstream chunks are relayed as they are, which the proxy does
+    // without parsing them
+    streamFormat: null
 };
 
 let conversationHistory = [];
+let conversationId = null; // Server-side conversation, see postChatTurn()
+let previewVersion = null; // Version of the server-side preview shown in the iframe, see refreshLivePreview()
+
+// Uploaded blobs by handle, kept so they can be re-uploaded if the server lost them
+const blobContents = {};
+const templateMarkers = {};
+
+// Compacted copies of the templates ("design digests"), see proxy/templates.py
+const templateDigests = {};
+
+// The template as sent to the model: the server's digest of it (no
+// comments or indentation, capped sample data) when available, else the
+// embedded copy.
+async function fetchTemplateDigest(templateName) {
+    if (!templateDigests[templateName]) {
+        try {
+            const response = await fetch(`${API_CONFIG.baseUrl}/templates/${encodeURIComponent(templateName)}`);
+            if (response.ok) {
+                templateDigests[templateName] = await response.text();
+            }
+        } catch (error) {
+            console.warn('Template digest unavailable, sending the full template:', error);
+        }
+    }
+    return templateDigests[templateName] || templateContents[templateName];
+}
+
+async function sha256Hex(blob) {
+    const digest = await crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+    return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+}
+
+async function postBlob(blob) {
+    const response = await fetch(API_CONFIG.baseUrl + '/blobs', {
+        method: 'POST',
+        headers: {
+            'Content-Type': blob.type || 'application/octet-stream'
+        },
+        body: blob
+    });
+    if (!response.ok) {
+        throw new Error(`Blob upload failed with status ${response.status}`);
+    }
+    return (await response.json()).handle;
+}
+
+// Upload content to the server's content-addressed blob store and return a
+// [[blob:handle]] marker for use in chat messages, or null if that failed.
+// Blobs the server already has (same template, same image) are not re-sent.
+async function uploadBlob(blob) {
+    try {
+        let handle = null;
+        if (window.crypto && crypto.subtle) {
+            handle = (await sha256Hex(blob)).slice(0, 32);
+            const head = await fetch(`${API_CONFIG.baseUrl}/blobs/${handle}`, { method: 'HEAD' });
+            if (!head.ok) {
+                handle = await postBlob(blob);
+            }
+        } else {
+            handle = await postBlob(blob);
+        }
+        blobContents[handle] = blob;
+        return `[[blob:${handle}]]`;
+    } catch (error) {
+        console.warn('Falling back to inline content:', error);
+        return null;
+    }
+}
+
+// Raw attachment files by prepared handle, re-sent if the server lost the prepared blob
+const attachmentSources = {};
+
+// Send a selected file to the server for preprocessing (image re-encoding,
+// text extraction) and return its report, or null if that failed.
+async function postAttachment(file) {
+    try {
+        const response = await fetch(API_CONFIG.baseUrl + '/attachments', {
+            method: 'POST',
+            headers: {
+                'Content-Type': file.type || 'application/octet-stream',
+                'X-Blob-Name': encodeURIComponent(file.name)
+            },
+            body: file
+        });
+        if (!response.ok) {
+            throw new Error(`Attachment upload failed with status ${response.status}`);
+        }
+        const prepared = await response.json();
+        attachmentSources[prepared.handle] = file;
+        return prepared;
+    } catch (error) {
+        console.warn('Preparing attachment in the browser instead:', error);
+        return null;
+    }
+}
+
+// Send the latest conversationHistory entry to the chat API.
+// Once the server holds the conversation only the new message is uploaded;
+// if the server has dropped it (restart, eviction, another instance) the
+// full local history is sent once to re-seed it.
+// Replies come as relayed upstream chunks, or compact frames when
+// API_CONFIG.streamFormat asks for them, see chunkContent().
+async function postChatTurn() {
+    const newMessage = conversationHistory[conversationHistory.length - 1];
+    const post = (body) => fetch(API_CONFIG.baseUrl + '/chat', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify(API_CONFIG.streamFormat ? { ...body, stream_format: API_CONFIG.streamFormat } : body)
+    });
+    
+    const send = async () => {
+        if (conversationId) {
+            const response = await post({ conversation_id: conversationId, message: newMessage });
+            if (response.status !== 404) {
+                return response;
+            }
+            return post({ conversation_id: conversationId, messages: conversationHistory });
+        } else if (conversationHistory.length === 1) {
+            return post({ message: newMessage });
+        }
+        return post({ messages: conversationHistory });
+    };
+    
+    let response = await send();
+    if (response.status === 409) {
+        // The server evicted (or never had) some attachments: upload them again and retry once
+        const missing = (await response.json()).handles || [];
+        await Promise.all([
+            ...missing.filter(h => blobContents[h]).map(h => postBlob(blobContents[h])),
+            ...missing.filter(h => attachmentSources[h]).map(h => postAttachment(attachmentSources[h]))
+        ]);
+        response = await send();
+    }
+    if (response.status === 429 || response.status === 503) {
+        // Busy or rate limited: wait as long as the server asks (up to 10s) and retry once
+        const retryAfter = Math.min(parseInt(response.headers.get('Retry-After'), 10) || 1, 10);
+        await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+        response = await send();
+    }
+
+    const returnedId = response.headers.get('X-Conversation-Id');
+    if (returnedId) {
+        conversationId = returnedId;
+    }
+    return response;
+}
+
+// Delta text of a parsed chat frame: a compact {"c": ...} frame (see
+// proxy/wire.py) or an upstream chunk relayed as is
+function chunkContent(parsed) {
+    if (typeof parsed.c === 'string') {
+        return parsed.c;
+    }
+    const delta = parsed.choices && parsed.choices[0] && parsed.choices[0].delta;
+    return (delta && delta.content) || '';
+}
+
+// How often one reply may be resumed after its connection dropped
+const MAX_STREAM_RESUMES = 3;
+
+// Reader over a /api/chat reply that survives dropped connections.
+// The server numbers frames with `id:` lines and keeps a resumable stream
+// going for a while after a disconnect (X-Stream-Id, see proxy/resume.py).
+// Only whole numbered frames are handed on, so after a drop reading
+// resumes from GET /api/chat/<stream id> after the last frame delivered
+// and nothing is shown twice.
+function chatStreamReader(response) {
+    const streamId = response.headers.get('X-Stream-Id');
+    let reader = response.body.getReader();
+    if (!streamId) {
+        return reader;
+    }
+    const encoder = new TextEncoder();
+    let decoder = new TextDecoder();
+    let pending = '';
+    let lastEventId = 0;
+    let finished = false;
+    let resumes = 0;
+    
+    const read = async () => {
+        while (true) {
+            let result;
+            try {
+                result = await reader.read();
+            } catch (error) {
+                if (finished || resumes >= MAX_STREAM_RESUMES) {
+                    throw error;
+                }
+                result = { done: true };
+            }
+            
+            if (result.done) {
+                if (finished || resumes >= MAX_STREAM_RESUMES) {
+                    const rest = pending + decoder.decode();
+                    pending = '';
+                    return rest ? { value: encoder.encode(rest), done: false } : { value: undefined, done: true };
+                }
+                resumes++;
+                console.warn(`Chat stream dropped after frame ${lastEventId}, resuming (${resumes}/${MAX_STREAM_RESUMES})`);
+                await new Promise(resolve => setTimeout(resolve, 500 * resumes));
+                const resumed = await fetch(`${API_CONFIG.baseUrl}/chat/${streamId}?last_event_id=${lastEventId}`);
+                if (!resumed.ok) {
+                    throw new Error(`Could not resume the reply (HTTP ${resumed.status})`);
+                }
+                reader = resumed.body.getReader();
+                decoder = new TextDecoder();
+                pending = '';
+                continue;
+            }
+            
+            pending += decoder.decode(result.value, { stream: true });
+            let end = -1;
+            for (const match of pending.matchAll(/(?:^|\n)id: (\d+)\n\n/g)) {
+                end = match.index + match[0].length;
+                lastEventId = parseInt(match[1], 10);
+            }
+            if (end < 0) {
+                continue;
+            }
+            const frames = pending.slice(0, end);
+            pending = pending.slice(end);
+            if (frames.includes('data: {"done"') || frames.includes('data: {"error"')) {
+                finished = true;
+            }
+            return { value: encoder.encode(frames), done: false };
+        }
+    };
+    return { read, cancel: () => reader.cancel() };
+}
 
 function addMessage(content, isUser = false) {
     const chatMessages = document.getElementById('chatMessages');
@@ -338,7 +573,7 @@ function replaceHtmlPlaceholderInElement(element, originalContent) {
             element.innerHTML = updatedHTML;
             
             // Auto-update live preview when HTML content is complete
-            updateLivePreview(originalContent);
+            refreshLivePreview(originalContent);
         }
     }
 }
@@ -409,30 +644,169 @@ function updateLivePreview(content) {
             }
         }
         
-        // Create blob and update iframe
-        const blob = new Blob([htmlWithImageInjection], { type: 'text/html' });
-        const url = URL.createObjectURL(blob);
-        
-        console.log('Updating preview frame with new content');
-        previewFrame.src = url;
-        previewFrame.style.display = 'block';
-        previewPlaceholder.style.display = 'none';
-        
-        // Store current preview URL for controls
-        window.currentPreviewUrl = url;
-        
-        // Clean up previous blob URL
-        if (window.previousPreviewUrl) {
-            setTimeout(() => {
-                URL.revokeObjectURL(window.previousPreviewUrl);
-            }, 1000);
-        }
-        window.previousPreviewUrl = url;
+        previewVersion = null;
+        showPreviewDocument(htmlWithImageInjection);
     } else {
         console.log('No HTML content extracted, keeping placeholder visible');
     }
 }
 
+function showPreviewDocument(html) {
+    const previewFrame = document.getElementById('previewFrame');
+    const previewPlaceholder = document.getElementById('previewPlaceholder');
+
+    // Create blob and update iframe
+    const blob = new Blob([html], { type: 'text/html' });
+    const url = URL.createObjectURL(blob);
+    
+    console.log('Updating preview frame with new content');
+    previewFrame.src = url;
+    previewFrame.style.display = 'block';
+    previewPlaceholder.style.display = 'none';
+    
+    // Store current preview URL for controls
+    window.currentPreviewUrl = url;
+    
+    // Clean up previous blob URL
+    if (window.previousPreviewUrl) {
+        const previous = window.previousPreviewUrl;
+        setTimeout(() => {
+            URL.revokeObjectURL(previous);
+        }, 1000);
+    }
+    window.previousPreviewUrl = url;
+}
+
+// Update the preview from the server's copy of the reply (POST /api/preview):
+// a patch of the document already in the iframe, or a whole document whose
+// images load from /api/blobs by URL. Falls back to rebuilding the preview
+// locally when the reply is not in a server-side conversation or an
+// attachment was never uploaded.
+async function refreshLivePreview(content) {
+    const latest = conversationHistory[conversationHistory.length - 1];
+    const images = {};
+    let uploaded = true;
+    lastFileContents.forEach((file, index) => {
+        if (file.isImage) {
+            if (file.marker) {
+                images[`IMAGE_PLACEHOLDER_${index + 1}`] = file.marker.slice(7, -2);
+            } else {
+                uploaded = false;
+            }
+        }
+    });
+    if (!conversationId || !latest || latest.role !== 'assistant' || latest.content !== content || !uploaded) {
+        updateLivePreview(content);
+        return;
+    }
+
+    const body = JSON.stringify({
+        conversation_id: conversationId,
+        base: previewVersion,
+        images: images,
+        asset_base: new URL(API_CONFIG.baseUrl + '/blobs/', window.location.href).href,
+        reply_chars: content.length
+    });
+    const post = () => fetch(API_CONFIG.baseUrl + '/preview', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: body
+    });
+    try {
+        let response = await post();
+        if (response.status === 409) {
+            // The server records a reply once its stream has ended, which can trail our last chunk
+            await new Promise(resolve => setTimeout(resolve, 250));
+            response = await post();
+        }
+        if (!response.ok) {
+            throw new Error(`preview answered ${response.status}`);
+        }
+        const result = await response.json();
+        if (result.mode === 'patch') {
+            if (!applyPreviewPatch(result.ops)) {
+                await loadPreviewDocument();
+                return;
+            }
+            previewVersion = result.version;
+        } else if (result.mode === 'document') {
+            previewVersion = result.version;
+            showPreviewDocument(result.html);
+        } else {
+            updateLivePreview(content);
+        }
+    } catch (error) {
+        console.warn('Preview service unavailable, rebuilding locally:', error);
+        updateLivePreview(content);
+    }
+}
+
+// The server's current preview document, for when a patch did not fit the iframe's DOM
+async function loadPreviewDocument() {
+    const response = await fetch(`${API_CONFIG.baseUrl}/preview/${conversationId}`);
+    if (!response.ok) {
+        throw new Error(`preview answered ${response.status}`);
+    }
+    const result = await response.json();
+    previewVersion = result.version;
+    showPreviewDocument(result.html);
+}
+
+// Apply patch ops from POST /api/preview to the iframe's document. Returns
+// false, leaving the rest unapplied, if the document is not the one the ops
+// were computed for.
+function applyPreviewPatch(ops) {
+    const previewFrame = document.getElementById('previewFrame');
+    let doc;
+    try {
+        doc = previewFrame && previewFrame.contentDocument;
+    } catch (error) {
+        return false;
+    }
+    if (!doc || doc.readyState === 'loading' || !window.currentPreviewUrl || doc.location.href !== window.currentPreviewUrl) {
+        return false;
+    }
+
+    const resolve = (path) => {
+        let node = path[0] === 0 ? doc.head : doc.body;
+        for (let i = 1; node && i < path.length; i++) {
+            node = node.childNodes[path[i]];
+        }
+        return node;
+    };
+    const parse = (html) => {
+        const template = doc.createElement('template');
+        template.innerHTML = html;
+        return template.content;
+    };
+
+    for (const op of ops) {
+        const node = resolve(op.path);
+        if (!node || node.nodeName.toLowerCase() !== op.node) {
+            console.warn('Preview patch does not match the document at', op.path);
+            return false;
+        }
+        if (op.op === 'text') {
+            node.nodeValue = op.text;
+        } else if (op.op === 'attrs') {
+            Object.entries(op.set).forEach(([name, value]) => node.setAttribute(name, value === null ? '' : value));
+            op.remove.forEach(name => node.removeAttribute(name));
+        } else if (op.op === 'remove') {
+            node.remove();
+        } else if (op.op === 'replace') {
+            node.replaceWith(parse(op.html));
+        } else if (op.op === 'insert') {
+            if (op.index > node.childNodes.length) {
+                return false;
+            }
+            node.insertBefore(parse(op.html), node.childNodes[op.index] || null);
+        } else {
+            return false;
+        }
+    }
+    return true;
+}
+
 async function sendMessage() {
     const messageInput = document.getElementById('messageInput');
     const sendButton = document.getElementById('sendButton');
@@ -497,12 +871,12 @@ async function sendMessage() {
                 }
                 fullMessage += `\nImage ${index + 1}: ${file.name}${sizeInfo}\n`;
                 fullMessage += `Description: Please analyze this image and use it as IMAGE_PLACEHOLDER_${index + 1} in your HTML.\n`;
-                fullMessage += `[Image Data: ${file.content}]\n`;
+                fullMessage += `[Image Data: ${file.marker || file.content}]\n`;
             } else if (file.isHtml) {
                 fullMessage += `\nHTML File ${index + 1}: ${file.name}\n`;
-                fullMessage += `Content:\n${file.content}\n`;
+                fullMessage += `Content:\n${file.marker || file.content}\n`;
             } else {
-                fullMessage += `\nDocument ${index + 1}: ${file.name}\nContent:\n${file.content}\n`;
+                fullMessage += `\nDocument ${index + 1}: ${file.name}\nContent:\n${file.marker || file.content}\n`;
             }
         });
     }
@@ -563,21 +937,13 @@ async function sendMessage() {
     let isHtmlDetected = false;
     
     try {
-        const response = await fetch(API_CONFIG.baseUrl + '/chat', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                messages: conversationHistory
-            })
-        });
+        const response = await postChatTurn();
         
         if (!response.ok) {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
         
-        const reader = response.body.getReader();
+        const reader = chatStreamReader(response);
         const decoder = new TextDecoder();
         
         while (true) {
@@ -603,36 +969,34 @@ async function sendMessage() {
                             break;
                         }
                         
-                        if (parsed.choices && parsed.choices[0] && parsed.choices[0].delta) {
-                            const delta = parsed.choices[0].delta;
-                            if (delta.content) {
-                                assistantMessage += delta.content;
-                                
-                                // Update progress based on message length (simple heuristic)
-                                const estimatedProgress = Math.min(90, (assistantMessage.length / 10)); // Max 90%, reserve 10% for completion
-                                const inputWrapper = document.querySelector('.message-input-wrapper');
-                                if (inputWrapper) {
-                                    inputWrapper.style.setProperty('--progress', `${estimatedProgress}%`);
-                                }
-                                
-                                // Check if HTML is detected (once detected, stay in HTML mode)
-                                if (!isHtmlDetected && detectHTML(assistantMessage)) {
-                                    isHtmlDetected = true;
-                                }
-                                
-                                if (isHtmlDetected) {
-                                    // Show clean content for HTML responses
-                                    const cleanContent = getCleanMessageForHTML(assistantMessage);
-                                    messageContent.innerHTML = formatMessage(cleanContent);
-                                    
-                                    // Don't replace placeholder during streaming - wait for completion
-                                } else {
-                                    // Normal content, show as usual
-                                    messageContent.innerHTML = formatMessage(assistantMessage);
-                                }
+                        const content = chunkContent(parsed);
+                        if (content) {
+                            assistantMessage += content;
+                            
+                            // Update progress based on message length (simple heuristic)
+                            const estimatedProgress = Math.min(90, (assistantMessage.length / 10)); // Max 90%, reserve 10% for completion
+                            const inputWrapper = document.querySelector('.message-input-wrapper');
+                            if (inputWrapper) {
+                                inputWrapper.style.setProperty('--progress', `${estimatedProgress}%`);
+                            }
+                            
+                            // Check if HTML is detected (once detected, stay in HTML mode)
+                            if (!isHtmlDetected && detectHTML(assistantMessage)) {
+                                isHtmlDetected = true;
+                            }
+                            
+                            if (isHtmlDetected) {
+                                // Show clean content for HTML responses
+                                const cleanContent = getCleanMessageForHTML(assistantMessage);
+                                messageContent.innerHTML = formatMessage(cleanContent);
                                 
-                                chatMessages.scrollTop = chatMessages.scrollHeight;
+                                // Don't replace placeholder during streaming - wait for completion
+                            } else {
+                                // Normal content, show as usual
+                                messageContent.innerHTML = formatMessage(assistantMessage);
                             }
+                            
+                            chatMessages.scrollTop = chatMessages.scrollHeight;
                         }
                     } catch (parseError) {
                         console.warn('Failed to parse chunk:', data);
@@ -780,7 +1144,21 @@ function handleFileSelect(event) {
         uploadedFiles.push(fileObj);
         updateFileList(); // Show file immediately with compression indicator
         
-        // Compress image files in the background
+        // Let the server downscale images and extract text; processFilesForMessage() waits for it
+        fileObj.prepared = postAttachment(file);
+        const prepared = await fileObj.prepared;
+        if (prepared && (prepared.processed || !isImageFile(file))) {
+            fileObj.marker = prepared.marker;
+            fileObj.compressing = false;
+            if (isImageFile(file)) {
+                fileObj.originalSize = prepared.original_bytes;
+                fileObj.compressedSize = prepared.prepared_bytes;
+            }
+            updateFileList();
+            return;
+        }
+        
+        // Otherwise compress image files in the browser
         if (isImageFile(file)) {
             try {
                 const compressionSettings = getOptimalCompression(file);
@@ -1169,7 +1547,13 @@ async function sendTemplateInstructionToClaud(templateName) {
     }
     
     try {
-        const fullMessage = `This is a slide template in HTML, read and understand its style, layout, and components:\n\n${templateHtml}`;
+        // The template is uploaded once per page load; the server dedupes across users
+        const templateText = await fetchTemplateDigest(templateName);
+        if (!templateMarkers[templateName]) {
+            templateMarkers[templateName] = await uploadBlob(new Blob([templateText], { type: 'text/html' }));
+        }
+        const templateRef = templateMarkers[templateName] || templateText;
+        const fullMessage = `This is a slide template in HTML, read and understand its style, layout, and components:\n\n${templateRef}`;
         
         // Add to conversation history
         conversationHistory.push({ role: "user", content: fullMessage });
@@ -1190,21 +1574,13 @@ async function sendTemplateInstructionToClaud(templateName) {
         let assistantMessage = '';
         
         // Send to Claude and get streaming response
-        const apiResponse = await fetch(API_CONFIG.baseUrl + '/chat', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                messages: conversationHistory
-            })
-        });
+        const apiResponse = await postChatTurn();
         
         if (!apiResponse.ok) {
             throw new Error(`HTTP error! status: ${apiResponse.status}`);
         }
         
-        const reader = apiResponse.body.getReader();
+        const reader = chatStreamReader(apiResponse);
         const decoder = new TextDecoder();
         
         while (true) {
@@ -1230,13 +1606,11 @@ async function sendTemplateInstructionToClaud(templateName) {
                             break;
                         }
                         
-                        if (parsed.choices && parsed.choices[0] && parsed.choices[0].delta) {
-                            const delta = parsed.choices[0].delta;
-                            if (delta.content) {
-                                assistantMessage += delta.content;
-                                messageContent.innerHTML = formatMessage(assistantMessage);
-                                chatMessages.scrollTop = chatMessages.scrollHeight;
-                            }
+                        const content = chunkContent(parsed);
+                        if (content) {
+                            assistantMessage += content;
+                            messageContent.innerHTML = formatMessage(assistantMessage);
+                            chatMessages.scrollTop = chatMessages.scrollHeight;
                         }
                     } catch (parseError) {
                         console.warn('Failed to parse chunk:', data);
@@ -2303,13 +2677,27 @@ async function processFilesForMessage() {
                 return null;
             }
             
+            await fileObj.prepared;
             const content = await readFileContent(fileObj.file, fileObj);
+            const isImage = isImageFile(fileObj.file);
+            
+            // Upload once and reference by handle instead of inlining the content,
+            // unless the server already holds a prepared copy
+            let marker = fileObj.marker;
+            if (!marker) {
+                const blob = isImage ?
+                    await (await fetch(content)).blob() :
+                    new Blob([content], { type: isHtmlFile(fileObj.file) ? 'text/html' : 'text/plain' });
+                marker = await uploadBlob(blob);
+            }
+            
             fileContents.push({
                 name: fileObj.name,
                 type: fileObj.type,
-                isImage: isImageFile(fileObj.file),
+                isImage: isImage,
                 isHtml: isHtmlFile(fileObj.file),
                 content: content,
+                marker: marker,
                 originalSize: fileObj.originalSize,
                 compressedSize: fileObj.compressedSize
             });
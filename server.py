@@ -1,110 +1,129 @@
+import time
+
 from flask import Flask, request, jsonify, send_from_directory, Response
 from flask_cors import CORS
-import requests
-import json
-import os
+
+from proxy import admission, metrics, requestlog, resume, routing, static_assets, templates, upstream, wire
+from proxy.blobs import BlobsMissing, check_references
+from proxy.chat import stream_chat
+from proxy.coalesce import stream_coalesced
+from proxy.config import load_api_config
+from proxy.context import fit_context
+from proxy.conversations import ConversationNotFound, record_reply, resolve_messages
+from proxy.response_cache import stream_with_cache
+from proxy.routes import admission_rejected, api, blobs_missing, conversation_not_found, start_batch
+from proxy.segmenter import segment_stream
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Conversation-Id', 'X-Request-Id', 'X-Stream-Id', 'X-Job-Id', 'Retry-After'])
+app.register_blueprint(api)
 
-# API Configuration - Load from environment variables or use defaults
-API_CONFIG = {
-    "api_key": os.getenv("CLAUDE_API_KEY", ""),
-    "base_url": os.getenv("CLAUDE_BASE_URL", "https://www.dmxapi.cn/v1"),
-    "model": os.getenv("CLAUDE_MODEL", "claude-sonnet-4-20250514")
-}
+# API Configuration - Load from environment variables or .env file
+API_CONFIG = load_api_config()
 
-# If no API key in environment, try to load from .env file manually
-if not API_CONFIG["api_key"]:
-    try:
-        with open('.env', 'r', encoding='utf-8') as f:
-            for line in f:
-                if line.startswith('CLAUDE_API_KEY='):
-                    API_CONFIG["api_key"] = line.split('=', 1)[1].strip()
-                elif line.startswith('CLAUDE_BASE_URL='):
-                    API_CONFIG["base_url"] = line.split('=', 1)[1].strip()
-                elif line.startswith('CLAUDE_MODEL='):
-                    API_CONFIG["model"] = line.split('=', 1)[1].strip()
-    except FileNotFoundError:
-        print("Warning: .env file not found. Please create one with your API configuration.")
-    except Exception as e:
-        print(f"Warning: Could not read .env file: {e}")
-
-if not API_CONFIG["api_key"]:
-    print("Warning: No API key configured. Please set CLAUDE_API_KEY environment variable or create .env file.")
+def serve_precompressed(filename):
+    entry = static_assets.get_assets('public').get(filename)
+    if entry is None:
+        return Response('Not Found', status=404, mimetype='text/plain')
+    status, body, headers = static_assets.select(
+        entry, request.headers.get('Accept-Encoding'), request.headers.get('If-None-Match'))
+    response = Response(body, status=status, headers=headers)
+    if status == 304:
+        response.headers.pop('Content-Type', None)
+    return response
 
 @app.route('/')
 def serve_index():
+    if static_assets.STATIC_CONFIG["mode"] == 'precompressed':
+        return serve_precompressed('index.html')
     return send_from_directory('public', 'index.html')
 
 @app.route('/<path:filename>')
 def serve_static(filename):
+    if static_assets.STATIC_CONFIG["mode"] == 'precompressed':
+        return serve_precompressed(filename)
     return send_from_directory('public', filename)
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
+    started = time.perf_counter()
+    trace = requestlog.start(requestlog.request_id(request.headers.get('X-Request-Id')))
+    ticket = None
     try:
         data = request.json
-        messages = data.get('messages', [])
+        client = admission.client_key(request.remote_addr, request.headers.get('X-Forwarded-For'))
+        # Admitted before the history, blobs and context budget are looked at,
+        # so a rejected request costs nothing and a retry starts clean
+        try:
+            ticket = admission.get_controller().admit(client)
+        except admission.Rejected as e:
+            trace.finish(e.status, 'rejected', reason=e.reason)
+            return admission_rejected(e)
         
-        # Prepare the request to Claude API
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {API_CONFIG["api_key"]}'
-        }
+        try:
+            conversation_id, messages, turn = resolve_messages(data, validate=check_references)
+        except ConversationNotFound:
+            ticket.release()
+            trace.finish(404, 'conversation_not_found')
+            return conversation_not_found()
+        except BlobsMissing as e:
+            ticket.release()
+            trace.finish(409, 'blob_not_found')
+            return blobs_missing(e)
+        
+        messages, max_tokens = fit_context(messages)
         
         payload = {
             'model': API_CONFIG['model'],
             'messages': messages,
             'stream': True,
-            'max_tokens': 10000
+            'max_tokens': max_tokens
         }
+        metrics.record_request(started, request.content_length or 0)
+        trace.event('chat_start', model=payload['model'], bytes_in=request.content_length or 0,
+                    messages=len(messages), max_tokens=max_tokens, conversation_id=conversation_id,
+                    client=client, stream_format=data.get('stream_format'))
         
-        def generate():
-            try:
-                # Make streaming request to Claude API
-                response = requests.post(
-                    f'{API_CONFIG["base_url"]}/chat/completions',
-                    headers=headers,
-                    json=payload,
-                    stream=True,
-                    timeout=30
-                )
-                
-                if response.status_code != 200:
-                    yield f"data: {json.dumps({'error': f'API request failed with status {response.status_code}'})}\n\n"
-                    return
-                
-                for line in response.iter_lines():
-                    if line:
-                        line = line.decode('utf-8')
-                        if line.startswith('data: '):
-                            data_content = line[6:]  # Remove 'data: ' prefix
-                            if data_content.strip() == '[DONE]':
-                                yield f"data: {json.dumps({'done': True})}\n\n"
-                                break
-                            try:
-                                chunk_data = json.loads(data_content)
-                                yield f"data: {json.dumps(chunk_data)}\n\n"
-                            except json.JSONDecodeError:
-                                continue
-                                
-            except requests.exceptions.Timeout:
-                yield f"data: {json.dumps({'error': 'Request timed out'})}\n\n"
-            except requests.exceptions.RequestException as e:
-                yield f"data: {json.dumps({'error': f'Request failed: {str(e)}'})}\n\n"
-            except Exception as e:
-                yield f"data: {json.dumps({'error': f'Server error: {str(e)}'})}\n\n"
-        
-        return Response(generate(), mimetype='text/plain', headers={
+        headers = {
             'Cache-Control': 'no-cache',
             'Connection': 'keep-alive',
             'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Headers': 'Content-Type'
-        })
+            'Access-Control-Allow-Headers': 'Content-Type',
+            'X-Request-Id': trace.request_id
+        }
+        frames = stream_with_cache(
+            payload, lambda: stream_coalesced(payload, lambda: stream_chat(API_CONFIG, payload, trace=trace)))
+        if conversation_id:
+            frames = record_reply(frames, turn)
+            headers['X-Conversation-Id'] = conversation_id
+        if data.get('stream_format') == 'segments':
+            frames = segment_stream(frames)
+        elif data.get('stream_format') == 'compact':
+            frames = wire.compact_stream(frames)
+        stream_id, frames = resume.resumable(frames, ticket)
+        if stream_id:
+            headers['X-Stream-Id'] = stream_id
+        encoding = wire.negotiate(request.headers.get('Accept-Encoding'))
+        if encoding:
+            frames = wire.compress_stream(frames, encoding)
+            headers.update(wire.compression_headers(encoding))
+        
+        frames = requestlog.TracedStream(metrics.instrument_stream(frames, started), trace)
+        frames = admission.AdmittedStream(frames, ticket)
+        return Response(frames, mimetype='text/plain', headers=headers)
         
     except Exception as e:
+        if ticket is not None:
+            ticket.release()
+        trace.finish(500, 'server_error', error=str(e))
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
+@app.route('/api/batch', methods=['POST'])
+def batch_job():
+    return start_batch(API_CONFIG)
+
 if __name__ == '__main__':
+    for target in routing.get_router(API_CONFIG).upstreams:
+        upstream.warm(target.base_url)
+    templates.get_digests().warm()
     app.run(debug=True, host='localhost', port=5000)
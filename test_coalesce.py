@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Test request coalescing (proxy/coalesce.py) against fake_upstream.py.
+
+Each test starts its own fake upstream on a free port, sends identical
+chat requests at the same time through stream_coalesced (or
+astream_coalesced) and checks with the upstream's /stats that only one
+upstream request was made, that every subscriber received the same
+frames, and what happens when the first subscriber or the upstream
+goes away.
+
+Usage:
+    python test_coalesce.py
+    python -m pytest -q test_coalesce.py
+"""
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import urllib.request
+
+os.environ["COALESCE_REQUESTS"] = "true"
+os.environ.setdefault("REQUEST_LOG", "false")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_upstream  # noqa: E402
+from proxy import coalesce  # noqa: E402
+from proxy.async_chat import astream_chat  # noqa: E402
+from proxy.chat import stream_chat  # noqa: E402
+
+SUBSCRIBERS = 8
+
+
+class FakeUpstream:
+    """fake_upstream.py served from a background thread."""
+
+    def __init__(self, **options):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.server = self.loop.run_until_complete(fake_upstream.start('127.0.0.1', self.port, **options))
+            started.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait(5)
+        self.api_config = {'api_key': 'test', 'base_url': f'http://127.0.0.1:{self.port}/v1', 'model': 'fake-model'}
+
+    def stats(self):
+        with urllib.request.urlopen(f'http://127.0.0.1:{self.port}/stats', timeout=5) as response:
+            return json.loads(response.read())
+
+    def stop(self):
+        async def shutdown():
+            self.server.close()
+            # Pooled keep-alive connections are still being served
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+        self.loop.close()
+
+
+def chat_payload(text):
+    return {'model': 'fake-model', 'messages': [{'role': 'user', 'content': text}], 'stream': True,
+            'max_tokens': 100}
+
+
+def coalesced(upstream, payload):
+    return coalesce.stream_coalesced(payload, lambda: stream_chat(upstream.api_config, payload))
+
+
+def read_concurrently(upstream, payload, count=SUBSCRIBERS):
+    """Read count identical requests at once; returns each subscriber's frames."""
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def read(index):
+        barrier.wait()
+        results[index] = list(coalesced(upstream, payload))
+
+    threads = [threading.Thread(target=read, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    return results
+
+
+def is_error(frame):
+    return frame.startswith(b'data: {"error"') if isinstance(frame, bytes) else frame.startswith('data: {"error"')
+
+
+def test_identical_requests_share_one_upstream_stream():
+    upstream = FakeUpstream(tokens=20, interval=0.02)
+    try:
+        results = read_concurrently(upstream, chat_payload('shared stream'))
+        assert upstream.stats()['requests'] == 1
+        assert len(results[0]) > 20
+        assert all(frames == results[0] for frames in results)
+        assert not any(is_error(frame) for frame in results[0])
+        assert coalesce.stats()['in_flight'] == 0
+    finally:
+        upstream.stop()
+
+
+def test_followers_get_the_stream_when_the_leader_disconnects():
+    upstream = FakeUpstream(tokens=20, interval=0.02)
+    payload = chat_payload('leader leaves')
+    try:
+        leader = coalesced(upstream, payload)
+        first = next(leader)
+        results = [None] * SUBSCRIBERS
+
+        def follow(index):
+            results[index] = list(coalesced(upstream, payload))
+
+        threads = [threading.Thread(target=follow, args=(i,)) for i in range(SUBSCRIBERS)]
+        for thread in threads:
+            thread.start()
+        next(leader)
+        leader.close()
+        for thread in threads:
+            thread.join(30)
+
+        assert upstream.stats()['requests'] == 1
+        assert all(frames == results[0] for frames in results)
+        assert results[0][0] == first
+        assert not any(is_error(frame) for frame in results[0])
+        assert upstream.stats()['completed'] == 1
+    finally:
+        upstream.stop()
+
+
+def test_upstream_closed_when_every_subscriber_leaves():
+    upstream = FakeUpstream(tokens=50, interval=0.02)
+    payload = chat_payload('everyone leaves')
+    try:
+        abandoned = coalesce.stats()['abandoned']
+        readers = [coalesced(upstream, payload) for _ in range(3)]
+        for reader in readers:
+            next(reader)
+        for reader in readers:
+            reader.close()
+        assert coalesce.stats()['abandoned'] == abandoned + 1
+        assert coalesce.stats()['in_flight'] == 0
+        # The next identical request starts a new upstream stream
+        assert len(list(coalesced(upstream, payload))) > 50
+        assert upstream.stats()['requests'] == 2
+    finally:
+        upstream.stop()
+
+
+def test_upstream_failure_reaches_every_subscriber():
+    upstream = FakeUpstream(tokens=20, interval=0.02, disconnect_rate=1.0)
+    try:
+        results = read_concurrently(upstream, chat_payload('cut short'))
+        assert upstream.stats()['requests'] == 1
+        assert all(frames == results[0] for frames in results)
+        assert is_error(results[0][-1])
+    finally:
+        upstream.stop()
+
+
+def test_upstream_error_status_reaches_every_subscriber():
+    upstream = FakeUpstream(error_rate=1.0, error_status=400)
+    try:
+        results = read_concurrently(upstream, chat_payload('rejected'))
+        assert upstream.stats()['requests'] == 1
+        assert all(frames == results[0] for frames in results)
+        assert len(results[0]) == 1 and is_error(results[0][0])
+    finally:
+        upstream.stop()
+
+
+def test_async_identical_requests_share_one_upstream_stream():
+    upstream = FakeUpstream(tokens=20, interval=0.02)
+    payload = chat_payload('shared async stream')
+
+    async def read():
+        return [frame async for frame in coalesce.astream_coalesced(
+            payload, lambda: astream_chat(upstream.api_config, payload))]
+
+    async def main():
+        return await asyncio.gather(*(read() for _ in range(SUBSCRIBERS)))
+
+    try:
+        results = asyncio.run(main())
+        assert upstream.stats()['requests'] == 1
+        assert len(results[0]) > 20
+        assert all(frames == results[0] for frames in results)
+    finally:
+        upstream.stop()
+
+
+if __name__ == '__main__':
+    failed = 0
+    for name, test in list(globals().items()):
+        if name.startswith('test_') and callable(test):
+            try:
+                test()
+                print(f'ok    {name}')
+            except AssertionError as e:
+                failed += 1
+                print(f'FAIL  {name} {e}')
+    sys.exit(1 if failed else 0)
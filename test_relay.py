@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Test the passthrough relay with a flush interval (proxy/sse.py) against
+fake_upstream.py.
+
+With CHAT_STREAM_FLUSH_INTERVAL set, upstream reads happen on a helper
+thread (sse.timed_reads). These tests check that the helper is done with
+the upstream response before stream_chat hands its connection back to
+the pool, so consecutive turns reuse one connection, and that a client
+leaving mid-stream leaves no reader behind.
+
+Usage:
+    python test_relay.py
+    python -m pytest -q test_relay.py
+"""
+import os
+import sys
+import threading
+
+os.environ.setdefault("REQUEST_LOG", "false")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from proxy import sse, upstream  # noqa: E402
+from proxy.chat import stream_chat  # noqa: E402
+from test_coalesce import FakeUpstream, chat_payload, is_error  # noqa: E402
+
+TURNS = 3
+
+
+def readers():
+    return [t for t in threading.enumerate() if t.name == 'timed-read']
+
+
+def with_flush_interval(test):
+    def run():
+        previous = sse.STREAM_CONFIG["flush_interval"]
+        # Shorter than the token gaps below, so held frames go out on the deadline
+        sse.STREAM_CONFIG["flush_interval"] = 0.05
+        try:
+            test()
+        finally:
+            sse.STREAM_CONFIG["flush_interval"] = previous
+    run.__name__ = test.__name__
+    return run
+
+
+@with_flush_interval
+def test_flush_interval_keeps_the_upstream_connection_reusable():
+    upstream_ = FakeUpstream(tokens=10, interval=0.08)
+    try:
+        for turn in range(TURNS):
+            frames = list(stream_chat(upstream_.api_config, chat_payload(f'turn {turn}')))
+            assert frames and not any(is_error(f) for f in frames)
+            assert not readers()
+        pool = upstream.pool_stats()[upstream_.api_config['base_url']]
+        assert pool['requests'] == TURNS
+        assert pool['misses'] == 1, pool
+        assert upstream_.stats()['requests'] == TURNS
+    finally:
+        upstream_.stop()
+
+
+@with_flush_interval
+def test_client_leaving_mid_stream_stops_the_reader():
+    upstream_ = FakeUpstream(tokens=50, interval=0.08)
+    try:
+        stream = stream_chat(upstream_.api_config, chat_payload('leaving early'))
+        for _ in range(3):
+            next(stream)
+        stream.close()
+        assert not readers()
+        # The dropped connection is replaced and the next turn completes
+        frames = list(stream_chat(upstream_.api_config, chat_payload('next turn')))
+        assert frames and not any(is_error(f) for f in frames)
+    finally:
+        upstream_.stop()
+
+
+if __name__ == '__main__':
+    failed = 0
+    for name, test in list(globals().items()):
+        if name.startswith('test_') and callable(test):
+            try:
+                test()
+                print(f'ok    {name}')
+            except AssertionError as e:
+                failed += 1
+                print(f'FAIL  {name} {e}')
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Test resuming chat streams (proxy/resume.py) through server.py and
+asgi.py against fake_upstream.py.
+
+A client leaves /api/chat after a few frames and reconnects with
+GET /api/chat/<stream_id>. The detached stream keeps its admission
+ticket while it reads upstream, so the reconnect must not be turned away
+by the per-client stream limit its own stream is counted against.
+
+Usage:
+    python test_resume.py
+    python -m pytest -q test_resume.py
+"""
+import asyncio
+import json
+import os
+import sys
+
+os.environ["RESUME_STREAMS"] = "true"
+os.environ.setdefault("REQUEST_LOG", "false")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import asgi  # noqa: E402
+import server  # noqa: E402
+from proxy import admission  # noqa: E402
+from test_coalesce import FakeUpstream  # noqa: E402
+
+FRAMES_BEFORE_LEAVING = 3
+
+
+def with_upstream(test):
+    """Run test against a fake upstream with ADMISSION_CLIENT_MAX_STREAMS=1."""
+    def run():
+        upstream = FakeUpstream(tokens=30, interval=0.02)
+        saved = [(config, dict(config)) for config in (server.API_CONFIG, asgi.API_CONFIG)]
+        previous = admission.ADMISSION_CONFIG["client_max_streams"]
+        admission.ADMISSION_CONFIG["client_max_streams"] = 1
+        for config, _ in saved:
+            config.update(upstream.api_config)
+        try:
+            test(upstream)
+        finally:
+            admission.ADMISSION_CONFIG["client_max_streams"] = previous
+            for config, values in saved:
+                config.update(values)
+            upstream.stop()
+    run.__name__ = test.__name__
+    return run
+
+
+def chat_body(text):
+    return {'messages': [{'role': 'user', 'content': text}]}
+
+
+def last_event_id(data):
+    ids = [line[4:] for line in data.split(b'\n') if line.startswith(b'id: ')]
+    return int(ids[-1])
+
+
+def assert_finished(data):
+    assert b'"done": true' in data, data[-200:]
+    assert b'"error"' not in data, data[-200:]
+
+
+@with_upstream
+def test_threaded_resume_with_one_stream_per_client(upstream):
+    client = server.app.test_client()
+    response = client.post('/api/chat', json=chat_body('threaded resume'), buffered=False)
+    assert response.status_code == 200
+    stream_id = response.headers['X-Stream-Id']
+    frames = iter(response.response)
+    received = b''.join(next(frames) for _ in range(FRAMES_BEFORE_LEAVING))
+    response.close()
+
+    resumed = client.get(f'/api/chat/{stream_id}', headers={'Last-Event-ID': str(last_event_id(received))})
+    assert resumed.status_code == 200, resumed.get_data()
+    assert_finished(resumed.get_data())
+    assert upstream.stats()['requests'] == 1
+
+
+class _Connection:
+    """An ASGI request whose client can be made to disconnect."""
+
+    def __init__(self, method, path, body=b'', headers=(), leave_after=None):
+        self.scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'',
+                      'headers': list(headers), 'client': ('127.0.0.1', 50000)}
+        self.body = body
+        self.leave_after = leave_after
+        self.sent_body = False
+        self.gone = asyncio.Event()
+        self.status = None
+        self.headers = {}
+        self.data = b''
+        self.chunks = 0
+
+    async def receive(self):
+        if not self.sent_body:
+            self.sent_body = True
+            return {'type': 'http.request', 'body': self.body, 'more_body': False}
+        await self.gone.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(self, message):
+        if message['type'] == 'http.response.start':
+            self.status = message['status']
+            self.headers = {k.decode('latin-1'): v.decode('latin-1') for k, v in message['headers']}
+        elif message.get('body'):
+            self.data += message['body']
+            self.chunks += 1
+            if self.chunks == self.leave_after:
+                self.gone.set()
+
+    async def run(self):
+        await asgi.app(self.scope, self.receive, self.send)
+        return self
+
+
+@with_upstream
+def test_async_resume_with_one_stream_per_client(upstream):
+    async def main():
+        chat = await _Connection('POST', '/api/chat', json.dumps(chat_body('async resume')).encode(),
+                                 leave_after=FRAMES_BEFORE_LEAVING).run()
+        assert chat.status == 200
+        return await _Connection('GET', f"/api/chat/{chat.headers['x-stream-id']}",
+                                 headers=[(b'last-event-id', str(last_event_id(chat.data)).encode())]).run()
+
+    resumed = asyncio.run(main())
+    assert resumed.status == 200, resumed.data
+    assert_finished(resumed.data)
+    assert upstream.stats()['requests'] == 1
+
+
+if __name__ == '__main__':
+    failed = 0
+    for name, test in list(globals().items()):
+        if name.startswith('test_') and callable(test):
+            try:
+                test()
+                print(f'ok    {name}')
+            except AssertionError as e:
+                failed += 1
+                print(f'FAIL  {name} {e}')
+    sys.exit(1 if failed else 0)
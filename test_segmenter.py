@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Corpus test for proxy/segmenter.py.
+
+Builds replies from the public/Template*.html slides (in a ```html fence,
+as a bare document, as a bare fragment, and one multi-hundred-KB reply
+holding every template several times, followed by a non-HTML code
+fence) and checks that the segment events
+
+- join back to the exact reply, byte for byte;
+- split it at the expected boundaries: text, then each block's opening
+  marker, HTML and closing marker, at the right UTF-16 offsets;
+- do not depend on where the delta boundaries fall.
+
+bench_segmenter.py measures throughput on the same corpus.
+
+Usage:
+    python test_segmenter.py
+    python -m pytest -q test_segmenter.py
+"""
+import glob
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from proxy.segmenter import Segmenter, utf16_len  # noqa: E402
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+INTRO = "Here is the slide based on your template:\n\n"
+OUTRO = "\n\nI kept the layout and colours of the template. Let me know if you want any changes!"
+
+SPLITS = 5
+
+
+def load_templates():
+    templates = {}
+    for path in sorted(glob.glob(os.path.join(ROOT, 'public', 'Template*.html'))):
+        with open(path, encoding='utf-8') as f:
+            templates[os.path.basename(path)] = f.read().strip()
+    return templates
+
+
+def body_of(document):
+    start = document.lower().find('<body')
+    start = document.find('>', start) + 1
+    end = document.lower().rfind('</body>')
+    return document[start:end].strip()
+
+
+def text(value):
+    return ('text', value)
+
+
+def block(kind, html, opener='', closer=''):
+    return (kind, opener, html, closer)
+
+
+def build_corpus(templates):
+    """
+    (name, reply, segments) triples.
+
+    segments is the reply in order as ('text', text) and
+    (kind, opening marker, html, closing marker) entries.
+    """
+    corpus = []
+    for name, document in templates.items():
+        fragment = '<div class="slide">\n' + body_of(document) + '\n</div>'
+        corpus.append((f'{name}:fence', f'{INTRO}```html\n{document}\n```{OUTRO}',
+                       [text(INTRO), block('fence', document + '\n', '```html\n', '```'), text(OUTRO)]))
+        corpus.append((f'{name}:document', f'{INTRO}{document}{OUTRO}',
+                       [text(INTRO), block('document', document), text(OUTRO)]))
+        corpus.append((f'{name}:fragment', f'{INTRO}{fragment}{OUTRO}',
+                       [text(INTRO), block('fragment', fragment), text(OUTRO)]))
+
+    segments = [text("Here are all the slides. Use `<div class=\"slide\">` wrappers to reorder them.\n\n")]
+    size = 0
+    while size < 300 * 1024:
+        for name, document in templates.items():
+            segments.append(text(f'### {name}\n\n'))
+            segments.append(block('fence', document + '\n', '```html\n', '```'))
+            segments.append(text('\n\n'))
+            size += len(document)
+    segments.append(text("```python\n# not HTML: <div>\nprint('done')\n```\n"))
+    corpus.append(('all-templates', ''.join(''.join(s[1:]) for s in segments), join_text(segments)))
+    return corpus
+
+
+def join_text(segments):
+    """Merge adjacent text segments, which the segmenter does not tell apart."""
+    joined = []
+    for segment_ in segments:
+        if joined and segment_[0] == 'text' and joined[-1][0] == 'text':
+            joined[-1] = text(joined[-1][1] + segment_[1])
+        else:
+            joined.append(segment_)
+    return joined
+
+
+def split_deltas(text, rng):
+    """Token-sized pieces of 1-8 characters."""
+    deltas = []
+    i = 0
+    while i < len(text):
+        n = rng.randint(1, 8)
+        deltas.append(text[i:i + n])
+        i += n
+    return deltas
+
+
+def segment(deltas):
+    segmenter = Segmenter()
+    events = []
+    for delta in deltas:
+        events.extend(segmenter.feed(delta))
+    events.extend(segmenter.close())
+    return events
+
+
+def piece(event):
+    return event.get('text') or event.get('html') or event.get('marker') or ''
+
+
+def merged(events):
+    """
+    The events as (offset, segment) pairs, in the form build_corpus uses.
+
+    Consecutive text events and the chunks of one block are merged, since
+    where a stream splits them depends on the deltas.
+    """
+    result = []
+    for event in events:
+        kind = event['type']
+        if kind == 'text':
+            if result and result[-1][1][0] == 'text':
+                offset, (_, value) = result[-1]
+                result[-1] = (offset, text(value + event['text']))
+            else:
+                result.append((event['offset'], text(event['text'])))
+        elif kind == 'html_start':
+            result.append((event['offset'], block(event['kind'], '', event.get('marker', ''))))
+        elif kind == 'html_chunk':
+            offset, (block_kind, opener, html, closer) = result[-1]
+            result[-1] = (offset, block(block_kind, html + event['html'], opener))
+        elif kind == 'html_end':
+            offset, (block_kind, opener, html, _) = result[-1]
+            assert event['complete'], f'block {event["block"]} not complete'
+            result[-1] = (offset, block(block_kind, html, opener, event.get('marker', '')))
+    return result
+
+
+def expected_offsets(segments):
+    offsets = []
+    offset = 0
+    for segment_ in segments:
+        offsets.append(offset)
+        offset += utf16_len(''.join(segment_[1:]))
+    return offsets
+
+
+def check_events(name, reply, segments, events):
+    joined = ''.join(piece(e) for e in events)
+    assert joined.encode('utf-8') == reply.encode('utf-8'), f'{name}: events do not join to the reply'
+    offset = 0
+    for event in events:
+        assert event['offset'] == offset, f'{name}: offset {event["offset"]} != {offset} at {event["type"]}'
+        offset += utf16_len(piece(event))
+    found = merged(events)
+    assert [s for _, s in found] == segments, f'{name}: segments differ at ' + next(
+        (f'{i}: {s[:2]} != {e[:2]}' for i, ((_, s), e) in enumerate(zip(found, segments)) if s != e),
+        f'the end ({len(found)} segments, {len(segments)} expected)')
+    assert [o for o, _ in found] == expected_offsets(segments), f'{name}: segment offsets differ'
+
+
+def test_corpus_segments():
+    corpus = build_corpus(load_templates())
+    assert corpus
+    for name, reply, segments in corpus:
+        check_events(name, reply, segments, segment([reply]))
+
+
+def test_corpus_does_not_depend_on_delta_boundaries():
+    for name, reply, segments in build_corpus(load_templates()):
+        for i in range(SPLITS):
+            check_events(f'{name} (split {i})', reply, segments, segment(split_deltas(reply, random.Random(i))))
+
+
+if __name__ == '__main__':
+    failed = 0
+    for name, test in list(globals().items()):
+        if name.startswith('test_') and callable(test):
+            try:
+                test()
+                print(f'ok    {name}')
+            except AssertionError as e:
+                failed += 1
+                print(f'FAIL  {name} {e}')
+    sys.exit(1 if failed else 0)